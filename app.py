@@ -1,50 +1,77 @@
-import os
-
 from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from models import db, connect_db, User, Follows, Comment, Post, Ingredient, Cabinet, CabinetIngredient
 from forms import UserAddForm, LoginForm
+from passwords import HasherBusy
+from config import get_config
+import identity
+import metrics
+import fragment_cache
+import replicas
+import ratelimit
+from ratelimit import limit
+from identity import CURR_USER_KEY
+
+
+def create_app(config=None):
+    """Build an app for a profile name from config.PROFILES or a config object
+
+    Blueprints and optional extensions are imported here rather than when
+    this module is, and the numpy/scipy batch code only by the jobs that
+    use it, so a worker boots with just what serving requests needs.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(get_config(config))
 
-#blueprints
-from blueprints.user.user import user
-from blueprints.cabinet.cabinet import cabinet
-from blueprints.cdb.cdb import cdb
-from blueprints.post.post import post
+    #blueprints
+    from blueprints.user.user import user
+    from blueprints.cabinet.cabinet import cabinet
+    from blueprints.cdb.cdb import cdb
+    from blueprints.post.post import post
+    from blueprints.search.search import search
 
-CURR_USER_KEY = "curr_user"
+    app.register_blueprint(user, url_prefix="/user")
+    app.register_blueprint(cabinet, url_prefix="/cabinet")
+    app.register_blueprint(cdb, url_prefix = "/api/cdb")
+    app.register_blueprint(post, url_prefix = "/post")
+    app.register_blueprint(search, url_prefix = "/search")
 
-app = Flask(__name__)
-app.register_blueprint(user, url_prefix="/user")
-app.register_blueprint(cabinet, url_prefix="/cabinet")
-app.register_blueprint(cdb, url_prefix = "/api/cdb")
-app.register_blueprint(post, url_prefix = "/post")
+    if app.config.get('DEBUG_TOOLBAR'):
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///bartender'))
+    connect_db(app)
+    metrics.init_app(app)
+    fragment_cache.init_app(app)
+    replicas.init_app(app, db)
+    ratelimit.init_app(app)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    app.before_request(add_user_to_g)
+    app.register_error_handler(HasherBusy, password_hasher_busy)
+    app.add_url_rule('/', view_func=landing_page)
+    app.add_url_rule('/login', view_func=login, methods=["POST"])
+    app.add_url_rule('/logout', view_func=log_out_user)
+    app.add_url_rule('/signup', view_func=sign_up_user, methods=['POST'])
 
-connect_db(app)
+    return app
 
 
-@app.before_request
 # Functions for Authorization Management
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a lazy proxy, so requests that never use it skip the lookup.
+    """
 
-    else:
-        g.user = None
+    g.user = identity.current_user_proxy
+
+
+def password_hasher_busy(error):
+    """Too many logins/signups in flight; shed the request instead of queueing"""
+
+    return "Too many login attempts right now, please try again.", 503, {'Retry-After': '1'}
 
 
 def do_login(user):
@@ -57,11 +84,11 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        identity.invalidate(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
 # home/ feed - requires authorization
-@app.route('/')
 def landing_page():
     #
     # shows feed for logged in users, landing page if no user
@@ -75,7 +102,7 @@ def landing_page():
     return render_template('landing_page.html', signup_form = signup_form, login_form = login_form )
 
 # log in route - global access
-@app.route('/login', methods=["POST"])
+@limit('auth')
 def login():
     """Handle user login."""
 
@@ -86,6 +113,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # persists a rehashed password if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/user/")
@@ -98,7 +127,6 @@ def login():
 
 
 # log out route - requires authorization
-@app.route('/logout')
 def log_out_user():
     """Handle logout of user."""
 
@@ -108,7 +136,7 @@ def log_out_user():
     return redirect('/')
 
 
-@app.route('/signup', methods=['POST'])
+@limit('auth')
 def sign_up_user():
 
     """Handle user signup.
@@ -128,12 +156,12 @@ def sign_up_user():
                 password=form.password.data,
                 email=form.email.data,
             )
-            db.session.commit()
-            cabinet = Cabinet(user_id=user.id)
-            db.session.add(cabinet)
+            db.session.flush()
+            db.session.add(Cabinet(user_id=user.id))
             db.session.commit()
 
         except IntegrityError:
+            db.session.rollback()
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
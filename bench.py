@@ -0,0 +1,225 @@
+"""Endpoint benchmark suite.
+
+    python seed.py --users 100000 --posts 10000000
+    python bench.py --iterations 200 --save baseline.json
+    python bench.py --compare baseline.json
+
+Drives the app through app.test_client() against whatever DATABASE_URL
+points at, logged in as a mix of the heaviest followers and random users, and
+reports p50/p95/p99 latency and SQL statements per request for each endpoint.
+With --compare it exits non-zero when an endpoint's p95 latency or statement
+count regresses past the threshold, so it can gate a deploy.
+
+Only read-only endpoints run by default. The ones in WRITE_ENDPOINTS change
+the data they hit, so they run only with --writes, which is meant for a
+seeded throwaway database and not one anybody uses:
+
+    DATABASE_URL=postgres:///bartender_bench python bench.py --writes
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from urllib.parse import quote
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Follows, Post, Ingredient
+from querycount import count_queries
+import ratelimit
+
+# endpoints that write, skipped unless --writes is given
+WRITE_ENDPOINTS = ('add_to_cabinet',)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def sample_users(rng, count):
+    """Half the heaviest followers, half random users"""
+
+    heavy = [row[0] for row in db.session.query(Follows.user_following_id)
+        .group_by(Follows.user_following_id)
+        .order_by(db.func.count().desc())
+        .limit(count // 2 or 1)]
+
+    max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    if not max_id:
+        sys.exit('No users found; run seed.py first.')
+    picked = {id for id, in db.session.query(User.id)
+        .filter(User.id.in_([rng.randint(1, max_id) for _ in range(count * 4)]))
+        .limit(count - len(heavy))}
+
+    return User.query.filter(User.id.in_(set(heavy) | picked)).all()
+
+
+def endpoints(rng, users):
+    """Endpoint name -> function returning the (user, path) for the next request"""
+
+    max_post = db.session.query(db.func.max(Post.id)).scalar() or 1
+    ingredient_names = [name for name, in db.session.query(Ingredient.name).limit(5000)]
+
+    def home():
+        return rng.choice(users), '/user/'
+
+    def feed():
+        return rng.choice(users), '/user/feed'
+
+    def profile():
+        return rng.choice(users), f'/user/{rng.choice(users).username}'
+
+    def show_post():
+        return rng.choice(users), f'/post/{rng.randint(1, max_post)}'
+
+    def makeable():
+        return rng.choice(users), '/cabinet/makeable'
+
+    def add_to_cabinet():
+        return rng.choice(users), f'/cabinet/add/{rng.choice(ingredient_names)}'
+
+    def get_cabinet():
+        return rng.choice(users), '/cabinet/get'
+
+    def autocomplete():
+        name = rng.choice(ingredient_names)
+        return rng.choice(users), f'/cabinet/ingredients/autocomplete?q={quote(name[:rng.randint(2, len(name))])}'
+
+    return {
+        'show_home': home,
+        'get_feed': feed,
+        'show_profile': profile,
+        'show_post': show_post,
+        'show_makeable': makeable,
+        'add_to_cabinet': add_to_cabinet,
+        'get_cabinet': get_cabinet,
+        'autocomplete': autocomplete,
+    }
+
+
+def run(names, iterations, warmup, users=20, random_seed=0, writes=False):
+    """Benchmark each endpoint, those in WRITE_ENDPOINTS only if `writes`; returns {name: stats}
+
+    Raises ValueError for unknown endpoint names, or write endpoints without `writes`.
+    """
+
+    rng = random.Random(random_seed)
+    results = {}
+    app = create_app()
+    # measuring the endpoints, not the limits in front of them
+    ratelimit.limiter.backend = ratelimit.NullBackend()
+
+    with app.app_context():
+        sampled = sample_users(rng, users)
+        cases = endpoints(rng, sampled)
+        engine = db.engine
+
+    client = app.test_client()
+
+    names = names or [name for name in cases if writes or name not in WRITE_ENDPOINTS]
+    unknown = [name for name in names if name not in cases]
+    if unknown:
+        raise ValueError(f"unknown endpoint {', '.join(unknown)}; choose from {', '.join(cases)}")
+    skipped = [name for name in names if name in WRITE_ENDPOINTS and not writes]
+    if skipped:
+        raise ValueError(f"{', '.join(skipped)} write to the database; pass --writes to run them against a throwaway one")
+
+    for name in names:
+        case = cases[name]
+        latencies = []
+        statements = []
+        errors = 0
+
+        for i in range(warmup + iterations):
+            user, path = case()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+
+            with count_queries(engine) as counted:
+                start = time.perf_counter()
+                resp = client.get(path)
+                elapsed = time.perf_counter() - start
+
+            if i < warmup:
+                continue
+            if resp.status_code >= 500:
+                errors += 1
+            latencies.append(elapsed * 1000)
+            statements.append(len(counted))
+
+        results[name] = {
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'statements_mean': sum(statements) / len(statements),
+            'statements_max': max(statements),
+            'errors': errors,
+        }
+
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write(f"{'endpoint':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql avg':>10}{'sql max':>10}{'errors':>8}\n")
+    for name, r in results.items():
+        out.write(f"{name:<16}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                  f"{r['statements_mean']:>10.1f}{r['statements_max']:>10}{r['errors']:>8}\n")
+
+
+def regressions(results, baseline, threshold):
+    """Endpoints whose p95 or statement count grew by more than `threshold`x"""
+
+    found = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if r['p95_ms'] > base['p95_ms'] * threshold:
+            found.append(f"{name}: p95 {base['p95_ms']:.2f}ms -> {r['p95_ms']:.2f}ms")
+        if r['statements_max'] > base['statements_max']:
+            found.append(f"{name}: max statements {base['statements_max']} -> {r['statements_max']}")
+        if r['errors'] > base['errors']:
+            found.append(f"{name}: errors {base['errors']} -> {r['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('endpoints', nargs='*', help='endpoints to run (default: all)')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--users', type=int, default=20, help='distinct users to log in as')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--writes', action='store_true',
+        help=f"also run endpoints that write ({', '.join(WRITE_ENDPOINTS)}); use a throwaway database")
+    parser.add_argument('--save', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed p95 slowdown factor')
+    args = parser.parse_args()
+
+    try:
+        results = run(args.endpoints, args.iterations, args.warmup, args.users, args.seed, args.writes)
+    except ValueError as error:
+        parser.error(str(error))
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        for line in found:
+            print('REGRESSION', line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
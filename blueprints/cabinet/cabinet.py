@@ -1,39 +1,227 @@
-from flask import Blueprint, render_template, g, flash, redirect, session
-from models import Cabinet, CabinetIngredient, Ingredient, db
+from flask import Blueprint, render_template, g, flash, redirect, session, jsonify, request, make_response
+from models import Cabinet, CabinetIngredient, CabinetSuggestion, Ingredient, db
+from querycount import query_budget
+from replicas import use_primary
+from ratelimit import limit
+from . import matcher, ingredient_index, recommend
 
 cabinet = Blueprint("cabinet", __name__, template_folder="templates")
 
+# most names or ids accepted per list in one bulk request
+MAX_BULK_INGREDIENTS = 500
+# most recipes /makeable returns per list
+MAX_MAKEABLE = 500
+
+def cabinet_id_for(user):
+    """Id of the user's cabinet, created on first use"""
+
+    cabinet_id = db.session.query(Cabinet.id).filter(Cabinet.user_id == user.id).scalar()
+    if cabinet_id is None:
+        cabinet = Cabinet(user_id=user.id)
+        db.session.add(cabinet)
+        db.session.flush()
+        cabinet_id = cabinet.id
+    return cabinet_id
+
+def record_change(cabinet_id, added=(), removed=()):
+    """Log a change to the cabinet and queue a refresh of its buy-next suggestions"""
+
+    version = Cabinet.record_change(cabinet_id, added, removed)
+    if version is not None:
+        recommend.queue_refresh(cabinet_id)
+    return version
+
+def resolve_ingredients(items, index):
+    """Split ids and names into (ingredient ids, names the index doesn't know)"""
+
+    ids = set()
+    unknown = []
+    for item in items:
+        if isinstance(item, int) and not isinstance(item, bool):
+            ids.add(item)
+            continue
+        ingredient_id = index.lookup(item) if isinstance(item, str) else None
+        if ingredient_id:
+            ids.add(ingredient_id)
+        else:
+            unknown.append(item)
+    return ids, unknown
+
 @cabinet.route('/')
 def test():
     return 'TEST'
 
 @cabinet.route('/add/<name>', methods= ['GET','POST'])
+@use_primary
+@limit('write')
 def add_to_cabinet(name):
     """Add ingredients to Cabinet"""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    ingredient = Ingredient.query.filter(Ingredient.name == name).one_or_none()
+    index = ingredient_index.get_index()
+    ingredient_id = index.lookup(name)
 
-    if ingredient:
-        cabinet = Cabinet.query.filter(Cabinet.user_id == g.user.id).first()
-        cabinet.ingredients.append(ingredient)
+    if ingredient_id:
+        cabinet_id = cabinet_id_for(g.user)
+        record_change(cabinet_id, added=CabinetIngredient.add_many(cabinet_id, [ingredient_id]))
         db.session.commit()
         flash('Added Ingredient Successfully')
     else:
-        flash('Could not find ingredient')
+        suggestions = index.search(name, limit=3)
+        if suggestions:
+            flash(f"Could not find ingredient. Did you mean {', '.join(s['name'] for s in suggestions)}?")
+        else:
+            flash('Could not find ingredient')
 
     return redirect('/user')
 
+@cabinet.route('/ingredients/autocomplete')
+def autocomplete_ingredients():
+    """Ingredients matching ?q= by name or alias, tolerating typos"""
+
+    q = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+
+    return jsonify(results=ingredient_index.get_index().search(q, limit))
+
 @cabinet.route('/remove', methods = ['POST'])
+@limit('write')
 def remove_from_cabinet():
     """Remove ingredients from Cabinet"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    cabinet_id = cabinet_id_for(g.user)
+    removed = CabinetIngredient.remove_many(cabinet_id, request.form.getlist('ingredient_id', type=int))
+    record_change(cabinet_id, removed=removed)
+    db.session.commit()
+    flash(f'Removed {len(removed)} ingredient(s)')
+
+    return redirect('/user')
+
+@cabinet.route('/ingredients', methods=['POST'])
+@limit('write')
+@query_budget(13)
+def update_cabinet_ingredients():
+    """Bulk add and remove: {"add": [...], "remove": [...]} of ingredient ids or names
+
+    Each list is written with a single statement. Names the ingredient index
+    can't resolve come back under "unknown".
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="Expected a JSON object."), 400
+
+    add = data.get('add') or []
+    remove = data.get('remove') or []
+    if not isinstance(add, list) or not isinstance(remove, list):
+        return jsonify(error="'add' and 'remove' must be lists."), 400
+    if len(add) > MAX_BULK_INGREDIENTS or len(remove) > MAX_BULK_INGREDIENTS:
+        return jsonify(error=f"At most {MAX_BULK_INGREDIENTS} ingredients per list."), 400
+
+    index = ingredient_index.get_index()
+    add_ids, unknown = resolve_ingredients(add, index)
+    remove_ids, unknown_removed = resolve_ingredients(remove, index)
 
-    return redirect('/cabinet')
+    cabinet_id = cabinet_id_for(g.user)
+    removed = CabinetIngredient.remove_many(cabinet_id, remove_ids - add_ids)
+    added = CabinetIngredient.add_many(cabinet_id, add_ids)
+    record_change(cabinet_id, added, removed)
+    db.session.commit()
+
+    ingredient_ids = [row.ingredient_id for row in db.session.query(CabinetIngredient.ingredient_id)
+        .filter(CabinetIngredient.cabinet_id == cabinet_id)
+        .order_by(CabinetIngredient.ingredient_id)]
+
+    return jsonify(added=len(added), removed=len(removed), unknown=unknown + unknown_removed, ingredients=ingredient_ids)
+
+def serialize_ingredients(query):
+    return [{'id': id, 'name': name} for id, name in query.order_by(Ingredient.name)]
 
 @cabinet.route('/get')
+@query_budget(4)
 def get_cabinet_list():
-    """Returns Cabinet Info"""
+    """Returns Cabinet Info
+
+    The ETag is the cabinet version, so polling an unchanged cabinet costs one
+    query and a 304. With ?since=<version> only the net additions and removals
+    after that version come back ("added"/"removed"); without it, or when the
+    change log doesn't reach back that far, the whole cabinet ("ingredients").
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    cabinet = Cabinet.query.filter(Cabinet.user_id == g.user.id).first()
+    if cabinet is None:
+        return jsonify(error="No cabinet."), 404
+
+    etag = f'cabinet-{cabinet.id}-{cabinet.version}'
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        since = request.args.get('since', type=int)
+        changes = cabinet.changes_since(since) if since is not None else None
+
+        if changes is None:
+            resp = jsonify(version=cabinet.version, ingredients=serialize_ingredients(
+                db.session.query(Ingredient.id, Ingredient.name)
+                .join(CabinetIngredient, CabinetIngredient.ingredient_id == Ingredient.id)
+                .filter(CabinetIngredient.cabinet_id == cabinet.id)))
+        else:
+            added, removed = changes
+            resp = jsonify(version=cabinet.version, since=since, removed=sorted(removed),
+                added=serialize_ingredients(db.session.query(Ingredient.id, Ingredient.name)
+                    .filter(Ingredient.id.in_(added))) if added else [])
+
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+@cabinet.route('/makeable')
+def show_makeable():
+    """Returns the recipes the current user's cabinet can make, plus near misses
+
+    ?missing= sets how many absent ingredients still count as a near miss (0-2)
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    max_missing = min(max(request.args.get('missing', 2, type=int), 0), 2)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_MAKEABLE)
+
+    ingredient_ids = [row.ingredient_id for row in db.session.query(CabinetIngredient.ingredient_id)
+        .join(Cabinet, Cabinet.id == CabinetIngredient.cabinet_id)
+        .filter(Cabinet.user_id == g.user.id)]
+
+    result = matcher.get_index().match(ingredient_ids, max_missing=max_missing, limit=limit)
+
+    return jsonify(makeable=result['makeable'],
+        missing={str(n): recipes for n, recipes in result['missing'].items()})
+
+@cabinet.route('/suggestions')
+@query_budget(2)
+def show_suggestions():
+    """Ingredients to buy next, by how many new recipes each one would unlock
+
+    Read from cabinet_suggestions, which a background job refreshes after
+    every change to the cabinet.
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    limit = min(max(request.args.get('limit', 10, type=int), 1), recommend.SUGGESTIONS_PER_CABINET)
+
+    suggestions = (db.session.query(Ingredient.id, Ingredient.name, CabinetSuggestion.unlocks)
+        .join(CabinetSuggestion, CabinetSuggestion.ingredient_id == Ingredient.id)
+        .join(Cabinet, Cabinet.id == CabinetSuggestion.cabinet_id)
+        .filter(Cabinet.user_id == g.user.id)
+        .order_by(CabinetSuggestion.unlocks.desc(), Ingredient.name)
+        .limit(limit))
 
-    return redirect('/cabinet')
\ No newline at end of file
+    return jsonify(suggestions=[{'id': id, 'name': name, 'unlocks': unlocks} for id, name, unlocks in suggestions])
@@ -0,0 +1,114 @@
+"""Sparse matrix arithmetic behind blueprints/cabinet/recommend.py.
+
+The catalog is a sparse recipe x ingredient incidence matrix M. Shared
+ingredient counts for every pair of recipes are M @ M.T, from which the
+Jaccard similarity |a & b| / (|a| + |b| - |a & b|) follows elementwise. For a
+batch of cabinets C (cabinet x ingredient), C @ M.T counts the ingredients
+each cabinet has of each recipe; the recipes missing exactly one make a 0/1
+matrix U, and U @ M counts, per cabinet and ingredient, the recipes buying
+that ingredient would complete. Both are a few sparse products per block of
+rows instead of Python loops over recipes.
+
+numpy and scipy are only imported by the processes that compute, through
+recommend.get_catalog, not by every web worker that imports the views.
+"""
+
+import time
+
+import numpy as np
+from scipy import sparse
+
+# dense cells per block of cabinets x recipes when looking for near misses
+BLOCK_CELLS = 4 * 1024 * 1024
+
+
+class Catalog:
+    """Recipe x ingredient incidence matrix for the matcher's current catalog"""
+
+    def __init__(self, recipe_ids, recipe_ingredients):
+        """`recipe_ids[i]` uses the ingredient ids in `recipe_ingredients[i]`"""
+
+        self.recipe_ids = np.asarray(recipe_ids, dtype=np.int64)
+        sizes = np.fromiter((len(ings) for ings in recipe_ingredients), dtype=np.int64, count=len(recipe_ids))
+        columns = np.fromiter((i for ings in recipe_ingredients for i in ings), dtype=np.int64, count=sizes.sum())
+
+        self.ingredient_ids, columns = np.unique(columns, return_inverse=True)
+        rows = np.repeat(np.arange(len(self.recipe_ids)), sizes)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.int32), (rows, columns.ravel())),
+            shape=(len(self.recipe_ids), len(self.ingredient_ids)))
+        self.sizes = sizes
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(index.recipe_ids, index.recipe_ingredients)
+
+    def similar(self, k, block=1024):
+        """Yield (recipe_id, similar_recipe_id, score) arrays, k per recipe, best first"""
+
+        matrix, transposed = self.matrix, self.matrix.T.tocsr()
+        for start in range(0, matrix.shape[0], block):
+            shared = matrix[start:start + block] @ transposed
+            rows, columns, counts = _triples(shared)
+            rows += start
+
+            keep = rows != columns
+            rows, columns, counts = rows[keep], columns[keep], counts[keep]
+            scores = counts / (self.sizes[rows] + self.sizes[columns] - counts)
+
+            top = _top_per_row(rows, scores, -columns, k)
+            yield self.recipe_ids[rows[top]], self.recipe_ids[columns[top]], scores[top]
+
+    def cabinet_matrix(self, cabinet_ids, pairs):
+        """Cabinet x ingredient matrix from (cabinet_id, ingredient_id) pairs.
+
+        Ingredients no recipe uses can't unlock anything and are left out.
+        """
+
+        slots = {cabinet_id: slot for slot, cabinet_id in enumerate(cabinet_ids)}
+        pairs = np.array([(slots[cabinet_id], ingredient_id) for cabinet_id, ingredient_id in pairs],
+            dtype=np.int64).reshape(-1, 2)
+
+        columns = np.searchsorted(self.ingredient_ids, pairs[:, 1])
+        known = columns < len(self.ingredient_ids)
+        known[known] = self.ingredient_ids[columns[known]] == pairs[known, 1]
+
+        return sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=np.int32), (pairs[known, 0], columns[known])),
+            shape=(len(cabinet_ids), len(self.ingredient_ids)))
+
+    def buy_next(self, cabinets, k):
+        """Yield (cabinet slot, ingredient_id, unlocks) arrays for a cabinet matrix, k per cabinet"""
+
+        transposed = self.matrix.T.tocsr()
+        block = max(1, BLOCK_CELLS // max(1, len(self.recipe_ids)))
+        for start in range(0, cabinets.shape[0], block):
+            have = cabinets[start:start + block]
+            missing = self.sizes - (have @ transposed).toarray()
+            near = sparse.csr_matrix((missing == 1).astype(np.int32))
+
+            # counts the owned ingredients of those recipes too; drop them
+            unlocks = near @ self.matrix
+            unlocks = (unlocks - unlocks.multiply(have)).tocsr()
+            unlocks.eliminate_zeros()
+
+            rows, columns, counts = _triples(unlocks)
+            top = _top_per_row(rows, counts, -columns, k)
+            yield rows[top] + start, self.ingredient_ids[columns[top]], counts[top]
+
+
+def _triples(matrix):
+    """(rows, columns, values) of a CSR matrix's stored entries"""
+
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return rows, matrix.indices.astype(np.int64), matrix.data
+
+
+def _top_per_row(rows, values, tiebreak, k):
+    """Indices of the k largest values in each row, largest first, then by largest tiebreak"""
+
+    order = np.lexsort((-tiebreak, -values, rows))
+    rows = rows[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    return order[rank < k]
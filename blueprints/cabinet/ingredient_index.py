@@ -0,0 +1,312 @@
+"""Ingredient search index for the cabinet blueprint.
+
+Ingredient names and aliases are normalized (accents stripped, lower case,
+punctuation collapsed) and held in memory twice: as a sorted list for prefix
+lookups with bisect, and as a trigram -> entries map for typo tolerant
+matching. The index is loaded once per process and then patched in place as
+Ingredient and IngredientAlias rows are committed.
+"""
+
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, inspect
+
+from models import db, Ingredient, IngredientAlias
+
+# rebuild at least this often so other workers pick up catalog changes
+MAX_INDEX_AGE = 600
+
+# pg_trgm's default similarity threshold
+MIN_SIMILARITY = 0.3
+
+# most entries to count per fuzzy search; common trigrams past this are skipped
+MAX_SCAN = 8000
+
+# posting list items are (trigram count << KEY_BITS | key), so shorter names sort first
+KEY_BITS = 40
+KEY_MASK = (1 << KEY_BITS) - 1
+
+
+_NON_ALNUM = re.compile(r'[\W_]+')
+
+
+def normalize(name):
+    """'  Crème de Cassis!' -> 'creme de cassis'"""
+
+    if not name.isascii():
+        decomposed = unicodedata.normalize('NFKD', name)
+        name = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_ALNUM.sub(' ', name.lower()).strip()
+
+
+def trigrams(normalized):
+    """Trigrams of each word, padded like pg_trgm so word starts weigh more"""
+
+    grams = set()
+    for word in normalized.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def ingredient_key(ingredient_id):
+    return ingredient_id << 1
+
+
+def alias_key(alias_id):
+    return alias_id << 1 | 1
+
+
+def is_alias(key):
+    return key & 1
+
+
+class IngredientIndex:
+    """Prefix and trigram index over ingredient names and aliases.
+
+    Entries are keyed by small ints, see ingredient_key and alias_key; lookups
+    always answer with the canonical ingredient.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.sorted = []
+        self.postings = defaultdict(list)
+        self.exact = defaultdict(set)
+        self.by_ingredient = defaultdict(set)
+        self.names = {}
+        self.lock = threading.RLock()
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        rows = [(ingredient_key(id), id, name) for id, name in db.session.query(Ingredient.id, Ingredient.name)]
+        rows += [(alias_key(id), ingredient_id, name) for id, ingredient_id, name in
+            db.session.query(IngredientAlias.id, IngredientAlias.ingredient_id, IngredientAlias.name)]
+        return cls.from_rows(rows)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from (key, ingredient_id, name) rows, sorting once at the end"""
+
+        index = cls()
+        for key, ingredient_id, name in rows:
+            index.add(key, ingredient_id, name, keep_sorted=False)
+        index.sorted.sort()
+        for posting in index.postings.values():
+            posting.sort()
+        return index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, ingredient_id, name, keep_sorted=True):
+        """Add or replace an entry"""
+
+        with self.lock:
+            self.remove(key)
+
+            normalized = normalize(name)
+            grams = trigrams(normalized)
+            self.entries[key] = (ingredient_id, name, normalized, grams)
+            item = len(grams) << KEY_BITS | key
+            if keep_sorted:
+                bisect.insort(self.sorted, (normalized, key))
+                for gram in grams:
+                    bisect.insort(self.postings[gram], item)
+            else:
+                self.sorted.append((normalized, key))
+                for gram in grams:
+                    self.postings[gram].append(item)
+            self.exact[normalized].add(key)
+            self.by_ingredient[ingredient_id].add(key)
+            if not is_alias(key):
+                self.names[ingredient_id] = name
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            ingredient_id, name, normalized, grams = entry
+
+            i = bisect.bisect_left(self.sorted, (normalized, key))
+            if i < len(self.sorted) and self.sorted[i] == (normalized, key):
+                del self.sorted[i]
+            item = len(grams) << KEY_BITS | key
+            for gram in grams:
+                posting = self.postings[gram]
+                i = bisect.bisect_left(posting, item)
+                if i < len(posting) and posting[i] == item:
+                    del posting[i]
+            self.exact[normalized].discard(key)
+            self.by_ingredient[ingredient_id].discard(key)
+            if not is_alias(key):
+                self.names.pop(ingredient_id, None)
+
+    def remove_ingredient(self, ingredient_id):
+        """Drop an ingredient and every alias pointing at it"""
+
+        with self.lock:
+            for key in list(self.by_ingredient.pop(ingredient_id, ())):
+                self.remove(key)
+
+    def lookup(self, name):
+        """Id of the ingredient whose name or alias normalizes to `name`, or None"""
+
+        with self.lock:
+            keys = self.exact.get(normalize(name))
+            if not keys:
+                return None
+            # a real name beats an alias
+            key = min(keys, key=lambda key: (is_alias(key), key))
+            return self.entries[key][0]
+
+    def _result(self, key, score):
+        ingredient_id, name, normalized, grams = self.entries[key]
+        result = {'id': ingredient_id, 'name': self.names.get(ingredient_id, name), 'score': round(score, 3)}
+        if is_alias(key):
+            result['alias'] = name
+        return result
+
+    def search(self, query, limit=10):
+        """Best matches for `query`: exact, then prefix, then fuzzy"""
+
+        q = normalize(query)
+        if not q:
+            return []
+
+        results = {}
+        with self.lock:
+            # prefix matches, exact first
+            i = bisect.bisect_left(self.sorted, (q,))
+            while i < len(self.sorted) and len(results) < limit:
+                normalized, key = self.sorted[i]
+                if not normalized.startswith(q):
+                    break
+                ingredient_id = self.entries[key][0]
+                if ingredient_id not in results:
+                    results[ingredient_id] = self._result(key, 1.0 if normalized == q else 0.9)
+                i += 1
+
+            if len(results) < limit:
+                for ingredient_id, result in self._fuzzy(q, limit):
+                    if ingredient_id not in results:
+                        results[ingredient_id] = result
+                    if len(results) == limit:
+                        break
+
+        return sorted(results.values(), key=lambda r: -r['score'])
+
+    def _fuzzy(self, q, limit):
+        """Trigram similarity matches, rarest trigrams read first.
+
+        Rare trigrams are counted in full and common ones share what is left
+        of MAX_SCAN. Posting lists are ordered by name length, so a truncated
+        list still contributes its shortest, best scoring names.
+        """
+
+        grams = trigrams(q)
+        postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+
+        hits = Counter()
+        budget = MAX_SCAN
+        for i, items in enumerate(postings):
+            share = budget // (len(postings) - i)
+            hits.update(items[:share])
+            budget -= min(len(items), share)
+
+        scored = []
+        for item, count in hits.most_common(limit * 5):
+            key = item & KEY_MASK
+            entry_grams = self.entries[key][3]
+            shared = len(grams & entry_grams)
+            similarity = shared / (len(grams) + len(entry_grams) - shared)
+            if similarity >= MIN_SIMILARITY:
+                scored.append((similarity, key))
+
+        scored.sort(key=lambda item: -item[0])
+        return [(self.entries[key][0], self._result(key, score * 0.8)) for score, key in scored]
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Return the current index, loading it if needed"""
+
+    global _index
+
+    index = _index
+    if index is None or time.monotonic() - index.built_at > MAX_INDEX_AGE:
+        with _lock:
+            if _index is None or time.monotonic() - _index.built_at > MAX_INDEX_AGE:
+                _index = IngredientIndex.build()
+            index = _index
+    return index
+
+
+def invalidate():
+    """Drop the index; the next lookup reloads it"""
+
+    global _index
+    _index = None
+
+
+def _changes(session):
+    """(op, key, ingredient_id, name) for the ingredient rows this flush wrote"""
+
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Ingredient):
+            changes.append(('add', ingredient_key(obj.id), obj.id, obj.name))
+        elif isinstance(obj, IngredientAlias):
+            changes.append(('add', alias_key(obj.id), obj.ingredient_id, obj.name))
+
+    for obj in session.dirty:
+        if isinstance(obj, Ingredient) and inspect(obj).attrs.name.history.has_changes():
+            changes.append(('add', ingredient_key(obj.id), obj.id, obj.name))
+        elif isinstance(obj, IngredientAlias) and session.is_modified(obj, include_collections=False):
+            changes.append(('add', alias_key(obj.id), obj.ingredient_id, obj.name))
+
+    for obj in session.deleted:
+        if isinstance(obj, Ingredient):
+            changes.append(('remove_ingredient', None, obj.id, None))
+        elif isinstance(obj, IngredientAlias):
+            changes.append(('remove', alias_key(obj.id), obj.ingredient_id, None))
+
+    return changes
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = _changes(session)
+    if changes:
+        session.info.setdefault('ingredient_index_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('ingredient_index_changes', None)
+    index = _index
+    if not changes or index is None:
+        return
+
+    for op, key, ingredient_id, name in changes:
+        if op == 'add':
+            index.add(key, ingredient_id, name)
+        elif op == 'remove':
+            index.remove(key)
+        else:
+            index.remove_ingredient(ingredient_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('ingredient_index_changes', None)
@@ -0,0 +1,201 @@
+"""Recipe matching engine for the cabinet blueprint.
+
+Every recipe gets a slot number and every ingredient maps to a bitset (a
+python int) with the bit for each recipe slot that uses it. Matching a cabinet
+adds the bitsets of its ingredients into bit-sliced counters, so the number of
+ingredients on hand for every recipe is known after a handful of big-int
+operations per cabinet ingredient, no matter how many recipes there are.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event, inspect
+
+from models import db, Recipe, Ingredient, RecipeIngredient
+
+# rebuild at least this often so other workers pick up catalog changes
+MAX_INDEX_AGE = 300
+
+
+class RecipeIndex:
+    """Inverted index of ingredient id -> bitset of recipe slots"""
+
+    def __init__(self, recipes, pairs, ingredient_names=None):
+        """`recipes` is a list of (id, name), `pairs` an iterable of
+        (recipe_id, ingredient_id) rows from recipe_ingredient.
+        """
+
+        self.recipe_ids = [recipe_id for recipe_id, name in recipes]
+        self.recipe_names = [name for recipe_id, name in recipes]
+        self.ingredient_names = ingredient_names or {}
+
+        slots = {recipe_id: slot for slot, recipe_id in enumerate(self.recipe_ids)}
+        ingredients = [[] for recipe_id in self.recipe_ids]
+        for recipe_id, ingredient_id in pairs:
+            slot = slots.get(recipe_id)
+            if slot is not None:
+                ingredients[slot].append(ingredient_id)
+        self.recipe_ingredients = [tuple(ings) for ings in ingredients]
+
+        self.ingredient_bits = {}
+        sizes = {}
+        for slot, ings in enumerate(self.recipe_ingredients):
+            bit = 1 << slot
+            for ingredient_id in ings:
+                self.ingredient_bits[ingredient_id] = self.ingredient_bits.get(ingredient_id, 0) | bit
+            if ings:
+                sizes[len(ings)] = sizes.get(len(ings), 0) | bit
+
+        # size -> bitset of recipes needing exactly that many ingredients
+        self.size_bits = sizes
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        """Load the whole catalog with three flat queries"""
+
+        recipes = db.session.query(Recipe.id, Recipe.name).order_by(Recipe.name, Recipe.id).all()
+        pairs = db.session.query(RecipeIngredient.recipe_id, RecipeIngredient.ingredient_id).all()
+        names = dict(db.session.query(Ingredient.id, Ingredient.name).all())
+
+        return cls(recipes, pairs, names)
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    def _counters(self, ingredient_ids):
+        """Bit-sliced count of cabinet ingredients per recipe.
+
+        planes[i] holds bit i of every recipe's counter, so adding an
+        ingredient is a ripple-carry add of its bitset into the planes.
+        """
+
+        planes = []
+        for ingredient_id in ingredient_ids:
+            carry = self.ingredient_bits.get(ingredient_id, 0)
+            i = 0
+            while carry:
+                if i == len(planes):
+                    planes.append(0)
+                planes[i], carry = planes[i] ^ carry, planes[i] & carry
+                i += 1
+        return planes
+
+    @staticmethod
+    def _count_equals(planes, count, candidates):
+        """Bitset of `candidates` whose counter equals `count`"""
+
+        if count >> len(planes):
+            return 0
+        for i, plane in enumerate(planes):
+            candidates &= plane if (count >> i) & 1 else ~plane
+        return candidates
+
+    def missing_bits(self, ingredient_ids, max_missing=2):
+        """Return a list where item m is the bitset of recipes missing exactly m ingredients"""
+
+        planes = self._counters(set(ingredient_ids))
+        result = []
+        for missing in range(max_missing + 1):
+            bits = 0
+            for size, size_bits in self.size_bits.items():
+                if size >= missing:
+                    bits |= self._count_equals(planes, size - missing, size_bits)
+            result.append(bits)
+        return result
+
+    def match(self, ingredient_ids, max_missing=2, limit=None):
+        """Recipes makeable from `ingredient_ids`, plus near misses.
+
+        Returns a dict with a 'makeable' list and a 'missing' dict keyed by how
+        many ingredients are absent (1..max_missing).
+        """
+
+        have = set(ingredient_ids)
+        groups = self.missing_bits(have, max_missing)
+
+        result = {'makeable': self._recipes(groups[0], have, limit), 'missing': {}}
+        for missing in range(1, max_missing + 1):
+            result['missing'][missing] = self._recipes(groups[missing], have, limit)
+        return result
+
+    def _recipes(self, bits, have, limit):
+        """Expand a bitset of slots into recipe dicts, in name order"""
+
+        recipes = []
+        while bits and (limit is None or len(recipes) < limit):
+            low = bits & -bits
+            slot = low.bit_length() - 1
+            bits ^= low
+
+            recipe = {'id': self.recipe_ids[slot], 'name': self.recipe_names[slot]}
+            absent = [i for i in self.recipe_ingredients[slot] if i not in have]
+            if absent:
+                recipe['missing'] = [{'id': i, 'name': self.ingredient_names.get(i)} for i in absent]
+            recipes.append(recipe)
+        return recipes
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Return the current index, rebuilding it if it is stale"""
+
+    global _index
+
+    index = _index
+    if index is None or time.monotonic() - index.built_at > MAX_INDEX_AGE:
+        with _lock:
+            if _index is None or time.monotonic() - _index.built_at > MAX_INDEX_AGE:
+                _index = RecipeIndex.build()
+            index = _index
+    return index
+
+
+def invalidate():
+    """Drop the index; the next lookup rebuilds it.
+
+    Bulk loaders that bypass the ORM should call this after committing.
+    """
+
+    global _index
+    _index = None
+
+
+def _touches_catalog(session):
+    """Did this flush change recipes, their ingredients or ingredient names?"""
+
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (Recipe, Ingredient, RecipeIngredient)):
+            return True
+
+    for obj in session.dirty:
+        if isinstance(obj, (Recipe, RecipeIngredient)):
+            return True
+        # cabinet appends dirty the Ingredient through its backref, ignore those
+        if isinstance(obj, Ingredient):
+            attrs = inspect(obj).attrs
+            if attrs.name.history.has_changes() or attrs.recipes.history.has_changes():
+                return True
+
+    return False
+
+
+@event.listens_for(db.session, 'after_flush')
+def _mark_catalog_changed(session, flush_context):
+    if _touches_catalog(session):
+        session.info['recipe_index_dirty'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_on_commit(session):
+    if session.info.pop('recipe_index_dirty', False):
+        invalidate()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('recipe_index_dirty', None)
@@ -0,0 +1,131 @@
+"""Recipe similarity and "buy next" suggestions, computed in batch.
+
+    python -m blueprints.cabinet.recommend
+
+The sparse matrix arithmetic is in catalog.py. Results are written to
+recipe_similarities and cabinet_suggestions and read from there by the
+views. A cabinet's suggestions are refreshed by a job queued with the
+change; the command above rebuilds everything and is what to run after the
+catalog changes.
+"""
+
+import time
+
+import jobs
+from models import db, Cabinet, CabinetIngredient, CabinetSuggestion, RecipeSimilarity
+from . import matcher
+
+# similar recipes kept per recipe, suggestions kept per cabinet
+SIMILAR_PER_RECIPE = 10
+SUGGESTIONS_PER_CABINET = 10
+
+# rows per INSERT, and cabinets per pass of refresh_all
+BATCH = 5000
+
+
+_catalog = None
+
+
+def get_catalog():
+    """Catalog for the matcher's current index, rebuilt when the index is"""
+
+    global _catalog
+    from .catalog import Catalog
+
+    index = matcher.get_index()
+    catalog = _catalog
+    if catalog is None or catalog[0] is not index:
+        catalog = _catalog = (index, Catalog.from_index(index))
+    return catalog[1]
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(table.insert(), rows[start:start + BATCH])
+
+
+def refresh_similarities(catalog=None):
+    """Recompute recipe_similarities for the whole catalog; the caller commits"""
+
+    catalog = catalog or get_catalog()
+
+    RecipeSimilarity.query.delete(synchronize_session=False)
+    for recipe_ids, similar_ids, scores in catalog.similar(SIMILAR_PER_RECIPE):
+        _insert(RecipeSimilarity.__table__, [
+            {'recipe_id': int(a), 'similar_recipe_id': int(b), 'score': float(s)}
+            for a, b, s in zip(recipe_ids, similar_ids, scores)])
+
+
+def refresh_cabinets(cabinet_ids, catalog=None):
+    """Recompute cabinet_suggestions for these cabinets; the caller commits"""
+
+    cabinet_ids = sorted(set(cabinet_ids))
+    if not cabinet_ids:
+        return
+    catalog = catalog or get_catalog()
+
+    pairs = (db.session.query(CabinetIngredient.cabinet_id, CabinetIngredient.ingredient_id)
+        .filter(CabinetIngredient.cabinet_id.in_(cabinet_ids)))
+    cabinets = catalog.cabinet_matrix(cabinet_ids, pairs)
+
+    CabinetSuggestion.query.filter(CabinetSuggestion.cabinet_id.in_(cabinet_ids)).delete(synchronize_session=False)
+    for slots, ingredient_ids, unlocks in catalog.buy_next(cabinets, SUGGESTIONS_PER_CABINET):
+        _insert(CabinetSuggestion.__table__, [
+            {'cabinet_id': cabinet_ids[slot], 'ingredient_id': int(i), 'unlocks': int(n)}
+            for slot, i, n in zip(slots, ingredient_ids, unlocks)])
+
+
+def refresh_all(log=print):
+    """Recompute everything, committing after the similarities and each batch of cabinets"""
+
+    start = time.perf_counter()
+    catalog = get_catalog()
+    refresh_similarities(catalog)
+    db.session.commit()
+    log(f'similarities {len(catalog.recipe_ids)} recipes {time.perf_counter() - start:8.1f}s')
+
+    start = time.perf_counter()
+    count, last = 0, 0
+    while True:
+        cabinet_ids = [id for id, in db.session.query(Cabinet.id)
+            .filter(Cabinet.id > last).order_by(Cabinet.id).limit(BATCH)]
+        if not cabinet_ids:
+            break
+        refresh_cabinets(cabinet_ids, catalog)
+        db.session.commit()
+        count, last = count + len(cabinet_ids), cabinet_ids[-1]
+    log(f'suggestions  {count} cabinets {time.perf_counter() - start:8.1f}s')
+
+
+def queue_refresh(cabinet_id):
+    jobs.enqueue('recommend.refresh_cabinets', cabinet_id=cabinet_id)
+
+
+def queue_refresh_all():
+    jobs.enqueue('recommend.refresh_all')
+
+
+@jobs.task('recommend.refresh_cabinets', batch=True)
+def refresh_cabinets_job(payloads):
+    refresh_cabinets(payload['cabinet_id'] for payload in payloads)
+
+
+@jobs.task('recommend.refresh_all')
+def refresh_all_job():
+    # queued after a mirror sync, whose invalidate() only reached the syncing
+    # process; this worker's index may predate the sync by MAX_INDEX_AGE
+    matcher.invalidate()
+    refresh_all(log=lambda message: None)
+
+
+def main():
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        refresh_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,47 @@
-from flask import Blueprint, render_template, g, flash, redirect, session
+from flask import Blueprint, render_template, g, flash, redirect, session, jsonify, request
+from sqlalchemy.orm import selectinload
+from models import db, Recipe, RecipeSimilarity
 
-cdb = Blueprint("cdb", __name__, template_folder="templates")
\ No newline at end of file
+cdb = Blueprint("cdb", __name__, template_folder="templates")
+
+# Recipes here come from the local mirror (see mirror.py), never from a
+# live call to TheCocktailDB.
+
+@cdb.route('/recipes')
+def search_recipes():
+    """Recipes whose name starts with ?q="""
+
+    q = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    prefix = q.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_')
+
+    recipes = (Recipe.query
+        .filter(Recipe.name.ilike(prefix + '%', escape='\\'))
+        .options(selectinload(Recipe.ingredients))
+        .order_by(Recipe.name)
+        .limit(limit)
+        .all())
+
+    return jsonify(recipes=[recipe.serialize() for recipe in recipes])
+
+@cdb.route('/recipes/<int:recipe_id>')
+def show_recipe(recipe_id):
+    """A single recipe with its ingredients"""
+
+    recipe = Recipe.query.options(selectinload(Recipe.ingredients)).get_or_404(recipe_id)
+
+    return jsonify(recipe=recipe.serialize())
+
+@cdb.route('/recipes/<int:recipe_id>/similar')
+def similar_recipes(recipe_id):
+    """Recipes sharing the most ingredients with this one, by Jaccard similarity
+
+    Precomputed in batch by blueprints/cabinet/recommend.py.
+    """
+
+    similar = (db.session.query(Recipe.id, Recipe.name, RecipeSimilarity.score)
+        .join(RecipeSimilarity, RecipeSimilarity.similar_recipe_id == Recipe.id)
+        .filter(RecipeSimilarity.recipe_id == recipe_id)
+        .order_by(RecipeSimilarity.score.desc(), Recipe.name))
+
+    return jsonify(similar=[{'id': id, 'name': name, 'score': round(score, 3)} for id, name, score in similar])
@@ -0,0 +1,170 @@
+"""HTTP client for TheCocktailDB.
+
+Connections are kept alive in a small per-host pool, responses are cached
+in-process for a TTL, and once an entry expires it is revalidated with
+If-None-Match / If-Modified-Since so an unchanged catalog page costs a 304
+instead of a full download.
+"""
+
+import gzip
+import http.client
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_BASE_URL = 'https://www.thecocktaildb.com/api/json/v1/1/'
+
+
+class CocktailDBError(Exception):
+    """The remote API returned an error or could not be reached"""
+
+
+class ConnectionPool:
+    """LIFO pool of keep-alive connections to one host"""
+
+    def __init__(self, scheme, host, port=None, size=4, timeout=10):
+        self.factory = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)
+
+    def _connect(self):
+        return self.factory(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, headers):
+        """Send a request, retrying once on a fresh connection if a pooled one went stale"""
+
+        for attempt in range(2):
+            try:
+                conn = self._idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self._connect()
+                reused = False
+
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                try:
+                    self._idle.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return resp, body
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ResponseCache:
+    """LRU of url -> (fetched_at, etag, last_modified, data)"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def set(self, url, etag, last_modified, data):
+        with self._lock:
+            self._entries[url] = (time.monotonic(), etag, last_modified, data)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, url):
+        """Mark an entry fresh again after a 304"""
+
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries[url] = (time.monotonic(),) + entry[1:]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CocktailDBClient:
+    """JSON client for the TheCocktailDB v1 API"""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, ttl=3600, pool_size=4, timeout=10):
+        parts = urlsplit(base_url)
+        self.base_path = parts.path if parts.path.endswith('/') else parts.path + '/'
+        self.pool = ConnectionPool(parts.scheme, parts.hostname, parts.port, pool_size, timeout)
+        self.cache = ResponseCache()
+        self.ttl = ttl
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get('CDB_BASE_URL', DEFAULT_BASE_URL),
+            ttl=config.get('CDB_CACHE_TTL', 3600),
+        )
+
+    def get(self, endpoint, **params):
+        """GET `endpoint` (e.g. 'search.php') and return (data, changed).
+
+        `changed` is False when the data came from cache or a 304.
+        """
+
+        url = self.base_path + endpoint
+        if params:
+            url += '?' + urlencode(params)
+
+        cached = self.cache.get(url)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[3], False
+
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        if cached is not None:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+
+        try:
+            resp, body = self.pool.request('GET', url, headers)
+        except (http.client.HTTPException, OSError) as exc:
+            raise CocktailDBError(f'GET {url} failed: {exc}') from exc
+
+        if resp.status == 304 and cached is not None:
+            self.cache.touch(url)
+            return cached[3], False
+
+        if resp.status != 200:
+            raise CocktailDBError(f'GET {url} returned {resp.status}')
+
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        # the API answers some empty searches with an empty body
+        data = json.loads(body) if body.strip() else {}
+
+        self.cache.set(url, resp.getheader('ETag'), resp.getheader('Last-Modified'), data)
+        return data, True
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,160 @@
+"""Mirror TheCocktailDB catalog into the local recipe tables.
+
+    python -m blueprints.cdb.mirror
+
+Drinks are fetched by first letter and written into `recipes`,
+`ingredients` and `recipe_ingredient` with set-based statements. A refresh
+is incremental: pages that answer 304 are skipped, and drinks whose
+dateModified matches the stored cdb_modified are left alone, so re-running a
+sync against an unchanged catalog writes nothing.
+"""
+
+import string
+
+from flask import current_app
+
+from models import db, Recipe, Ingredient, RecipeIngredient
+from blueprints.cabinet import matcher, recommend
+from blueprints.search import index as search_index
+from .client import CocktailDBClient
+
+LETTERS = string.ascii_lowercase + string.digits
+MAX_DRINK_INGREDIENTS = 15
+
+_client = None
+
+
+def get_client():
+    """Process-wide client, so the pool and response cache survive between syncs"""
+
+    global _client
+    if _client is None:
+        _client = CocktailDBClient.from_config(current_app.config)
+    return _client
+
+
+def normalize(name):
+    return ' '.join(name.split()).lower()
+
+
+def drink_ingredients(drink):
+    """Ingredient names of a drink, in order and without repeats"""
+
+    names = []
+    seen = set()
+    for i in range(1, MAX_DRINK_INGREDIENTS + 1):
+        name = (drink.get(f'strIngredient{i}') or '').strip()
+        if name and normalize(name) not in seen:
+            seen.add(normalize(name))
+            names.append(name[:50])
+    return names
+
+
+class Mirror:
+    """One sync run; keeps id maps so each drink costs no lookups"""
+
+    def __init__(self, client):
+        self.client = client
+        self.stats = {'pages': 0, 'unchanged_pages': 0, 'created': 0, 'updated': 0, 'ingredients': 0}
+
+        self.ingredient_ids = {normalize(name): id for id, name in db.session.query(Ingredient.id, Ingredient.name)}
+        self.recipes = {cdb_id: (id, modified) for id, cdb_id, modified in
+            db.session.query(Recipe.id, Recipe.cdb_id, Recipe.cdb_modified).filter(Recipe.cdb_id.isnot(None))}
+
+    def ingredient_id(self, name):
+        key = normalize(name)
+        if key not in self.ingredient_ids:
+            ingredient = Ingredient(name=name)
+            db.session.add(ingredient)
+            db.session.flush()
+            self.ingredient_ids[key] = ingredient.id
+            self.stats['ingredients'] += 1
+        return self.ingredient_ids[key]
+
+    def sync_ingredient_list(self):
+        data, changed = self.client.get('list.php', i='list')
+        if changed:
+            for item in data.get('drinks') or []:
+                if item.get('strIngredient1'):
+                    self.ingredient_id(item['strIngredient1'].strip()[:50])
+
+    def sync_drinks(self, drinks):
+        """Create or update recipes for a page of drinks"""
+
+        changed = {}
+        for drink in drinks:
+            cdb_id = drink['idDrink']
+            modified = drink.get('dateModified')
+            existing = self.recipes.get(cdb_id)
+            if existing and existing[1] == modified:
+                continue
+
+            values = {
+                'name': drink['strDrink'][:50],
+                'instructions': drink.get('strInstructions'),
+                'thumbnail': drink.get('strDrinkThumb'),
+                'cdb_modified': modified,
+            }
+            if existing:
+                Recipe.query.filter(Recipe.id == existing[0]).update(values, synchronize_session=False)
+                recipe_id = existing[0]
+                self.stats['updated'] += 1
+            else:
+                recipe = Recipe(cdb_id=cdb_id, **values)
+                db.session.add(recipe)
+                db.session.flush()
+                recipe_id = recipe.id
+                self.stats['created'] += 1
+
+            self.recipes[cdb_id] = (recipe_id, modified)
+            changed[recipe_id] = [self.ingredient_id(name) for name in drink_ingredients(drink)]
+
+        if changed:
+            RecipeIngredient.query.filter(RecipeIngredient.recipe_id.in_(list(changed))).delete(synchronize_session=False)
+            db.session.execute(RecipeIngredient.__table__.insert(), [
+                {'recipe_id': recipe_id, 'ingredient_id': ingredient_id}
+                for recipe_id, ingredient_ids in changed.items()
+                for ingredient_id in ingredient_ids
+            ])
+
+    def run(self, letters=LETTERS):
+        self.sync_ingredient_list()
+        db.session.commit()
+
+        for letter in letters:
+            data, changed = self.client.get('search.php', f=letter)
+            self.stats['pages'] += 1
+            if not changed:
+                self.stats['unchanged_pages'] += 1
+                continue
+            self.sync_drinks(data.get('drinks') or [])
+            db.session.commit()
+
+        return self.stats
+
+
+def sync(client=None, letters=LETTERS):
+    """Import new and changed drinks; returns counts of what was done"""
+
+    stats = Mirror(client or get_client()).run(letters)
+    if stats['created'] or stats['updated'] or stats['ingredients']:
+        # the bulk writes above bypass the ORM events the matcher listens for
+        matcher.invalidate()
+        search_index.invalidate()
+        recommend.queue_refresh_all()
+        db.session.commit()
+    return stats
+
+
+def main():
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        stats = sync()
+        print(', '.join(f'{key}: {value}' for key, value in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
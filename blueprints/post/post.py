@@ -1,11 +1,33 @@
-from flask import Blueprint, render_template, g, flash, redirect, session
+from flask import Blueprint, render_template, g, flash, redirect, session, jsonify
+from sqlalchemy.orm import joinedload
 from models import Cabinet, CabinetIngredient, Ingredient, db, User, Post, Comment
+from pagination import paginate, page_args
+from querycount import query_budget
 
 post = Blueprint("post", __name__, template_folder="templates")
 
 @post.route('/<int:post_id>')
+@query_budget(6)
 def show_post(post_id):
 
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(joinedload(Post.user)).get_or_404(post_id)
+    cursor, limit = page_args()
+    page = post_comments(post_id, cursor, limit)
 
-    return render_template('post/post.html', post=post)
\ No newline at end of file
+    return render_template('post/post.html', post=post, comments=page.items, next_cursor=page.next_cursor)
+
+@post.route('/<int:post_id>/comments')
+def get_comments(post_id):
+    """JSON page of a post's comments, for infinite scroll"""
+
+    Post.query.get_or_404(post_id)
+    cursor, limit = page_args()
+    page = post_comments(post_id, cursor, limit)
+
+    return jsonify(comments=[comment.serialize() for comment in page.items], next_cursor=page.next_cursor)
+
+def post_comments(post_id, cursor, limit):
+    """A page of a post's comments, oldest first like a thread"""
+
+    query = Comment.query.filter(Comment.post_id == post_id).options(joinedload(Comment.user))
+    return paginate(query, Comment.timestamp, Comment.id, cursor, limit, descending=False)
\ No newline at end of file
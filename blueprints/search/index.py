@@ -0,0 +1,251 @@
+"""In-process full-text index, for SQLite and test deployments.
+
+Postgres deployments search the search_vector columns instead. Here posts,
+comments and recipes (name plus ingredient names) are tokenized into an
+inverted index of term -> {document key: weighted term count}. A search
+intersects the posting lists of its terms, rarest first, and ranks what is
+left by tf-idf. Like the ingredient index the index is loaded once per process
+and patched as rows are committed. Recipes are only marked stale on commit
+and re-read on the next search, since their text spans three tables.
+"""
+
+import heapq
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, inspect
+
+from models import db, Post, Comment, Recipe, RecipeIngredient, Ingredient
+from blueprints.cabinet.ingredient_index import normalize
+
+# rebuild at least this often so other workers' writes show up
+MAX_INDEX_AGE = 600
+
+# documents are keyed id << 2 | kind
+KINDS = {'post': 0, 'comment': 1, 'recipe': 2}
+KIND_NAMES = {kind: name for name, kind in KINDS.items()}
+
+RECIPE_NAME_WEIGHT = 2
+
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from has have in into is it its of on or that the this to was with'.split())
+
+
+def doc_key(kind, id):
+    return id << 2 | KINDS[kind]
+
+
+def split_key(key):
+    return KIND_NAMES[key & 3], key >> 2
+
+
+def stem(word):
+    """Crude English plural stripping, so 'cocktails' finds 'cocktail'"""
+
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def terms(text):
+    return [stem(word) for word in normalize(text or '').split() if word not in STOP_WORDS]
+
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        # key -> (length, terms), so a document can be taken out of its postings
+        self.documents = {}
+        self.recipes_by_ingredient = defaultdict(set)
+        self.stale_recipes = set()
+        self.lock = threading.RLock()
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        for id, content in db.session.query(Post.id, Post.content).yield_per(10000):
+            index.add(doc_key('post', id), [(content, 1)])
+        for id, content in db.session.query(Comment.id, Comment.content).yield_per(10000):
+            index.add(doc_key('comment', id), [(content, 1)])
+        index.load_recipes(None)
+        return index
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, key, texts):
+        """Index a document from [(text, weight)], replacing any earlier version"""
+
+        counts = Counter()
+        for text, weight in texts:
+            for term in terms(text):
+                counts[term] += weight
+
+        with self.lock:
+            self.remove(key)
+            for term, count in counts.items():
+                self.postings[term][key] = count
+            self.documents[key] = (sum(counts.values()) or 1, tuple(counts))
+
+    def remove(self, key):
+        with self.lock:
+            document = self.documents.pop(key, None)
+            if document is None:
+                return
+            for term in document[1]:
+                docs = self.postings[term]
+                docs.pop(key, None)
+                if not docs:
+                    del self.postings[term]
+
+    def load_recipes(self, recipe_ids):
+        """(Re)index recipes by id, or all of them for None, with their ingredient names"""
+
+        recipes = db.session.query(Recipe.id, Recipe.name)
+        links = (db.session.query(RecipeIngredient.recipe_id, Ingredient.id, Ingredient.name)
+            .join(Ingredient, Ingredient.id == RecipeIngredient.ingredient_id))
+        if recipe_ids is not None:
+            recipes = recipes.filter(Recipe.id.in_(recipe_ids))
+            links = links.filter(RecipeIngredient.recipe_id.in_(recipe_ids))
+
+        ingredients = defaultdict(list)
+        for recipe_id, ingredient_id, name in links:
+            ingredients[recipe_id].append((ingredient_id, name))
+
+        with self.lock:
+            found = set()
+            for recipe_id, name in recipes:
+                found.add(recipe_id)
+                self.add(doc_key('recipe', recipe_id), [(name, RECIPE_NAME_WEIGHT)] +
+                    [(ingredient_name, 1) for _, ingredient_name in ingredients[recipe_id]])
+                for ingredient_id, _ in ingredients[recipe_id]:
+                    self.recipes_by_ingredient[ingredient_id].add(recipe_id)
+            for recipe_id in set(recipe_ids or ()) - found:
+                self.remove(doc_key('recipe', recipe_id))
+
+    def search(self, query, kinds=KINDS, offset=0, limit=20):
+        """[(kind, id, score)] best first, for documents of `kinds` containing every term"""
+
+        wanted = {KINDS[kind] for kind in kinds}
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+
+        with self.lock:
+            if self.stale_recipes:
+                stale, self.stale_recipes = self.stale_recipes, set()
+                self.load_recipes(stale)
+
+            postings = sorted((self.postings.get(term, {}) for term in query_terms), key=len)
+            if not postings[0]:
+                return []
+
+            total = len(self.documents)
+            weights = [(docs, math.log(1 + total / len(docs))) for docs in postings]
+            scored = []
+            for key in postings[0]:
+                if key & 3 not in wanted or not all(key in docs for docs in postings[1:]):
+                    continue
+                score = sum(docs[key] * idf for docs, idf in weights) / math.sqrt(self.documents[key][0])
+                scored.append((score, -key, key))
+
+            best = heapq.nlargest(offset + limit, scored)[offset:]
+            return [split_key(key) + (score,) for score, _, key in best]
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Return the current index, loading it if needed"""
+
+    global _index
+
+    index = _index
+    if index is None or time.monotonic() - index.built_at > MAX_INDEX_AGE:
+        with _lock:
+            if _index is None or time.monotonic() - _index.built_at > MAX_INDEX_AGE:
+                _index = SearchIndex.build()
+            index = _index
+    return index
+
+
+def invalidate():
+    """Drop the index; the next search reloads it.
+
+    Bulk loaders that bypass the ORM should call this after committing.
+    """
+
+    global _index
+    _index = None
+
+
+def _key(obj):
+    return doc_key('post' if isinstance(obj, Post) else 'comment', obj.id)
+
+
+def _changes(session):
+    """(op, key, texts) for the documents this flush wrote; op 'recipe' marks a recipe stale"""
+
+    changes = []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, (Post, Comment)):
+            if obj in session.new or inspect(obj).attrs.content.history.has_changes():
+                changes.append(('add', _key(obj), [(obj.content, 1)]))
+        elif isinstance(obj, Recipe):
+            if obj in session.new or session.is_modified(obj):
+                changes.append(('recipe', obj.id, None))
+        elif isinstance(obj, Ingredient):
+            if obj not in session.new and inspect(obj).attrs.name.history.has_changes():
+                changes.append(('ingredient', obj.id, None))
+        elif isinstance(obj, RecipeIngredient):
+            changes.append(('recipe', obj.recipe_id, None))
+
+    for obj in session.deleted:
+        if isinstance(obj, (Post, Comment)):
+            changes.append(('remove', _key(obj), None))
+        elif isinstance(obj, Recipe):
+            changes.append(('recipe', obj.id, None))
+        elif isinstance(obj, Ingredient):
+            changes.append(('ingredient', obj.id, None))
+        elif isinstance(obj, RecipeIngredient):
+            changes.append(('recipe', obj.recipe_id, None))
+
+    return changes
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = _changes(session)
+    if changes:
+        session.info.setdefault('search_index_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('search_index_changes', None)
+    index = _index
+    if not changes or index is None:
+        return
+
+    with index.lock:
+        for op, key, texts in changes:
+            if op == 'add':
+                index.add(key, texts)
+            elif op == 'remove':
+                index.remove(key)
+            elif op == 'recipe':
+                index.stale_recipes.add(key)
+            else:
+                index.stale_recipes.update(index.recipes_by_ingredient.get(key, ()))
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('search_index_changes', None)
@@ -0,0 +1,93 @@
+from collections import defaultdict
+
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy.orm import joinedload, selectinload
+from models import db, Post, Comment, Recipe
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from . import index as search_index
+
+search = Blueprint("search", __name__)
+
+# Postgres matches against the trigger-maintained search_vector columns and
+# their GIN indexes; other databases use the in-process index in index.py.
+# SEARCH_BACKEND ('postgres' or 'memory') overrides the choice.
+
+MODELS = {'post': Post, 'comment': Comment, 'recipe': Recipe}
+
+# deepest result reachable by paging
+MAX_RESULTS = 1000
+
+def backend():
+    name = current_app.config.get('SEARCH_BACKEND')
+    if name is None:
+        name = 'postgres' if db.engine.dialect.name == 'postgresql' else 'memory'
+    return name
+
+def postgres_hits(q, kinds, offset, limit):
+    """[(kind, id, rank)] from one UNION ALL over the kinds' GIN indexed vectors"""
+
+    query = db.func.websearch_to_tsquery('english', q)
+    selects = [
+        db.select([
+            db.literal(kind).label('kind'),
+            MODELS[kind].id.label('id'),
+            db.func.ts_rank_cd(MODELS[kind].search_vector, query).label('rank'),
+        ]).where(MODELS[kind].search_vector.op('@@')(query))
+        for kind in kinds
+    ]
+    hits = (db.union_all(*selects) if len(selects) > 1 else selects[0]).alias('hits')
+
+    rows = db.session.execute(db.select([hits.c.kind, hits.c.id, hits.c.rank])
+        .order_by(hits.c.rank.desc(), hits.c.kind, hits.c.id.desc())
+        .offset(offset)
+        .limit(limit))
+    return [(kind, id, rank) for kind, id, rank in rows]
+
+def memory_hits(q, kinds, offset, limit):
+    return search_index.get_index().search(q, kinds, offset, limit)
+
+LOADERS = {
+    'post': lambda ids: Post.query.options(joinedload(Post.user)).filter(Post.id.in_(ids)),
+    'comment': lambda ids: Comment.query.options(joinedload(Comment.user)).filter(Comment.id.in_(ids)),
+    'recipe': lambda ids: Recipe.query.options(selectinload(Recipe.ingredients)).filter(Recipe.id.in_(ids)),
+}
+
+def serialize_hits(hits):
+    """Load the rows behind the hits, one query per kind, and serialize them in rank order"""
+
+    ids = defaultdict(list)
+    for kind, id, score in hits:
+        ids[kind].append(id)
+
+    rows = {(kind, row.id): row for kind in ids for row in LOADERS[kind](ids[kind])}
+
+    return [dict(rows[kind, id].serialize(), type=kind, score=round(score, 4))
+        for kind, id, score in hits if (kind, id) in rows]
+
+@search.route('/')
+def search_all():
+    """Posts, comments and recipes matching ?q=, best match first
+
+    ?type= narrows the search to a comma separated list of post, comment and
+    recipe. ?page= and ?limit= page through the first MAX_RESULTS results.
+    """
+
+    q = request.args.get('q', '').strip()
+    kinds = [kind for kind in request.args.get('type', ','.join(MODELS)).split(',') if kind]
+    if not kinds or any(kind not in MODELS for kind in kinds):
+        return jsonify(error=f"type must be a comma separated list of {', '.join(MODELS)}."), 400
+
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * limit
+    if offset >= MAX_RESULTS:
+        return jsonify(error=f"Only the first {MAX_RESULTS} results can be paged through."), 400
+    if not q:
+        return jsonify(results=[], next_page=None)
+
+    find = postgres_hits if backend() == 'postgres' else memory_hits
+    # fetch one extra hit to learn whether there is a next page
+    hits = find(q, kinds, offset, min(limit, MAX_RESULTS - offset) + 1)
+    more = len(hits) > limit and offset + limit < MAX_RESULTS
+
+    return jsonify(results=serialize_hits(hits[:limit]), next_page=page + 1 if more else None)
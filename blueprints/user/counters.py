@@ -0,0 +1,136 @@
+"""Repair drift in the denormalized user counters.
+
+    python -m blueprints.user.counters            recount every user now
+    python -m blueprints.user.counters --queue    queue a recount for the workers
+
+users.followers_count, following_count, posts_count and comments_count are
+kept in step by Follows.follow/unfollow and User.change_counts, in the same
+transaction as the rows they count. Writes that go around them (bulk loads
+like seed.py, cascading deletes, manual fixes) leave the counters off, so
+the reconcile job recounts users in batches and corrects the ones that
+drifted. It runs one batch per job and queues the next, so a full pass never
+holds a worker or row locks for long.
+"""
+
+import argparse
+import logging
+
+from sqlalchemy import bindparam
+
+import jobs
+from models import db, User, Follows, Post, Comment
+
+log = logging.getLogger(__name__)
+
+BATCH = 1000
+
+# what each counter counts, by the column holding the user id
+SOURCES = {
+    'followers': Follows.user_being_followed_id,
+    'following': Follows.user_following_id,
+    'posts': Post.user_id,
+    'comments': Comment.user_id,
+}
+
+
+def actual_counts(user_ids):
+    """{user_id: {counter: count}} from the rows themselves, one grouped COUNT per counter"""
+
+    counts = {user_id: dict.fromkeys(User.COUNTERS, 0) for user_id in user_ids}
+    for name, column in SOURCES.items():
+        for user_id, count in (db.session.query(column, db.func.count())
+                .filter(column.in_(user_ids))
+                .group_by(column)):
+            counts[user_id][name] = count
+    return counts
+
+
+def reconcile(user_ids):
+    """Correct the counters of these users; returns {user_id: {counter: (stored, actual)}} for those that were off
+
+    The user rows are locked before counting, in id order like follows lock
+    them, so a follow or post committing meanwhile either is counted here or
+    bumps the corrected value after.
+    """
+
+    columns = [getattr(User, f'{name}_count') for name in User.COUNTERS]
+    stored = {row[0]: dict(zip(User.COUNTERS, row[1:])) for row in
+        db.session.query(User.id, *columns).filter(User.id.in_(user_ids)).order_by(User.id).with_for_update()}
+    actual = actual_counts(list(stored))
+
+    drift = {}
+    for user_id, counts in stored.items():
+        off = {name: (counts[name], actual[user_id][name])
+            for name in User.COUNTERS if counts[name] != actual[user_id][name]}
+        if off:
+            drift[user_id] = off
+
+    if drift:
+        table = User.__table__
+        db.session.execute(
+            table.update()
+                .where(table.c.id == bindparam('user_id'))
+                .values({f'{name}_count': bindparam(name) for name in User.COUNTERS}),
+            [dict(actual[user_id], user_id=user_id) for user_id in drift])
+        db.session.info.setdefault('identity_changed', set()).update(drift)
+
+    return drift
+
+
+def next_batch(after_id, batch=BATCH):
+    return [id for id, in db.session.query(User.id).filter(User.id > after_id).order_by(User.id).limit(batch)]
+
+
+def reconcile_all(batch=BATCH, log=print):
+    """Recount every user, committing per batch; returns how many were off"""
+
+    repaired, after_id = 0, 0
+    while True:
+        user_ids = next_batch(after_id, batch)
+        if not user_ids:
+            break
+        repaired += len(reconcile(user_ids))
+        db.session.commit()
+        after_id = user_ids[-1]
+    log(f'{repaired} users had drifted counters')
+    return repaired
+
+
+def queue_reconcile(batch=BATCH):
+    jobs.enqueue('counters.reconcile', after_id=0, batch=batch)
+
+
+@jobs.task('counters.reconcile')
+def reconcile_job(after_id, batch=BATCH):
+    """Reconcile the next batch of users after `after_id` and queue the one after"""
+
+    user_ids = next_batch(after_id, batch)
+    if not user_ids:
+        return
+
+    drift = reconcile(user_ids)
+    if drift:
+        log.warning('repaired counters of %d users: %s', len(drift), drift)
+    jobs.enqueue('counters.reconcile', after_id=user_ids[-1], batch=batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--queue', action='store_true', help='queue a recount for the workers instead')
+    parser.add_argument('--batch', type=int, default=BATCH, help='users per batch')
+    args = parser.parse_args()
+
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        if args.queue:
+            queue_reconcile(args.batch)
+            db.session.commit()
+        else:
+            reconcile_all(args.batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Streaming account data export.
+
+GET /user/export answers newline-delimited JSON: the account first, then
+every post, comment, favorite recipe and cabinet ingredient of the user,
+one object per line with a "type". Rows are read BATCH at a time with
+yield_per, which on Postgres runs each query on a server side cursor, as
+plain columns rather than model instances, and written to the client in
+CHUNK_BYTES pieces as they are read, so an export takes the same memory
+whatever the size of the account. Clients accepting gzip get it compressed
+on the fly.
+"""
+
+import json
+import zlib
+
+from models import db, User, Post, Comment, Favorites, Recipe, Cabinet, CabinetIngredient, Ingredient
+
+# rows fetched from the cursor at a time
+BATCH = 1000
+# bytes of output gathered before they are sent
+CHUNK_BYTES = 64 * 1024
+
+
+def records(user_id):
+    """Every record of the user's data as a dict, account first"""
+
+    id, username, email = (db.session.query(User.id, User.username, User.email)
+        .filter(User.id == user_id)
+        .one())
+    yield {'type': 'user', 'id': id, 'username': username, 'email': email}
+
+    posts = (db.session.query(Post.id, Post.content, Post.timestamp)
+        .filter(Post.user_id == user_id)
+        .order_by(Post.timestamp, Post.id))
+    for id, content, timestamp in posts.yield_per(BATCH):
+        yield {'type': 'post', 'id': id, 'content': content, 'timestamp': timestamp.isoformat()}
+
+    comments = (db.session.query(Comment.id, Comment.post_id, Comment.content, Comment.timestamp)
+        .filter(Comment.user_id == user_id)
+        .order_by(Comment.timestamp, Comment.id))
+    for id, post_id, content, timestamp in comments.yield_per(BATCH):
+        yield {'type': 'comment', 'id': id, 'post_id': post_id, 'content': content,
+            'timestamp': timestamp.isoformat()}
+
+    favorites = (db.session.query(Recipe.id, Recipe.name)
+        .join(Favorites, Favorites.recipe_id == Recipe.id)
+        .filter(Favorites.user_id == user_id)
+        .order_by(Recipe.id))
+    for id, name in favorites.yield_per(BATCH):
+        yield {'type': 'favorite', 'recipe_id': id, 'name': name}
+
+    ingredients = (db.session.query(Ingredient.id, Ingredient.name)
+        .join(CabinetIngredient, CabinetIngredient.ingredient_id == Ingredient.id)
+        .join(Cabinet, Cabinet.id == CabinetIngredient.cabinet_id)
+        .filter(Cabinet.user_id == user_id)
+        .order_by(Ingredient.id))
+    for id, name in ingredients.yield_per(BATCH):
+        yield {'type': 'cabinet_ingredient', 'ingredient_id': id, 'name': name}
+
+
+def ndjson(records):
+    """Records as UTF-8 JSON lines, in chunks of about CHUNK_BYTES"""
+
+    chunk = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+def gzipped(chunks):
+    """The chunks compressed into one gzip stream"""
+
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,96 @@
+"""The follow graph as a sparse matrix, for blueprints/user/suggestions.py.
+
+The follow graph is loaded once into a sparse adjacency matrix A in CSR
+form (row = follower, column = followed), a few int arrays no matter how
+many edges there are. Row u of A @ A counts, for every account w, how many
+of the accounts u follows also follow w: the mutual follows that make w a
+suggestion. Accounts u already follows, and u itself, are dropped and the
+best k per user are kept.
+
+Rows are multiplied in blocks sized by how many two-step paths they have,
+so users who follow many busy accounts don't blow up a block.
+
+Only the suggestions job imports this, so web workers don't load numpy
+and scipy.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Follows
+
+# two-step paths multiplied per block of rows
+MAX_PATHS = 20 * 1000 * 1000
+
+# rows fetched per round trip when loading the graph
+BATCH = 100000
+
+
+class FollowGraph:
+    """Follows as a CSR adjacency matrix over dense user indexes"""
+
+    def __init__(self, edges):
+        """`edges` is an (n, 2) array of (follower id, followed id)"""
+
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.user_ids, indexes = np.unique(edges, return_inverse=True)
+        indexes = indexes.reshape(-1, 2)
+
+        n = len(self.user_ids)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(edges), dtype=np.int32), (indexes[:, 0], indexes[:, 1])), shape=(n, n))
+
+    @classmethod
+    def load(cls):
+        """Read every follow in chunks straight into arrays"""
+
+        result = db.session.execute(db.select([Follows.user_following_id, Follows.user_being_followed_id]))
+        chunks = []
+        while True:
+            rows = result.fetchmany(BATCH)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64))
+        return cls(np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64))
+
+    def blocks(self):
+        """Row ranges whose two-step paths add up to about MAX_PATHS each"""
+
+        out_degree = np.diff(self.matrix.indptr)
+        paths = np.cumsum(self.matrix @ out_degree)
+        start = 0
+        while start < len(paths):
+            done = paths[start - 1] if start else 0
+            stop = max(int(np.searchsorted(paths, done + MAX_PATHS, side='right')), start + 1)
+            yield start, stop
+            start = stop
+
+    def suggest(self, k):
+        """Yield a block at a time: (first user id, last user id, user_id, suggested_user_id, mutuals)
+
+        The arrays hold k suggestions per user in the block, most mutuals
+        first, then the longest standing account.
+        """
+
+        for start, stop in self.blocks():
+            follows = self.matrix[start:stop]
+            mutuals = follows @ self.matrix
+            # drop accounts already followed
+            mutuals = (mutuals - mutuals.multiply(follows)).tocsr()
+            mutuals.eliminate_zeros()
+
+            rows = np.repeat(np.arange(start, stop), np.diff(mutuals.indptr))
+            columns = mutuals.indices.astype(np.int64)
+            counts = mutuals.data
+
+            # and the users themselves
+            keep = rows != columns
+            rows, columns, counts = rows[keep], columns[keep], counts[keep]
+
+            order = np.lexsort((columns, -counts, rows))
+            rows = rows[order]
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            top = order[rank < k]
+
+            yield (self.user_ids[start], self.user_ids[stop - 1],
+                self.user_ids[rows[top]], self.user_ids[columns[top]], counts[top])
@@ -0,0 +1,66 @@
+"""Follow suggestions from friends of friends, computed in batch.
+
+    python -m blueprints.user.suggestions
+
+The arithmetic is in follow_graph.py: friends of friends are counted with
+sparse matrix products, accounts already followed are dropped and the best
+SUGGESTIONS_PER_USER per user are written to follow_suggestions. Reads
+filter out accounts followed since the last run, which is all the freshness
+the suggestions need between rebuilds.
+"""
+
+import time
+
+import jobs
+from models import db, Follows, FollowSuggestion
+
+SUGGESTIONS_PER_USER = 20
+
+# rows per INSERT
+BATCH = 100000
+
+
+def refresh_all(log=print):
+    """Rebuild follow_suggestions from the whole graph, committing per block"""
+
+    from .follow_graph import FollowGraph
+
+    start = time.perf_counter()
+    graph = FollowGraph.load()
+    log(f'graph        {len(graph.user_ids)} users {graph.matrix.nnz} follows {time.perf_counter() - start:8.1f}s')
+
+    start = time.perf_counter()
+    table = FollowSuggestion.__table__
+    # users who lost every candidate since the last run keep nothing
+    db.session.execute(table.delete().where(table.c.user_id.notin_(db.select([Follows.user_following_id]))))
+    db.session.commit()
+    for first, last, user_ids, suggested_ids, mutuals in graph.suggest(SUGGESTIONS_PER_USER):
+        db.session.execute(table.delete().where(table.c.user_id.between(int(first), int(last))))
+        rows = [{'user_id': int(u), 'suggested_user_id': int(s), 'mutuals': int(m)}
+            for u, s, m in zip(user_ids, suggested_ids, mutuals)]
+        for i in range(0, len(rows), BATCH):
+            db.session.execute(table.insert(), rows[i:i + BATCH])
+        db.session.commit()
+    log(f'suggestions  {time.perf_counter() - start:8.1f}s')
+
+
+def queue_refresh_all():
+    jobs.enqueue('suggestions.refresh_all')
+
+
+@jobs.task('suggestions.refresh_all', max_attempts=3)
+def refresh_all_job():
+    refresh_all(log=lambda message: None)
+
+
+def main():
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        refresh_all()
+
+
+if __name__ == '__main__':
+    main()
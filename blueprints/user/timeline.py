@@ -0,0 +1,126 @@
+"""Materialized home timelines.
+
+Each user's feed lives in the `timelines` table. A new post goes into its
+author's timeline right away and is fanned out to followers by a background
+job. Following someone copies their recent posts in the same way and
+unfollowing takes them out again, so reading a feed is one range read on
+(user_id, timestamp) however many accounts a user follows. The jobs skip
+rows that are already there, so a retried job is harmless.
+
+A new account's timeline starts out complete, since it follows no one and
+has no posts. Accounts from before timelines existed were built by
+migration 11, so reading never has to build a feed.
+"""
+
+from sqlalchemy import and_, exists, literal, select
+from sqlalchemy.orm import joinedload
+
+import jobs
+from models import db, Follows, Post, TimelineEntry
+from pagination import paginate, DEFAULT_PAGE_SIZE
+
+# how many of a user's posts are copied into a new follower's timeline
+BACKFILL_LIMIT = 200
+
+
+def fan_out_post(post):
+    """Add a flushed `post` to its author's timeline now and queue it for followers'"""
+
+    db.session.execute(TimelineEntry.__table__.insert().values(
+        user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+
+    jobs.enqueue('timeline.fan_out', post_id=post.id)
+
+
+@jobs.task('timeline.fan_out', batch=True)
+def fan_out_to_followers(payloads):
+    """Copy new posts into their authors' followers' timelines"""
+
+    table = TimelineEntry.__table__
+    posts = Post.query.filter(Post.id.in_([payload['post_id'] for payload in payloads])).all()
+
+    for post in posts:
+        present = exists().where(and_(
+            table.c.user_id == Follows.user_following_id,
+            table.c.post_id == post.id,
+        ))
+        followers = select([
+            Follows.user_following_id,
+            literal(post.id),
+            literal(post.timestamp),
+        ]).where(and_(Follows.user_being_followed_id == post.user_id, ~present))
+
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], followers))
+
+
+def _insert_posts(user_id, posts, bind=None):
+    """Copy rows of the `posts` subquery into `user_id`'s timeline, skipping ones already there"""
+
+    table = TimelineEntry.__table__
+    present = exists().where(and_(
+        table.c.user_id == user_id,
+        table.c.post_id == posts.c.id,
+    ))
+
+    rows = select([literal(user_id), posts.c.id, posts.c.timestamp]).where(~present)
+    (bind or db.session).execute(table.insert().from_select(['user_id', 'post_id', 'timestamp'], rows))
+
+
+def queue_backfill(follower_id, followed_id):
+    jobs.enqueue('timeline.backfill_follow', follower_id=follower_id, followed_id=followed_id)
+
+
+@jobs.task('timeline.backfill_follow')
+def backfill_follow(follower_id, followed_id, limit=BACKFILL_LIMIT):
+    """Copy the followed user's recent posts into the follower's timeline"""
+
+    recent = (select([Post.id, Post.timestamp])
+        .where(Post.user_id == followed_id)
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+        .limit(limit)
+        .alias('recent'))
+
+    _insert_posts(follower_id, recent)
+
+
+def queue_unfollow(follower_id, followed_id):
+    jobs.enqueue('timeline.remove_follow', follower_id=follower_id, followed_id=followed_id)
+
+
+@jobs.task('timeline.remove_follow')
+def remove_follow(follower_id, followed_id):
+    """Take an unfollowed user's posts out of the former follower's timeline"""
+
+    # followed again before this ran; the backfill job owns those rows now
+    if Follows.exists(follower_id, followed_id):
+        return
+
+    posts = select([Post.id]).where(Post.user_id == followed_id)
+    (TimelineEntry.query
+        .filter(TimelineEntry.user_id == follower_id, TimelineEntry.post_id.in_(posts))
+        .delete(synchronize_session=False))
+
+
+def rebuild(user_id, limit=BACKFILL_LIMIT, bind=None):
+    """Fill in a timeline from posts and follows, on the session or a connection passed as `bind`"""
+
+    followed = select([Follows.user_being_followed_id]).where(Follows.user_following_id == user_id)
+    recent = (select([Post.id, Post.timestamp])
+        .where((Post.user_id == user_id) | Post.user_id.in_(followed))
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+        .limit(limit)
+        .alias('recent'))
+
+    _insert_posts(user_id, recent, bind)
+
+
+def read(user_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """A page of a user's timeline, newest first"""
+
+    query = (Post.query
+        .join(TimelineEntry, TimelineEntry.post_id == Post.id)
+        .filter(TimelineEntry.user_id == user_id)
+        .options(joinedload(Post.user)))
+
+    return paginate(query, TimelineEntry.timestamp, TimelineEntry.post_id, cursor, limit)
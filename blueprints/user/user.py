@@ -1,6 +1,13 @@
-from flask import Blueprint, render_template, g, flash, redirect, session, jsonify
-from models import User, Follows, db, Cabinet, Post, Comment
+from flask import Blueprint, Response, render_template, g, flash, redirect, session, jsonify, request, stream_with_context
+from sqlalchemy.orm import joinedload, selectinload
+from models import User, Follows, FollowSuggestion, db, Cabinet, Post, Comment
+from pagination import paginate, page_args
+from querycount import query_budget
+import fragment_cache
+from replicas import use_primary
+from ratelimit import limit
 from .forms import PostForm, CommentForm
+from . import timeline, suggestions, export
 from ..post.post import post
 
 user = Blueprint("user", __name__, template_folder="templates", static_folder="static")
@@ -8,21 +15,88 @@ user = Blueprint("user", __name__, template_folder="templates", static_folder="s
 #ALL USEr ROUTES REQUIRE AUTH
 
 @user.route('/')
+@query_budget(12)
 def show_home():
 
     if g.user:
-        following = [user.id for user in g.user.following]
-        bartalk = Post.query.filter((Post.user_id == g.user.id) | (Post.user_id.in_(following))).order_by(Post.timestamp).all()
-        return render_template('user/home.html', bartalk=bartalk)
+        cursor, limit = page_args()
+        page = timeline.read(g.user.id, cursor, limit)
+        return render_template('user/home.html', bartalk=page.items, next_cursor=page.next_cursor)
     else:
         flash('Please Login', 'secondary')
         return redirect('/')
 
+@user.route('/feed')
+def get_feed():
+    """JSON page of the home feed, for infinite scroll"""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    cursor, limit = page_args()
+    page = timeline.read(g.user.id, cursor, limit)
+
+    return jsonify(posts=[post.serialize() for post in page.items], next_cursor=page.next_cursor)
+
+@user.route('/suggestions')
+@query_budget(2)
+def get_follow_suggestions():
+    """Accounts followed by the accounts you follow, most mutual follows first
+
+    Precomputed in batch; accounts followed since then are left out.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    limit = min(max(request.args.get('limit', 10, type=int), 1), suggestions.SUGGESTIONS_PER_USER)
+    followed = db.exists().where(db.and_(
+        Follows.user_following_id == g.user.id,
+        Follows.user_being_followed_id == FollowSuggestion.suggested_user_id,
+    ))
+
+    rows = (db.session.query(User.id, User.username, FollowSuggestion.mutuals)
+        .join(FollowSuggestion, FollowSuggestion.suggested_user_id == User.id)
+        .filter(FollowSuggestion.user_id == g.user.id, ~followed)
+        .order_by(FollowSuggestion.mutuals.desc(), User.id)
+        .limit(limit))
+
+    return jsonify(suggestions=[{'id': id, 'username': username, 'mutuals': mutuals} for id, username, mutuals in rows])
+
+@user.route('/export')
+@limit('export')
+def export_account():
+    """Download all your data as NDJSON, streamed as it is read; see export.py"""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    chunks = export.ndjson(export.records(g.user.id))
+    headers = {
+        'Content-Disposition': f'attachment; filename="bartender-{g.user.username}.ndjson"',
+        'Vary': 'Accept-Encoding',
+    }
+    if request.accept_encodings['gzip']:
+        chunks = export.gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
+
+def user_posts(user, cursor, limit):
+    """A page of `user`'s posts, newest first"""
+
+    query = Post.query.filter(Post.user_id == user.id).options(joinedload(Post.user))
+    return paginate(query, Post.timestamp, Post.id, cursor, limit)
+
 # /<username> - renders profile of other users
 @user.route('/<username>')
+@query_budget(8)
 def show_profile(username):
 
-    user = User.query.filter(User.username == username).first()
+    user = (User.query
+        .filter(User.username == username)
+        .options(selectinload(User.cabinet))
+        .first())
     
     if user == g.user:
         # cabinet = Cabinet.query.filter(Cabinet.user_id == g.user.id).one_or_none()
@@ -30,14 +104,28 @@ def show_profile(username):
 
     elif user:
         # cabinet = Cabinet.query.filter(Cabinet.user_id == user.id).one_or_none()
-        return render_template('user/profile.html', user = user)
+        cursor, limit = page_args()
+        page = user_posts(user, cursor, limit)
+        return render_template('user/profile.html', user = user, posts = page.items, next_cursor = page.next_cursor)
 
     else:
         flash('Could not find that User.', 'warning')
         return redirect('/user')
+
+@user.route('/<username>/posts')
+def get_user_posts(username):
+    """JSON page of a user's posts, for infinite scroll"""
+
+    user = User.query.filter(User.username == username).first_or_404()
+    cursor, limit = page_args()
+    page = user_posts(user, cursor, limit)
+
+    return jsonify(posts=[post.serialize() for post in page.items], next_cursor=page.next_cursor)
 # /cabinet - directs to cabinet blue print
 
 @user.route('/follow/<int:id>', methods= ['GET','POST'])
+@use_primary
+@limit('write')
 def follow_user(id):
     """Add a follow for the currently-logged-in user."""
 
@@ -46,12 +134,32 @@ def follow_user(id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(id)
-    g.user.following.append(followed_user)
+    if Follows.follow(g.user.id, followed_user.id):
+        timeline.queue_backfill(g.user.id, followed_user.id)
+    db.session.commit()
+    fragment_cache.invalidate(f'user:{g.user.id}', f'user:{followed_user.id}')
+
+    return redirect(f'/user/{followed_user.username}')
+
+@user.route('/unfollow/<int:id>', methods=['POST'])
+@limit('write')
+def unfollow_user(id):
+    """Remove a follow for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    followed_user = User.query.get_or_404(id)
+    if Follows.unfollow(g.user.id, followed_user.id):
+        timeline.queue_unfollow(g.user.id, followed_user.id)
     db.session.commit()
+    fragment_cache.invalidate(f'user:{g.user.id}', f'user:{followed_user.id}')
 
     return redirect(f'/user/{followed_user.username}')
 
 @user.route('/create', methods=['GET','POST'])
+@limit('write', methods=('POST',))
 def create_post():
     if not g.user:
         flash("Please Log In", "danger")
@@ -64,7 +172,11 @@ def create_post():
         post = Post(content=form.content.data, user_id=g.user.id)
 
         db.session.add(post)
+        db.session.flush()
+        User.change_counts(g.user.id, posts=1)
+        timeline.fan_out_post(post)
         db.session.commit()
+        fragment_cache.invalidate(f'user:{g.user.id}')
 
         return redirect('/user')
 
@@ -72,6 +184,7 @@ def create_post():
         return render_template('user/post.html', form=form)
 
 @user.route('/comment/<int:post_id>', methods=['GET','POST'])
+@limit('write', methods=('POST',))
 def add_comment(post_id):
     if not g.user:
         flash("Please Log In", "danger")
@@ -85,7 +198,9 @@ def add_comment(post_id):
         comment = Comment(content=form.content.data, user_id=g.user.id, post_id=post_id)
 
         db.session.add(comment)
+        User.change_counts(g.user.id, comments=1)
         db.session.commit()
+        fragment_cache.invalidate(f'post:{post_id}')
 
         return redirect(f'/post/{post_id}')
 
@@ -0,0 +1,137 @@
+"""Configuration profiles for create_app().
+
+    FLASK_CONFIG=production gunicorn wsgi:app
+    FLASK_CONFIG=sqlite flask run
+
+The profile is the one passed to create_app(), else the one FLASK_CONFIG
+names, else development when FLASK_ENV is development and production
+otherwise. Deployment settings come from the environment, read when this
+module is first imported.
+"""
+
+import os
+import tempfile
+
+
+def _replica_binds():
+    # comma separated read replica URLs
+    urls = filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))
+    return {f'replica_{i}': url for i, url in enumerate(urls)}
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgres:///bartender')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # GET pages in DB_REPLICA_BLUEPRINTS read from the replicas
+    SQLALCHEMY_BINDS = _replica_binds()
+    DB_REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+    DB_REPLICA_BLUEPRINTS = ('user', 'post', 'cabinet', 'search')
+    # how long a user reads from the primary after writing, to cover replication lag
+    DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+
+    # bcrypt cost; set BCRYPT_TARGET_MS to tune it to this machine at startup instead
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_TARGET_MS = int(os.environ.get('BCRYPT_TARGET_MS', 0))
+    BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 2))
+    BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', 16))
+
+    # run background jobs inline instead of queueing them for `python jobs.py`
+    JOBS_EAGER = os.environ.get('JOBS_EAGER') == '1'
+    CDB_BASE_URL = os.environ.get('CDB_BASE_URL', 'https://www.thecocktaildb.com/api/json/v1/1/')
+
+    # 'filesystem' (shared by the workers on a host), 'memory' (per process, so only
+    # for a single worker; invalidations don't reach the others) or 'null'
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'filesystem')
+    # must be private to the app's user; the default is created mode 0700 and checked
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), f'bartender-fragments-{os.getuid()}'))
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+    FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+    # per endpoint class, (requests per minute, burst) for each user, or IP when logged out
+    RATE_LIMITS = {'auth': (10, 5), 'write': (60, 20), 'export': (1, 3)}
+    # per endpoint class, requests running at once in a worker before the rest get a 503
+    CONCURRENCY_LIMITS = {'auth': BCRYPT_WORKERS + BCRYPT_MAX_PENDING, 'write': 32}
+    # 'memory' (per worker), 'filesystem' (shared by the workers on a host, needs RATE_LIMIT_DIR) or 'null'
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_DIR = os.environ.get('RATE_LIMIT_DIR')
+
+    # /metrics is readable with `Authorization: Bearer <METRICS_TOKEN>` or from these
+    # comma separated networks (e.g. 10.0.0.0/8), and by nobody if neither is set
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_ALLOWED_NETWORKS = [network for network in
+        os.environ.get('METRICS_ALLOWED_NETWORKS', '').split(',') if network]
+
+    # the debug toolbar is far too heavy to load outside development
+    DEBUG_TOOLBAR = False
+
+
+class ProductionConfig(Config):
+    pass
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    # the development server is a single process
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'memory')
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class SQLiteConfig(Config):
+    """Everything in one process on a local file, no database server or job worker"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///bartender.db')
+    JOBS_EAGER = os.environ.get('JOBS_EAGER', '1') == '1'
+
+
+class TestingConfig(Config):
+    TESTING = True
+    # in memory, so private to the process; a server database gets the
+    # pytest-xdist worker's name appended, bartender_test_gw0 and so on
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    if 'PYTEST_XDIST_WORKER' in os.environ and not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_DATABASE_URI += '_' + os.environ['PYTEST_XDIST_WORKER']
+    SQLALCHEMY_BINDS = {}
+    DB_REPLICA_BINDS = []
+
+    # Don't have WTForms use CSRF at all, since it's a pain to test
+    WTF_CSRF_ENABLED = False
+    # Fail any view that goes over its declared query budget
+    QUERY_BUDGET_STRICT = True
+    # Run background jobs inline; JobQueueTestCase turns this off to test the queue itself
+    JOBS_EAGER = True
+    # the cheapest cost, or hashing sample users' passwords dominates the run time
+    BCRYPT_LOG_ROUNDS = 4
+    BCRYPT_TARGET_MS = 0
+    FRAGMENT_CACHE_BACKEND = 'memory'
+    METRICS_TOKEN = 'test-metrics-token'
+    # tests sign up and post far faster than anyone should; RateLimitTestCase turns it on
+    RATE_LIMIT_BACKEND = 'null'
+
+
+PROFILES = {
+    'production': ProductionConfig,
+    'development': DevelopmentConfig,
+    'sqlite': SQLiteConfig,
+    'testing': TestingConfig,
+}
+
+
+def get_config(config=None):
+    """The config object for a profile name, or `config` itself if it already is one"""
+
+    if config is None:
+        config = os.environ.get('FLASK_CONFIG') or (
+            'development' if os.environ.get('FLASK_ENV') == 'development' else 'production')
+    if isinstance(config, str):
+        try:
+            return PROFILES[config]
+        except KeyError:
+            raise ValueError(f'Unknown config profile {config!r}, expected one of {", ".join(PROFILES)}')
+    return config
@@ -0,0 +1,266 @@
+"""Rendered template fragment cache.
+
+Templates wrap the expensive parts of a page in a call block:
+
+    {% call fragment_cache('comments', post.id, cursor, scope='post:%d' % post.id) %}
+        ...
+    {% endcall %}
+
+The block body is rendered once and the HTML served from the cache until it
+expires or its scope is invalidated. Every scope ('post:5', 'user:7') has a
+generation token that is folded into the key of each fragment in it, so
+invalidate('post:5') retires all of that post's fragments at once without
+having to find them. Keys may also carry a version that changes with the
+data, like a cabinet's version, which then needs no invalidation at all.
+
+Every fragment whose content can change takes a scope, since a fragment
+without one is only ever retired by its TTL.
+
+Deployments default to the filesystem backend, which shares fragments, and
+invalidations, between the workers on one host. The in-process LRU, bounded
+by total size, is for a single process like the development server: with
+several workers an invalidation would only reach the one that handled the
+write, and the others would serve stale HTML until FRAGMENT_CACHE_TTL.
+"""
+
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+import metrics
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_FILES = 50000
+
+
+class MemoryBackend:
+    """LRU of key -> (expires, html), evicting once the html totals max_bytes"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (time.time() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes and self._entries:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def check_private(path):
+    """Raise ValueError unless `path` is a real directory only the current user can use"""
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ValueError(f'Fragment cache directory {path} is not a directory')
+    if info.st_uid != os.getuid():
+        raise ValueError(f'Fragment cache directory {path} is owned by another user')
+    if info.st_mode & 0o077:
+        raise ValueError(f'Fragment cache directory {path} is open to other users; chmod 700 it')
+
+
+class FileSystemBackend:
+    """One file per key in a directory shared by the workers on a host.
+
+    Writes go through a temp file and os.replace, so readers never see a
+    partial fragment. A file's mtime is its expiry time. Once the directory
+    holds more than max_files, the files that expire soonest are removed.
+
+    Fragments are served as markup without escaping, so the directory must
+    be private: it is created mode 0700, and one that another user owns or
+    can get into is refused rather than trusted.
+    """
+
+    def __init__(self, path, max_files=DEFAULT_MAX_FILES):
+        self.path = path
+        self.max_files = max_files
+        self._writes = 0
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        check_private(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        filename = self._file(key)
+        try:
+            if os.path.getmtime(filename) < time.time():
+                return None
+            with open(filename, encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, value, ttl):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(value)
+            expires = time.time() + ttl
+            os.utime(tmp, (expires, expires))
+            os.replace(tmp, self._file(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.prune()
+
+    def prune(self):
+        """Drop expired files, then the soonest to expire while over max_files"""
+
+        now = time.time()
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    expires = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if expires < now:
+                    self._unlink(entry.path)
+                else:
+                    files.append((expires, entry.path))
+
+        files.sort()
+        for expires, path in files[:max(len(files) - self.max_files, 0)]:
+            self._unlink(path)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                self._unlink(entry.path)
+
+
+class NullBackend:
+    """Caches nothing, for tests and debugging templates"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def clear(self):
+        pass
+
+
+class FragmentCache:
+    def __init__(self, backend=None, ttl=DEFAULT_TTL):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+
+    def init_app(self, app):
+        """Pick the backend from config and expose fragment_cache to templates"""
+
+        kind = app.config.get('FRAGMENT_CACHE_BACKEND', 'memory')
+        if kind == 'memory':
+            self.backend = MemoryBackend(app.config.get('FRAGMENT_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        elif kind == 'filesystem':
+            self.backend = FileSystemBackend(app.config['FRAGMENT_CACHE_DIR'],
+                app.config.get('FRAGMENT_CACHE_MAX_FILES', DEFAULT_MAX_FILES))
+        elif kind == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown FRAGMENT_CACHE_BACKEND {kind!r}')
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL)
+
+        app.jinja_env.globals['fragment_cache'] = self.fragment
+
+    def generation(self, scope):
+        """Current token for `scope`, minting one if there is none.
+
+        A missing token (never set, expired or evicted) gets a fresh one
+        instead of a default, so losing it can only cause misses, never bring
+        back fragments from before an invalidation.
+        """
+
+        key = f'gen:{scope}'
+        token = self.backend.get(key)
+        if token is None:
+            token = uuid.uuid4().hex[:12]
+            self.backend.set(key, token, self.ttl * 4)
+        return token
+
+    def key(self, name, parts, scope=None):
+        key = ':'.join([name] + [str(part) for part in parts])
+        if scope is not None:
+            key += '@' + self.generation(scope)
+        return key
+
+    def fragment(self, name, *parts, scope=None, caller):
+        """Template global for {% call fragment_cache(name, *parts, scope=...) %}"""
+
+        key = self.key(name, parts, scope)
+        html = self.backend.get(key)
+        if html is None:
+            metrics.fragment_cache_requests.inc((name, 'miss'))
+            html = str(caller())
+            self.backend.set(key, html, self.ttl)
+        else:
+            metrics.fragment_cache_requests.inc((name, 'hit'))
+        return Markup(html)
+
+    def invalidate(self, *scopes):
+        """Retire every fragment cached under these scopes"""
+
+        for scope in scopes:
+            self.backend.set(f'gen:{scope}', uuid.uuid4().hex[:12], self.ttl * 4)
+
+    def clear(self):
+        self.backend.clear()
+
+
+cache = FragmentCache()
+
+
+def init_app(app):
+    cache.init_app(app)
+
+
+def invalidate(*scopes):
+    cache.invalidate(*scopes)
@@ -0,0 +1,118 @@
+"""Request identity resolution for g.user.
+
+The logged in user's row is cached in-process for a short TTL, so most
+requests attach the user to the session without a SELECT. g.user is a lazy
+proxy: the lookup only happens when a view or template actually touches it.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, session
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.local import LocalProxy
+
+from models import db, User
+
+CURR_USER_KEY = "curr_user"
+
+DEFAULT_TTL = 60
+MAX_ENTRIES = 10000
+
+
+class IdentityCache:
+    """LRU of user id -> column values, with a per-entry TTL"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def set(self, user_id, values, ttl):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = IdentityCache()
+
+
+def load_user(user_id):
+    """Return the User for `user_id` attached to the current session"""
+
+    values = cache.get(user_id)
+    if values is not None:
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = User.query.get(user_id)
+    if user is not None:
+        values = {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+        cache.set(user_id, values, current_app.config.get('IDENTITY_CACHE_TTL', DEFAULT_TTL))
+    return user
+
+
+def current_user():
+    """The logged in User or None, looked up once per request"""
+
+    if '_user' not in g:
+        user_id = session.get(CURR_USER_KEY)
+        g._user = load_user(user_id) if user_id is not None else None
+    return g._user
+
+
+current_user_proxy = LocalProxy(current_user)
+
+
+def invalidate(user_id):
+    """Forget a cached user, e.g. on logout or profile change"""
+
+    cache.invalidate(user_id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('identity_changed', set())
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+    # appending to followers/following dirties a User without changing its row
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj, include_collections=False):
+            changed.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_on_commit(session):
+    for user_id in session.info.pop('identity_changed', ()):
+        invalidate(user_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('identity_changed', None)
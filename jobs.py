@@ -0,0 +1,238 @@
+"""DB-backed background jobs.
+
+    python jobs.py --workers 4
+
+Request handlers enqueue() follow-up work in the same transaction as the rows
+it is about, so a job exists exactly when its request committed, and return
+without waiting for it. Worker processes claim due jobs in batches with
+SELECT ... FOR UPDATE SKIP LOCKED, run them, and delete them in the same
+transaction as the work. A job that raises is retried with exponential
+backoff up to its task's max_attempts, then left as 'failed' with the error
+for inspection. Jobs held by a worker that died are reclaimed after
+LOCK_TIMEOUT, so tasks should be safe to run twice.
+
+With JOBS_EAGER set (tests, or development without a worker) enqueue() runs
+the task inline instead.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from flask import current_app
+
+import querycount
+from models import db, Job
+
+log = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = timedelta(minutes=5)
+BACKOFF_BASE = 2
+BACKOFF_MAX = 3600
+
+Task = namedtuple('Task', 'name fn max_attempts batch')
+
+TASKS = {}
+
+
+def task(name, max_attempts=5, batch=False):
+    """Register a job handler.
+
+    Handlers take the enqueued keyword arguments, or with batch=True a list
+    of payload dicts, so a worker can serve many queued calls in one go.
+    """
+
+    def register(fn):
+        TASKS[name] = Task(name, fn, max_attempts, batch)
+        return fn
+    return register
+
+
+def enqueue(name, **payload):
+    """Queue a call of task `name` in the current transaction; it runs after commit"""
+
+    if name not in TASKS:
+        raise KeyError(f'Unknown task {name!r}')
+
+    if current_app.config.get('JOBS_EAGER'):
+        # a worker would run this, so it isn't charged to the view's query budget
+        with querycount.not_counted():
+            _run(TASKS[name], [payload])
+        return None
+
+    job = Job(task=name, payload=json.dumps(payload))
+    db.session.add(job)
+    return job
+
+
+def _run(task, payloads):
+    if task.batch:
+        task.fn(payloads)
+    else:
+        for payload in payloads:
+            task.fn(**payload)
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE ** attempts, BACKOFF_MAX))
+
+
+def claim(worker_id, limit):
+    """Lock up to `limit` due jobs for this worker"""
+
+    now = datetime.utcnow()
+    due = db.or_(
+        db.and_(Job.status == 'queued', Job.run_at <= now),
+        db.and_(Job.status == 'running', Job.locked_at < now - LOCK_TIMEOUT),
+    )
+
+    jobs = (Job.query
+        .filter(due)
+        .order_by(Job.run_at, Job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all())
+
+    for job in jobs:
+        job.status = 'running'
+        job.locked_at = now
+        job.locked_by = worker_id
+        job.attempts += 1
+    db.session.commit()
+    return jobs
+
+
+def work_once(worker_id, batch_size=100):
+    """Claim and run one batch of due jobs; returns how many were claimed"""
+
+    jobs = claim(worker_id, batch_size)
+    if not jobs:
+        return 0
+
+    claimed = [(job.id, job.task, job.payload, job.attempts) for job in jobs]
+    for name, group in groupby(sorted(claimed, key=lambda job: job[1]), key=lambda job: job[1]):
+        group = list(group)
+        task = TASKS.get(name)
+        if task is None:
+            _failed(None, group, f'Unknown task {name!r}')
+        elif task.batch:
+            _execute(task, group)
+        else:
+            for job in group:
+                _execute(task, [job])
+
+    return len(claimed)
+
+
+def _execute(task, jobs):
+    ids = [job[0] for job in jobs]
+    try:
+        _run(task, [json.loads(job[2]) for job in jobs])
+        Job.query.filter(Job.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        log.exception('job %s %s failed', task.name, ids)
+        _failed(task, jobs, traceback.format_exc())
+
+
+def _failed(task, jobs, error):
+    """Reschedule failed jobs with backoff, or give up on those out of attempts"""
+
+    now = datetime.utcnow()
+    max_attempts = task.max_attempts if task else 0
+    for id, name, payload, attempts in jobs:
+        values = {'last_error': error[-4000:], 'locked_at': None, 'locked_by': None}
+        if attempts >= max_attempts:
+            values['status'] = 'failed'
+        else:
+            values.update(status='queued', run_at=now + backoff(attempts))
+        Job.query.filter(Job.id == id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def work(app, worker_id, batch_size=100, poll_interval=1.0, should_stop=lambda: False):
+    """Run jobs until should_stop() says otherwise, sleeping while the queue is empty"""
+
+    with app.app_context():
+        while not should_stop():
+            try:
+                claimed = work_once(worker_id, batch_size)
+            except Exception:
+                db.session.rollback()
+                log.exception('worker %s could not claim jobs', worker_id)
+                claimed = 0
+            finally:
+                db.session.remove()
+
+            if not claimed:
+                time.sleep(poll_interval)
+
+
+def _worker_process(batch_size, poll_interval):
+    # tasks register themselves on the importable `jobs` module, not on __main__,
+    # as create_app imports the blueprints
+    from app import create_app
+    import jobs
+
+    app = create_app()
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    with app.app_context():
+        # never share the parent's pooled connections after a fork
+        db.engine.dispose()
+
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    log.info('worker %s started', worker_id)
+    jobs.work(app, worker_id, batch_size, poll_interval, should_stop=lambda: bool(stopping))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=2, help='worker processes')
+    parser.add_argument('--batch', type=int, default=100, help='jobs claimed per round trip')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds to sleep when the queue is empty')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    def start(index):
+        process = multiprocessing.Process(
+            target=_worker_process, args=(args.batch, args.poll), name=f'worker-{index}')
+        process.start()
+        return process
+
+    processes = [start(i) for i in range(args.workers)]
+
+    # restart workers that die until asked to stop, then let them finish their batch
+    while not stopping:
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                log.warning('worker-%s exited with %s, restarting', i, process.exitcode)
+                processes[i] = start(i)
+        time.sleep(1)
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
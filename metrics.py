@@ -0,0 +1,225 @@
+"""Request and SQL instrumentation, exposed on /metrics.
+
+Each request records its latency in a per-endpoint histogram along with the
+number of SQL statements it ran and the time spent in the database, timed
+with SQLAlchemy engine events. /metrics renders everything in the Prometheus
+text format. Metrics live in process memory, so each worker reports its own
+series; scrape the workers individually or sum them in the query.
+
+/metrics answers only scrapers that send `Authorization: Bearer
+<METRICS_TOKEN>` or connect from one of METRICS_ALLOWED_NETWORKS, and is a
+404 to everyone else. With neither configured nobody can read it. Behind a
+reverse proxy every request comes from the proxy's address, so don't list
+that network; use the token.
+"""
+
+import bisect
+import hmac
+import ipaddress
+import threading
+import time
+
+from flask import Response, abort, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from querycount import statement_count
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # one count per bucket plus +Inf, then the running sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+
+        for label_values, series in sorted(items):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{{{labels},{le}}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._series.items())
+        for label_values, value in items:
+            lines.append(f'{self.name}{{{_labels(self.labels, label_values)}}} {value}')
+        return lines
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_latency = Histogram(
+    'bartender_request_duration_seconds', 'Request latency by endpoint.',
+    ('endpoint', 'method'), LATENCY_BUCKETS)
+requests_total = Counter(
+    'bartender_requests_total', 'Requests by endpoint and status code.',
+    ('endpoint', 'method', 'status'))
+request_statements = Histogram(
+    'bartender_request_sql_statements', 'SQL statements run per request.',
+    ('endpoint',), STATEMENT_BUCKETS)
+sql_statements_total = Counter(
+    'bartender_sql_statements_total', 'SQL statements run, by endpoint.',
+    ('endpoint',))
+sql_seconds_total = Counter(
+    'bartender_sql_seconds_total', 'Time spent executing SQL, by endpoint.',
+    ('endpoint',))
+fragment_cache_requests = Counter(
+    'bartender_fragment_cache_requests_total', 'Template fragment cache lookups, by fragment and hit/miss.',
+    ('fragment', 'result'))
+requests_shed = Counter(
+    'bartender_requests_shed_total', 'Requests refused by rate limits (429) or concurrency limits (503), by endpoint class.',
+    ('endpoint_class', 'reason'))
+
+REGISTRY = (request_latency, requests_total, request_statements, sql_statements_total, sql_seconds_total,
+    fragment_cache_requests, requests_shed)
+
+
+# the start time lives on the statement's execution context, which is thrown
+# away with it, so a statement that fails leaves nothing behind to pop
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    _add_sql_time(context)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(exception_context):
+    _add_sql_time(exception_context.execution_context)
+
+
+def _add_sql_time(context):
+    start = getattr(context, '_metrics_start', None)
+    if start is not None and has_app_context():
+        g._sql_time = g.get('_sql_time', 0.0) + time.perf_counter() - start
+
+
+# request methods reported as themselves; anything else a client makes up is 'other'
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+
+def method_label():
+    return request.method if request.method in METHODS else 'other'
+
+
+def _start_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_statements = statement_count()
+    g._sql_time = 0.0
+
+
+def _record_request(response):
+    start = g.pop('_metrics_start', None)
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or 'unmatched'
+    statements = statement_count() - g.pop('_metrics_statements', 0)
+
+    method = method_label()
+    request_latency.observe((endpoint, method), time.perf_counter() - start)
+    requests_total.inc((endpoint, method, str(response.status_code)))
+    request_statements.observe((endpoint,), statements)
+    sql_statements_total.inc((endpoint,), statements)
+    sql_seconds_total.inc((endpoint,), g.pop('_sql_time', 0.0))
+
+    return response
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed():
+    """Does the request carry METRICS_TOKEN or come from METRICS_ALLOWED_NETWORKS?"""
+
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+    if token:
+        sent = request.headers.get('Authorization', '')
+        if hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+            return True
+
+    networks = config.get('METRICS_ALLOWED_NETWORKS', ())
+    if networks and request.remote_addr:
+        try:
+            address = ipaddress.ip_address(request.remote_addr)
+        except ValueError:
+            return False
+        return any(address in ipaddress.ip_network(network) for network in networks)
+    return False
+
+
+def show_metrics():
+    """Prometheus scrape endpoint"""
+
+    if not scrape_allowed():
+        abort(404)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Time every request and add the /metrics route"""
+
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
@@ -0,0 +1,336 @@
+"""Versioned schema migrations.
+
+    python migrate.py            apply pending migrations
+    python migrate.py --status   list applied and pending migrations
+    python migrate.py --check    compare live indexes with the ones the models declare
+
+Migrations are functions registered in order with @migration and recorded in
+schema_migrations once applied. Each one only creates what is missing, so
+they are also safe to run against databases that were set up with
+db.create_all() before migrations existed.
+
+Index migrations are marked non-transactional: on Postgres they build with
+CREATE INDEX CONCURRENTLY, which can't run inside a transaction but doesn't
+block writes to the table while it builds.
+"""
+
+import argparse
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from models import (db, Recipe, Cabinet, Job, RecipeSimilarity, CabinetSuggestion, User, Follows, FollowSuggestion,
+    Post, Comment, SEARCH_DDL, SEARCH_INDEXES)
+
+# arbitrary key for pg_advisory_lock, so concurrent deploys migrate one at a time
+LOCK_ID = 4242001
+
+# rows per UPDATE when filling in columns on big tables
+SEARCH_FILL_BATCH = 50000
+
+Migration = namedtuple('Migration', 'version name fn transactional')
+
+MIGRATIONS = []
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, transactional=True):
+    def register(fn):
+        assert all(m.version < version for m in MIGRATIONS), 'migrations must be registered in order'
+        MIGRATIONS.append(Migration(version, fn.__name__, fn, transactional))
+        return fn
+    return register
+
+
+def add_column(conn, table, name):
+    """ALTER TABLE ... ADD COLUMN from the model's definition, unless it exists; True if added"""
+
+    if name in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+        return False
+
+    column = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {_quote(conn, table.name)} ADD COLUMN {column}'))
+    return True
+
+
+def create_index(conn, name, table, columns, unique=False, concurrently=True, using=None):
+    """CREATE INDEX IF NOT EXISTS, concurrently on Postgres unless told otherwise.
+
+    A concurrent build that failed leaves an INVALID index behind under the
+    same name; it is dropped and rebuilt rather than taken as done.
+    """
+
+    concurrently = concurrently and conn.dialect.name == 'postgresql'
+    if concurrently and name in invalid_indexes(conn):
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {_quote(conn, name)}'))
+
+    conn.execute(text('CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} ON {table} {using}({columns})'.format(
+        unique='UNIQUE ' if unique else '',
+        concurrently='CONCURRENTLY ' if concurrently else '',
+        name=_quote(conn, name),
+        table=_quote(conn, table),
+        using=f'USING {using} ' if using else '',
+        columns=', '.join(_quote(conn, column) for column in columns),
+    )))
+
+
+def invalid_indexes(conn):
+    """Names of Postgres indexes left unusable by a failed concurrent build"""
+
+    if conn.dialect.name != 'postgresql':
+        return set()
+    return {name for name, in conn.execute(text(
+        'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'))}
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+@migration(1)
+def create_tables(conn):
+    """Tables that don't exist yet, at their current definitions"""
+
+    db.metadata.create_all(conn)
+
+
+@migration(2)
+def add_recipe_mirror_and_cabinet_version_columns(conn):
+    """Columns added to existing tables by the CocktailDB mirror and cabinet sync"""
+
+    for name in ('instructions', 'thumbnail', 'cdb_modified'):
+        add_column(conn, Recipe.__table__, name)
+    if add_column(conn, Recipe.__table__, 'cdb_id'):
+        # ADD COLUMN can't carry a UNIQUE constraint on SQLite; an index does the same job
+        create_index(conn, 'uq_recipes_cdb_id', 'recipes', ['cdb_id'], unique=True, concurrently=False)
+
+    add_column(conn, Cabinet.__table__, 'version')
+
+
+@migration(3, transactional=False)
+def add_hot_path_indexes(conn):
+    """Indexes for profile/post pagination, follow lookups and cabinet and ingredient lookups"""
+
+    create_index(conn, 'ix_posts_user_timestamp', 'posts', ['user_id', 'timestamp', 'id'])
+    create_index(conn, 'ix_comments_post_timestamp', 'comments', ['post_id', 'timestamp', 'id'])
+    create_index(conn, 'ix_follows_following', 'follows', ['user_following_id'])
+    create_index(conn, 'ix_cabinets_user_id', 'cabinets', ['user_id'])
+    create_index(conn, 'ix_ingredients_name', 'ingredients', ['name'])
+
+
+@migration(4)
+def create_jobs_table(conn):
+    """Queue for the background workers"""
+
+    Job.__table__.create(conn, checkfirst=True)
+
+
+@migration(5)
+def create_recommendation_tables(conn):
+    """Precomputed similar recipes and buy-next suggestions"""
+
+    RecipeSimilarity.__table__.create(conn, checkfirst=True)
+    CabinetSuggestion.__table__.create(conn, checkfirst=True)
+
+
+@migration(6)
+def add_user_counters(conn):
+    """Denormalized follower, following, post and comment counts, filled in from the rows"""
+
+    added = [add_column(conn, User.__table__, f'{name}_count') for name in User.COUNTERS]
+    if not any(added):
+        return
+
+    users = User.__table__
+
+    def count(column):
+        return db.select([db.func.count()]).where(column == users.c.id).as_scalar()
+
+    conn.execute(users.update().values(
+        followers_count=count(Follows.user_being_followed_id),
+        following_count=count(Follows.user_following_id),
+        posts_count=count(Post.user_id),
+        comments_count=count(Comment.user_id),
+    ))
+
+
+@migration(7)
+def create_follow_suggestions_table(conn):
+    """Precomputed friends-of-friends follow suggestions"""
+
+    FollowSuggestion.__table__.create(conn, checkfirst=True)
+
+
+@migration(8)
+def add_search_vectors(conn):
+    """search_vector columns, and on Postgres the triggers that keep them current"""
+
+    for model in (Post, Comment, Recipe):
+        add_column(conn, model.__table__, 'search_vector')
+
+    if conn.dialect.name == 'postgresql':
+        for statements in SEARCH_DDL.values():
+            for statement in statements:
+                conn.execute(text(statement))
+
+
+@migration(9, transactional=False)
+def fill_search_vectors(conn):
+    """Vectors for rows written before the triggers, in batches, then their GIN indexes"""
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    vectors = {
+        'posts': "to_tsvector('english', content)",
+        'comments': "to_tsvector('english', content)",
+        'recipes': 'recipe_search_vector(id, name)',
+    }
+    for table, vector in vectors.items():
+        last = conn.execute(text(f'SELECT max(id) FROM {table}')).scalar() or 0
+        for start in range(0, last + 1, SEARCH_FILL_BATCH):
+            conn.execute(text(f'UPDATE {table} SET search_vector = {vector} '
+                'WHERE id >= :start AND id < :stop AND search_vector IS NULL'),
+                start=start, stop=start + SEARCH_FILL_BATCH)
+        create_index(conn, SEARCH_INDEXES[table], table, ['search_vector'], using='gin')
+
+
+@migration(10, transactional=False)
+def add_comment_user_index(conn):
+    """Index for reading a user's comments in order, as account exports do"""
+
+    create_index(conn, 'ix_comments_user_timestamp', 'comments', ['user_id', 'timestamp', 'id'])
+
+
+@migration(11, transactional=False)
+def build_timelines(conn):
+    """Timelines of the accounts from before they existed, one account per statement
+
+    Rows already there are skipped, so this also completes timelines that
+    fan-out and follows had partly filled since.
+    """
+
+    from blueprints.user import timeline
+
+    for user_id, in conn.execute(db.select([User.id]).order_by(User.id)).fetchall():
+        timeline.rebuild(user_id, bind=conn)
+
+
+def applied_versions(engine):
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {version for version, in conn.execute(db.select([schema_migrations.c.version]))}
+
+
+def pending(engine):
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def upgrade(engine, log=print):
+    """Apply every pending migration in order; returns the ones applied"""
+
+    done = []
+    with engine.connect() as lock:
+        if engine.dialect.name == 'postgresql':
+            lock.execute(text('SELECT pg_advisory_lock(:id)'), id=LOCK_ID)
+        try:
+            for m in pending(engine):
+                log(f'applying {m.version} {m.name}')
+                _apply(engine, m)
+                done.append(m)
+        finally:
+            if engine.dialect.name == 'postgresql':
+                lock.execute(text('SELECT pg_advisory_unlock(:id)'), id=LOCK_ID)
+    return done
+
+
+def _apply(engine, m):
+    record = schema_migrations.insert().values(version=m.version, name=m.name, applied_at=datetime.utcnow())
+
+    if m.transactional or engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            m.fn(conn)
+            conn.execute(record)
+    else:
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            m.fn(conn)
+            conn.execute(record)
+
+
+def check(engine, metadata=db.metadata):
+    """Indexes the models declare that the live database lacks.
+
+    Returns (name, table, columns) tuples. A declared index counts as present
+    when a valid live index, primary key or unique constraint starts with
+    the same columns.
+    """
+
+    with engine.connect() as conn:
+        inspector = inspect(conn)
+        invalid = invalid_indexes(conn)
+        tables = set(inspector.get_table_names())
+
+        missing = []
+        for table in metadata.sorted_tables:
+            if table.name not in tables:
+                missing.extend((index.name, table.name, _columns(index)) for index in table.indexes)
+                continue
+
+            live = [tuple(index['column_names']) for index in inspector.get_indexes(table.name)
+                if index['name'] not in invalid]
+            live.append(tuple(inspector.get_pk_constraint(table.name)['constrained_columns']))
+            live.extend(tuple(unique['column_names']) for unique in inspector.get_unique_constraints(table.name))
+
+            for index in table.indexes:
+                columns = _columns(index)
+                if not any(have[:len(columns)] == columns for have in live):
+                    missing.append((index.name, table.name, columns))
+    return missing
+
+
+def _columns(index):
+    return tuple(column.name for column in index.columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations')
+    parser.add_argument('--check', action='store_true', help='exit non-zero if declared indexes are missing')
+    args = parser.parse_args()
+
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        engine = db.engine
+
+        if args.status:
+            waiting = {m.version for m in pending(engine)}
+            for m in MIGRATIONS:
+                print(f"{m.version:>4} {m.name:<50} {'pending' if m.version in waiting else 'applied'}")
+        elif args.check:
+            missing = check(engine)
+            for name, table, columns in missing:
+                print(f"MISSING {name} on {table} ({', '.join(columns)})")
+            if missing:
+                sys.exit(1)
+            print('all declared indexes present')
+        else:
+            if not upgrade(engine):
+                print('nothing to apply')
+
+
+if __name__ == '__main__':
+    main()
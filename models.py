@@ -1,17 +1,31 @@
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql
+
+from passwords import PasswordHasher
+from replicas import RoutingSQLAlchemy
+import sqlite_profile
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher(bcrypt)
+db = RoutingSQLAlchemy()
+
+# tsvector on Postgres, kept current by the triggers in SEARCH_DDL; other
+# databases search with the in-process index in blueprints/search/index.py
+SearchVector = db.Text().with_variant(postgresql.TSVECTOR(), 'postgresql')
 
 def connect_db(app):
     """Connect the database to the Flask App
     """
 
-    db.app = app
+    # the first app built is the one used outside an app context
+    if db.app is None:
+        db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+    hasher.init_app(app)
 
 # build database schema
 # class Friends (db.Model):
@@ -51,6 +65,84 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with the followed user; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_following', 'user_following_id'),
+    )
+
+    @classmethod
+    def exists(cls, following_id, followed_id):
+        """Primary key lookup: does `following_id` follow `followed_id`?"""
+
+        query = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=following_id,
+        )
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def follow(cls, following_id, followed_id):
+        """Start following and bump both users' counters; False if already following"""
+
+        table = cls.__table__
+        row = {'user_following_id': following_id, 'user_being_followed_id': followed_id}
+
+        if db.engine.dialect.name == 'postgresql':
+            inserted = db.session.execute(postgresql.insert(table).values(row).on_conflict_do_nothing()).rowcount
+        elif cls.exists(following_id, followed_id):
+            inserted = 0
+        else:
+            inserted = db.session.execute(table.insert().values(row)).rowcount
+
+        if inserted:
+            cls._change_counts(following_id, followed_id, 1)
+        return bool(inserted)
+
+    @classmethod
+    def unfollow(cls, following_id, followed_id):
+        """Stop following and drop both users' counters; False if not following"""
+
+        deleted = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=following_id,
+        ).delete(synchronize_session=False)
+
+        if deleted:
+            cls._change_counts(following_id, followed_id, -1)
+        return bool(deleted)
+
+    @staticmethod
+    def _change_counts(following_id, followed_id, delta):
+        # lowest id first, so A following B while B follows A lock the two
+        # user rows in the same order instead of deadlocking
+        updates = {following_id: {'following': delta}, followed_id: {'followers': delta}}
+        if following_id == followed_id:
+            updates = {following_id: {'following': delta, 'followers': delta}}
+        for user_id in sorted(updates):
+            User.change_counts(user_id, **updates[user_id])
+
+class FollowSuggestion(db.Model):
+    """An account to suggest following, with how many of the user's follows follow it"""
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
 # Users
 class User(db.Model):
     """User Model"""
@@ -81,6 +173,36 @@ class User(db.Model):
         db.Text,
         nullable=False,
     )
+
+    # maintained by change_counts in the same transaction as the rows they
+    # count, and repaired by the counters.reconcile job if they ever drift
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    posts_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    comments_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
     
     # friends = db.relationship(
     #     'User', 
@@ -111,15 +233,52 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
 
+    def follow_state(self, users):
+        """Follow state between this user and each of `users`, in one query.
+
+        `users` may be User objects or ids. Returns a dict of
+        user id -> {'following': bool, 'followed_by': bool}.
+        """
+
+        ids = [user.id if isinstance(user, User) else user for user in users]
+        state = {id: {'following': False, 'followed_by': False} for id in ids}
+        if not ids:
+            return state
+
+        rows = db.session.query(Follows.user_following_id, Follows.user_being_followed_id).filter(
+            ((Follows.user_following_id == self.id) & Follows.user_being_followed_id.in_(ids)) |
+            ((Follows.user_being_followed_id == self.id) & Follows.user_following_id.in_(ids)))
+
+        for following_id, followed_id in rows:
+            if following_id == self.id and followed_id in state:
+                state[followed_id]['following'] = True
+            if followed_id == self.id and following_id in state:
+                state[following_id]['followed_by'] = True
+
+        return state
+
+
+    COUNTERS = ('followers', 'following', 'posts', 'comments')
+
+    @classmethod
+    def change_counts(cls, user_id, **deltas):
+        """Add to a user's counters with one UPDATE, e.g. change_counts(id, posts=1)
+
+        The caller commits. The user's cached identity is dropped after the
+        commit, since this bypasses the ORM changes identity.py watches.
+        """
+
+        columns = {getattr(cls, f'{name}_count'): getattr(cls, f'{name}_count') + delta
+            for name, delta in deltas.items()}
+        cls.query.filter(cls.id == user_id).update(columns, synchronize_session=False)
+        db.session.info.setdefault('identity_changed', set()).add(user_id)
 
     # def accept_friend(self, friend_id):
 
@@ -136,7 +295,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -152,13 +311,18 @@ class User(db.Model):
         """Find user with `username` and `password`.
         If it finds such a user, returns that user object.
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different cost than the current
+        setting it is replaced; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -179,6 +343,15 @@ class Cabinet(db.Model):
         db.Integer,
         db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
+        index=True,
+    )
+
+    # bumped by record_change whenever ingredients are added or removed
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
     )
 
     user = db.relationship('User', backref ='cabinet')
@@ -189,6 +362,47 @@ class Cabinet(db.Model):
         secondary='cabinet_ingredients',
         backref = 'cabinets')
 
+    @classmethod
+    def record_change(cls, cabinet_id, added=(), removed=()):
+        """Bump the cabinet's version and log what changed; returns the new version"""
+
+        if not added and not removed:
+            return None
+
+        # the UPDATE row lock orders concurrent writers to the same cabinet
+        cls.query.filter(cls.id == cabinet_id).update({cls.version: cls.version + 1}, synchronize_session=False)
+        version = db.session.query(cls.version).filter(cls.id == cabinet_id).scalar()
+
+        db.session.execute(CabinetChange.__table__.insert(),
+            [{'cabinet_id': cabinet_id, 'version': version, 'ingredient_id': id, 'added': True} for id in added] +
+            [{'cabinet_id': cabinet_id, 'version': version, 'ingredient_id': id, 'added': False} for id in removed])
+
+        if version % 10 == 0:
+            CabinetChange.query.filter(
+                CabinetChange.cabinet_id == cabinet_id,
+                CabinetChange.version <= version - CabinetChange.KEEP_VERSIONS,
+            ).delete(synchronize_session=False)
+
+        return version
+
+    def changes_since(self, since):
+        """Net ({added ids}, {removed ids}) after version `since`, or None if the log doesn't reach back that far"""
+
+        if since < self.version - CabinetChange.KEEP_VERSIONS:
+            return None
+
+        added, removed = set(), set()
+        for ingredient_id, was_added in (db.session.query(CabinetChange.ingredient_id, CabinetChange.added)
+                .filter(CabinetChange.cabinet_id == self.id, CabinetChange.version > since)
+                .order_by(CabinetChange.version)):
+            if was_added:
+                added.add(ingredient_id)
+                removed.discard(ingredient_id)
+            else:
+                removed.add(ingredient_id)
+                added.discard(ingredient_id)
+        return added, removed
+
 class CabinetIngredient(db.Model):
     """Many to Many table for Ingredients and Cabinets"""
 
@@ -208,6 +422,100 @@ class CabinetIngredient(db.Model):
         primary_key=True
     )
 
+    @classmethod
+    def add_many(cls, cabinet_id, ingredient_ids):
+        """Stock a cabinet, skipping unknown ids and ingredients already there.
+
+        Returns the ids actually added. On Postgres this is a single INSERT ...
+        SELECT ... ON CONFLICT DO NOTHING RETURNING. SQLite runs the same
+        INSERT OR IGNORE ... SELECT, and the added ids are the ones stocked
+        after it that weren't before.
+        """
+
+        if not ingredient_ids:
+            return []
+
+        table = cls.__table__
+        ingredient_ids = set(ingredient_ids)
+        rows = db.select([db.literal(cabinet_id), Ingredient.id]).where(Ingredient.id.in_(ingredient_ids))
+
+        if db.engine.dialect.name == 'postgresql':
+            stmt = (postgresql.insert(table)
+                .from_select(['cabinet_id', 'ingredient_id'], rows)
+                .on_conflict_do_nothing()
+                .returning(table.c.ingredient_id))
+            return [id for id, in db.session.execute(stmt)]
+
+        stocked = db.select([table.c.ingredient_id]).where(
+            db.and_(table.c.cabinet_id == cabinet_id, table.c.ingredient_id.in_(ingredient_ids)))
+        before = {id for id, in db.session.execute(stocked)}
+
+        if db.engine.dialect.name == 'sqlite':
+            stmt = table.insert().prefix_with('OR IGNORE').from_select(['cabinet_id', 'ingredient_id'], rows)
+        else:
+            stmt = table.insert().from_select(['cabinet_id', 'ingredient_id'], rows.where(Ingredient.id.notin_(stocked)))
+        if not db.session.execute(stmt).rowcount:
+            return []
+
+        return sorted({id for id, in db.session.execute(stocked)} - before)
+
+    @classmethod
+    def remove_many(cls, cabinet_id, ingredient_ids):
+        """Remove ingredients from a cabinet with one DELETE; returns the ids actually removed"""
+
+        if not ingredient_ids:
+            return []
+
+        table = cls.__table__
+        stocked = db.and_(table.c.cabinet_id == cabinet_id, table.c.ingredient_id.in_(set(ingredient_ids)))
+
+        if db.engine.dialect.name == 'postgresql':
+            return [id for id, in db.session.execute(table.delete().where(stocked).returning(table.c.ingredient_id))]
+
+        removed = [id for id, in db.session.execute(db.select([table.c.ingredient_id]).where(stocked))]
+        if removed:
+            db.session.execute(table.delete().where(stocked))
+        return removed
+
+class CabinetChange(db.Model):
+    """Log of ingredients added to or removed from a cabinet, by cabinet version"""
+
+    __tablename__ = 'cabinet_changes'
+
+    # versions kept per cabinet; clients further behind get a full snapshot
+    KEEP_VERSIONS = 100
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    cabinet_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cabinets.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    ingredient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('ingredients.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    added = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_cabinet_changes_cabinet_version', 'cabinet_id', 'version'),
+    )
+
 # Ingredients 
 class Ingredient(db.Model):
     """Ingredient Model"""
@@ -222,8 +530,32 @@ class Ingredient(db.Model):
     name = db.Column(
         db.String(50),
         nullable=False,
+        index=True,
     )
 
+class IngredientAlias(db.Model):
+    """Other names an ingredient goes by, e.g. 'cointreau' for triple sec"""
+
+    __tablename__ = 'ingredient_aliases'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    ingredient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('ingredients.id', ondelete='CASCADE'),
+        nullable = False,
+    )
+
+    name = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    ingredient = db.relationship('Ingredient', backref='aliases')
+
 
 # Friends : Users >--< Users
 
@@ -270,7 +602,7 @@ class Post(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -279,7 +611,59 @@ class Post(db.Model):
         nullable = False,
     )
 
+    search_vector = db.deferred(db.Column(
+        SearchVector,
+    ))
+
     user = db.relationship('User', backref= 'posts')
+
+    # profile pages and timeline rebuilds page a user's posts by (timestamp, id)
+    __table_args__ = (
+        db.Index('ix_posts_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    def serialize(self):
+        """Serialize post to a dict for JSON responses"""
+
+        return {
+            'id': self.id,
+            'content': self.content,
+            'timestamp': self.timestamp.isoformat(),
+            'user': {'id': self.user.id, 'username': self.user.username},
+        }
+
+
+#Timelines : materialized home feed, one row per post per user who sees it
+
+class TimelineEntry(db.Model):
+    """Timeline Model"""
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key = True,
+    )
+
+    post_id = db.Column(
+        db.Integer,
+        db.ForeignKey('posts.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key = True,
+    )
+
+    # copy of posts.timestamp so the feed is a range read on one index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp', 'user_id', 'timestamp', 'post_id'),
+    )
+
+    post = db.relationship('Post')
     
 
 #comments : Comments --< Post / Comments >--- Users
@@ -301,7 +685,7 @@ class Comment(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     post_id = db.Column(
@@ -316,9 +700,30 @@ class Comment(db.Model):
         nullable = False,
     )
 
+    search_vector = db.deferred(db.Column(
+        SearchVector,
+    ))
+
     user = db.relationship('User', backref= 'comments')
     post = db.relationship('Post', backref= 'comments')
 
+    __table_args__ = (
+        db.Index('ix_comments_post_timestamp', 'post_id', 'timestamp', 'id'),
+        # account exports read a user's comments in order
+        db.Index('ix_comments_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    def serialize(self):
+        """Serialize comment to a dict for JSON responses"""
+
+        return {
+            'id': self.id,
+            'post_id': self.post_id,
+            'content': self.content,
+            'timestamp': self.timestamp.isoformat(),
+            'user': {'id': self.user.id, 'username': self.user.username},
+        }
+
 #recipes 
 
 class Recipe(db.Model):
@@ -336,12 +741,46 @@ class Recipe(db.Model):
         nullable=False,
     )
 
+    instructions = db.Column(
+        db.Text,
+    )
+
+    thumbnail = db.Column(
+        db.Text,
+    )
+
+    # idDrink and dateModified of recipes mirrored from TheCocktailDB
+    cdb_id = db.Column(
+        db.String(20),
+        unique=True,
+    )
+
+    cdb_modified = db.Column(
+        db.String(30),
+    )
+
+    # name weighted above ingredient names
+    search_vector = db.deferred(db.Column(
+        SearchVector,
+    ))
+
     ingredients = db.relationship(
         'Ingredient',
         secondary= 'recipe_ingredient',
         backref= 'recipes'
     )
 
+    def serialize(self):
+        """Serialize recipe to a dict for JSON responses"""
+
+        return {
+            'id': self.id,
+            'name': self.name,
+            'instructions': self.instructions,
+            'thumbnail': self.thumbnail,
+            'ingredients': [{'id': i.id, 'name': i.name} for i in self.ingredients],
+        }
+
 class RecipeIngredient(db.Model):
     """Relationship between recipes and ingredients"""
 
@@ -359,4 +798,193 @@ class RecipeIngredient(db.Model):
         db.ForeignKey('ingredients.id', ondelete='CASCADE'),
         nullable = False,
         primary_key=True
-    )
\ No newline at end of file
+    )
+
+# Recommendations : precomputed in batch by blueprints/cabinet/recommend.py
+
+class RecipeSimilarity(db.Model):
+    """A recipe's most similar recipes by Jaccard similarity of their ingredients"""
+
+    __tablename__ = 'recipe_similarities'
+
+    recipe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('recipes.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key=True
+    )
+
+    similar_recipe_id = db.Column(
+        db.Integer,
+        db.ForeignKey('recipes.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key=True
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+class CabinetSuggestion(db.Model):
+    """An ingredient missing from a cabinet, with how many new recipes buying it unlocks"""
+
+    __tablename__ = 'cabinet_suggestions'
+
+    cabinet_id = db.Column(
+        db.Integer,
+        db.ForeignKey('cabinets.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key=True
+    )
+
+    ingredient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('ingredients.id', ondelete='CASCADE'),
+        nullable = False,
+        primary_key=True
+    )
+
+    unlocks = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+# Jobs : deferred work run by the background workers in jobs.py
+
+class Job(db.Model):
+    """A queued call of a task registered with jobs.task"""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    task = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    # JSON object of the task's keyword arguments
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # queued -> running -> deleted when done, or failed after max_attempts
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.String(100),
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+# Full-text search : Postgres keeps search_vector current with these
+# triggers. They are created with their tables, and by migrate.py for
+# databases that predate them.
+
+SEARCH_DDL = {
+    'posts': [
+        "DROP TRIGGER IF EXISTS posts_search_vector ON posts",
+        "CREATE TRIGGER posts_search_vector BEFORE INSERT OR UPDATE OF content ON posts "
+        "FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', content)",
+    ],
+    'comments': [
+        "DROP TRIGGER IF EXISTS comments_search_vector ON comments",
+        "CREATE TRIGGER comments_search_vector BEFORE INSERT OR UPDATE OF content ON comments "
+        "FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', content)",
+    ],
+    # created with recipe_ingredient, the last of the tables these read
+    'recipe_ingredient': [
+        """CREATE OR REPLACE FUNCTION recipe_search_vector(target_id integer, target_name text) RETURNS tsvector AS $$
+            SELECT setweight(to_tsvector('english', coalesce(target_name, '')), 'A') ||
+                   setweight(to_tsvector('english', coalesce(string_agg(i.name, ' '), '')), 'B')
+            FROM recipe_ingredient ri JOIN ingredients i ON i.id = ri.ingredient_id
+            WHERE ri.recipe_id = target_id
+        $$ LANGUAGE sql STABLE""",
+
+        """CREATE OR REPLACE FUNCTION recipes_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := recipe_search_vector(NEW.id, NEW.name);
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS recipes_search_vector ON recipes",
+        "CREATE TRIGGER recipes_search_vector BEFORE INSERT OR UPDATE OF name ON recipes "
+        "FOR EACH ROW EXECUTE PROCEDURE recipes_search_vector()",
+
+        # once per statement, so a bulk insert of links updates each recipe once
+        """CREATE OR REPLACE FUNCTION recipe_ingredient_search_vector() RETURNS trigger AS $$
+        BEGIN
+            UPDATE recipes SET search_vector = recipe_search_vector(id, name)
+            WHERE id IN (SELECT recipe_id FROM changed);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS recipe_ingredient_search_vector_insert ON recipe_ingredient",
+        "CREATE TRIGGER recipe_ingredient_search_vector_insert AFTER INSERT ON recipe_ingredient "
+        "REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE recipe_ingredient_search_vector()",
+        "DROP TRIGGER IF EXISTS recipe_ingredient_search_vector_delete ON recipe_ingredient",
+        "CREATE TRIGGER recipe_ingredient_search_vector_delete AFTER DELETE ON recipe_ingredient "
+        "REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE PROCEDURE recipe_ingredient_search_vector()",
+
+        """CREATE OR REPLACE FUNCTION ingredients_search_vector() RETURNS trigger AS $$
+        BEGIN
+            UPDATE recipes SET search_vector = recipe_search_vector(id, name)
+            WHERE id IN (SELECT recipe_id FROM recipe_ingredient WHERE ingredient_id = NEW.id);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS ingredients_search_vector ON ingredients",
+        "CREATE TRIGGER ingredients_search_vector AFTER UPDATE OF name ON ingredients "
+        "FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name) EXECUTE PROCEDURE ingredients_search_vector()",
+    ],
+}
+
+# GIN indexes on search_vector, by table
+SEARCH_INDEXES = {
+    'posts': 'ix_posts_search_vector',
+    'comments': 'ix_comments_search_vector',
+    'recipes': 'ix_recipes_search_vector',
+}
+
+for _table, _statements in SEARCH_DDL.items():
+    for _statement in _statements:
+        event.listen(db.metadata.tables[_table], 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+for _table, _name in SEARCH_INDEXES.items():
+    event.listen(db.metadata.tables[_table], 'after_create',
+        DDL(f'CREATE INDEX IF NOT EXISTS {_name} ON {_table} USING gin (search_vector)').execute_if(dialect='postgresql'))
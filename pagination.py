@@ -0,0 +1,87 @@
+"""Keyset (cursor) pagination on (timestamp, id).
+
+Pages are fetched with a row-value comparison against the last row seen
+instead of OFFSET, so the cost of a page does not grow with how deep into a
+list it is. Cursors are opaque url-safe strings.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(timestamp, id):
+    """Encode a (timestamp, id) position as a cursor string"""
+
+    raw = f'{timestamp.isoformat()}|{id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string, raising ValueError if it is malformed"""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError) as exc:
+        raise ValueError('invalid cursor') from exc
+
+
+class Page:
+    """One page of results and the cursor for the page after it"""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def paginate(query, timestamp_col, id_col, cursor=None, limit=DEFAULT_PAGE_SIZE,
+             descending=True, key=lambda item: (item.timestamp, item.id)):
+    """Return a Page of `query` ordered by (timestamp_col, id_col).
+
+    `key` pulls the (timestamp, id) position back out of a result row.
+    """
+
+    position = tuple_(timestamp_col, id_col)
+    if cursor:
+        after = tuple_(*decode_cursor(cursor))
+        query = query.filter(position < after if descending else position > after)
+
+    if descending:
+        query = query.order_by(timestamp_col.desc(), id_col.desc())
+    else:
+        query = query.order_by(timestamp_col, id_col)
+
+    # fetch one extra row to learn whether there is a next page
+    items = query.limit(limit + 1).all()
+    if len(items) > limit:
+        items = items[:limit]
+        return Page(items, encode_cursor(*key(items[-1])))
+    return Page(items)
+
+
+def page_args():
+    """Read ?cursor= and ?limit= from the current request, 400 on a bad cursor"""
+
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+
+    return cursor, limit
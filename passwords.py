@@ -0,0 +1,99 @@
+"""Password hashing off the request thread.
+
+bcrypt releases the GIL while it works, so hashes run on a small thread pool
+sized to the cores we are willing to spend on them. The number of hashes in
+flight is bounded: once it is reached new ones fail fast with HasherBusy
+instead of queueing behind a login burst and starving every other request.
+"""
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already pending"""
+
+
+class PasswordHasher:
+    """Bounded bcrypt worker pool around a Flask-Bcrypt instance"""
+
+    def __init__(self, bcrypt, rounds=12, workers=2, max_pending=16):
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read BCRYPT_* settings, calibrating the cost if BCRYPT_TARGET_MS is set"""
+
+        self.workers = app.config.get('BCRYPT_WORKERS', self.workers)
+        self.max_pending = app.config.get('BCRYPT_MAX_PENDING', self.max_pending)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+        target_ms = app.config.get('BCRYPT_TARGET_MS')
+        if target_ms:
+            self.rounds = self.calibrate(target_ms)
+        else:
+            self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+
+    def calibrate(self, target_ms, min_rounds=10, max_rounds=16, sample_rounds=8):
+        """Pick the cost whose hash time is closest to `target_ms` on this machine.
+
+        Each extra round doubles the work, so one cheap sample is enough to
+        extrapolate.
+        """
+
+        start = time.perf_counter()
+        self.bcrypt.generate_password_hash('calibration', sample_rounds)
+        sample_ms = max((time.perf_counter() - start) * 1000, 0.01)
+
+        rounds = sample_rounds + round(math.log2(target_ms / sample_ms))
+        return min(max(rounds, min_rounds), max_rounds)
+
+    def _pool(self):
+        # threads do not survive a fork, so each worker process gets its own pool
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='bcrypt')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        """Hash `password` at the current cost"""
+
+        return self._run(self.bcrypt.generate_password_hash, password, self.rounds).decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed`?"""
+
+        return self._run(self.bcrypt.check_password_hash, hashed, password)
+
+    @staticmethod
+    def cost(hashed):
+        """The cost factor stored in a bcrypt hash, e.g. 12 for $2b$12$..."""
+
+        return int(hashed.split('$')[2])
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the current one?"""
+
+        return self.cost(hashed) != self.rounds
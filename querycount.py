@@ -0,0 +1,85 @@
+"""SQL statement counting and per-view query budgets.
+
+Every statement run inside a request bumps a counter on g. Views decorated
+with @query_budget(n) check that counter when they return: over budget is a
+warning in production and a QueryBudgetExceeded error when
+QUERY_BUDGET_STRICT is set, which the test suite turns on so an N+1 fails
+the build instead of slowly creeping into production.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more SQL statements than its declared budget"""
+
+
+# savepoints are transaction bookkeeping (the test suite wraps every test in
+# one), not queries a view should be charged for
+TRANSACTION_CONTROL = ('SAVEPOINT ', 'RELEASE SAVEPOINT ', 'ROLLBACK TO SAVEPOINT ')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and not statement.startswith(TRANSACTION_CONTROL):
+        g._sql_count = g.get('_sql_count', 0) + 1
+
+
+def statement_count():
+    """SQL statements run so far in the current app context"""
+
+    return g.get('_sql_count', 0)
+
+
+@contextmanager
+def not_counted():
+    """Leave the statements run inside the block out of the current count"""
+
+    count = statement_count()
+    try:
+        yield
+    finally:
+        g._sql_count = count
+
+
+def query_budget(limit):
+    """Declare the most SQL statements a view (including its template) may run"""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            start = statement_count()
+            response = view(*args, **kwargs)
+            used = statement_count() - start
+
+            if used > limit:
+                message = f'{request.endpoint} ran {used} SQL statements, budget is {limit}'
+                if current_app.config.get('QUERY_BUDGET_STRICT'):
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+
+            return response
+        return wrapped
+    return decorator
+
+
+@contextmanager
+def count_queries(engine):
+    """Count statements run on `engine` inside the block: `with count_queries(db.engine) as counted`"""
+
+    counted = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(TRANSACTION_CONTROL):
+            counted.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield counted
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
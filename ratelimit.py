@@ -0,0 +1,255 @@
+"""Write rate limiting and admission control.
+
+Views that write declare the class of work they do:
+
+    @user.route('/create', methods=['GET', 'POST'])
+    @limit('write', methods=('POST',))
+    def create_post():
+
+Two checks then run before the view, neither of them touching the database:
+
+- At most CONCURRENCY_LIMITS[class] requests of the class run at once in a
+  worker. Past that a request is shed straight away with 503 and
+  Retry-After, instead of queueing for a DB connection or a bcrypt worker
+  while everyone else's requests wait behind it.
+- Every client has a token bucket per class, refilled at
+  RATE_LIMITS[class] = (per minute, burst). The client is the logged in
+  user, or the IP address for anonymous requests like logins and signups.
+  An empty bucket answers 429 with Retry-After set to when the next token
+  is due.
+
+Buckets live in process memory by default, so with several workers a
+client can get up to that many times its rate. The filesystem backend
+shares buckets between the workers on one host through a locked file per
+bucket. Any object with take(key, rate, burst) can stand in for either,
+passed to limiter.init_app(app, backend=...).
+"""
+
+import fcntl
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import jsonify, request, session
+
+import metrics
+from identity import CURR_USER_KEY
+
+DEFAULT_MAX_KEYS = 100000
+# a bucket untouched this long is full again, whatever its rate
+DEFAULT_MAX_IDLE = 3600
+
+
+class RateLimited(Exception):
+    """The client's bucket for this class of request is empty"""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """Too many requests of this class are already running in this worker"""
+
+
+def refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryBackend:
+    """Buckets in a per-process LRU of key -> (tokens, updated), at most max_keys of them.
+
+    Evicting a bucket only refills it, and the evicted ones are those of the
+    clients seen least recently.
+    """
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token; returns 0 if there was one, else the seconds until there is"""
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, rate, burst)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class FileSystemBackend:
+    """One file per bucket in a directory shared by the workers on a host.
+
+    A take holds an exclusive flock on the bucket's file while it reads and
+    rewrites it. Files idle for max_idle are removed now and then.
+    """
+
+    def __init__(self, path, max_idle=DEFAULT_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._takes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def take(self, key, rate, burst):
+        fd = os.open(self._file(key), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, updated = map(float, os.read(fd, 64).split())
+            except ValueError:
+                tokens, updated = burst, now
+            tokens = refill(tokens, updated, now, rate, burst)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+
+            state = f'{tokens - 1 if not wait else tokens} {now}'.encode()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, state)
+            os.ftruncate(fd, len(state))
+        finally:
+            os.close(fd)
+
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            self.prune()
+        return wait
+
+    def prune(self):
+        cutoff = time.time() - self.max_idle
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
+class NullBackend:
+    """Never limits, for tests and load testing"""
+
+    def take(self, key, rate, burst):
+        return 0
+
+    def clear(self):
+        pass
+
+
+def client_key():
+    """The logged in user, else the client's address"""
+
+    user_id = session.get(CURR_USER_KEY)
+    if user_id is not None:
+        return f'user:{user_id}'
+    return f'ip:{request.remote_addr}'
+
+
+class Limiter:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.rates = {}
+        self.slots = {}
+
+    def init_app(self, app, backend=None):
+        """Pick the backend and read the limits from config; answer 429/503 for the errors"""
+
+        if backend is None:
+            kind = app.config.get('RATE_LIMIT_BACKEND', 'memory')
+            if kind == 'memory':
+                backend = MemoryBackend()
+            elif kind == 'filesystem':
+                backend = FileSystemBackend(app.config['RATE_LIMIT_DIR'])
+            elif kind == 'null':
+                backend = NullBackend()
+            else:
+                raise ValueError(f'Unknown RATE_LIMIT_BACKEND {kind!r}')
+        self.backend = backend
+
+        self.rates = dict(app.config.get('RATE_LIMITS', {}))
+        self.slots = {endpoint_class: threading.BoundedSemaphore(count)
+            for endpoint_class, count in app.config.get('CONCURRENCY_LIMITS', {}).items()}
+
+        app.register_error_handler(RateLimited, rate_limited)
+        app.register_error_handler(Overloaded, overloaded)
+
+    @contextmanager
+    def admit(self, endpoint_class):
+        """Hold one of the class's slots for the block, once the client's bucket gives a token"""
+
+        slots = self.slots.get(endpoint_class)
+        if slots is not None and not slots.acquire(blocking=False):
+            metrics.requests_shed.inc((endpoint_class, 'overloaded'))
+            raise Overloaded(endpoint_class)
+        try:
+            if endpoint_class in self.rates:
+                per_minute, burst = self.rates[endpoint_class]
+                wait = self.backend.take(f'{endpoint_class}:{client_key()}', per_minute / 60, burst)
+                if wait:
+                    metrics.requests_shed.inc((endpoint_class, 'rate_limited'))
+                    raise RateLimited(wait)
+            yield
+        finally:
+            if slots is not None:
+                slots.release()
+
+
+limiter = Limiter()
+
+
+def init_app(app):
+    limiter.init_app(app)
+
+
+def limit(endpoint_class, methods=None):
+    """Rate limit and cap the concurrency of a view, for every method or just `methods`"""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            with limiter.admit(endpoint_class):
+                return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def _refusal(message, status, retry_after):
+    headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+    accept = request.accept_mimetypes
+    if request.is_json or (accept.accept_json and not accept.accept_html):
+        return jsonify(error=message), status, headers
+    return message, status, headers
+
+
+def rate_limited(error):
+    return _refusal("Too many requests, please slow down.", 429, error.retry_after)
+
+
+def overloaded(error):
+    return _refusal("We're too busy right now, please try again.", 503, 1)
@@ -0,0 +1,91 @@
+"""Read replica routing for the db session.
+
+GET and HEAD requests to the blueprints in DB_REPLICA_BLUEPRINTS read from
+one of the DB_REPLICA_BINDS (SQLALCHEMY_BINDS keys), picked once per
+request. Everything else uses the primary, and so does the rest of a request
+once it writes: flushes, INSERT/UPDATE/DELETE statements, raw SQL and
+SELECT ... FOR UPDATE always go to the primary, after which its reads follow.
+
+A request that wrote also makes its user sticky to the primary for
+DB_REPLICA_STICKY_SECONDS (kept in the session cookie), so the redirect
+after a post or follow reads its own write instead of a lagging replica.
+Views that write even on GET are marked with @use_primary.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+STICKY_KEY = '_primary_until'
+DEFAULT_STICKY_SECONDS = 5
+READ_METHODS = ('GET', 'HEAD')
+
+
+def use_primary(view):
+    """Mark a view that writes even when called with GET"""
+
+    view.use_primary = True
+    return view
+
+
+def replica_for_request():
+    """Bind key of the replica this request reads from, or None for the primary"""
+
+    if not has_request_context():
+        return None
+    if '_db_replica' not in g:
+        g._db_replica = _choose_replica()
+    return g._db_replica
+
+
+def _choose_replica():
+    config = current_app.config
+    binds = config.get('DB_REPLICA_BINDS')
+    if not binds or request.method not in READ_METHODS:
+        return None
+    if request.blueprint not in config.get('DB_REPLICA_BLUEPRINTS', ()):
+        return None
+    if getattr(current_app.view_functions.get(request.endpoint), 'use_primary', False):
+        return None
+    if session.get(STICKY_KEY, 0) > time.time():
+        return None
+    return random.choice(binds)
+
+
+class RoutingSession(SignallingSession):
+    """SignallingSession that sends a read-only request's queries to its replica"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self._flushing or isinstance(clause, (UpdateBase, TextClause))
+                or getattr(clause, '_for_update_arg', None) is not None):
+            self.info['wrote'] = True
+        elif not self.info.get('wrote'):
+            bind_key = replica_for_request()
+            if bind_key is not None:
+                return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_app(app, db):
+    """Make users who just wrote read from the primary for a while"""
+
+    @app.before_request
+    def forget_earlier_writes():
+        # the scoped session can outlive a request in the same thread
+        db.session.info.pop('wrote', None)
+
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        if db.session.info.get('wrote'):
+            session[STICKY_KEY] = time.time() + app.config.get('DB_REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+        return response
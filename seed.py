@@ -0,0 +1,267 @@
+"""Bulk-generate realistic synthetic data for load testing.
+
+    python seed.py --users 100000 --posts 10000000
+
+Activity is skewed the way real social data is: a few accounts attract most
+follows (preferential attachment), write most posts and get most comments,
+and a few ingredients show up in most recipes and cabinets. Rows go in with
+multi-row core INSERTs in batches rather than through the ORM. Every seeded
+user's password is `password`.
+
+Timelines are materialized last, from the seeded posts and follows, the
+way fan-out and follow backfills would have built them.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import migrate
+from blueprints.cabinet import recommend
+from blueprints.user import counters, suggestions, timeline
+from models import (db, hasher, User, Follows, Post, Comment, Ingredient, Recipe,
+    RecipeIngredient, Cabinet, CabinetIngredient)
+
+SPIRITS = ['gin', 'vodka', 'rum', 'tequila', 'mezcal', 'bourbon', 'rye', 'scotch', 'brandy', 'cognac', 'pisco', 'cachaca']
+MODIFIERS = ['vermouth', 'campari', 'aperol', 'chartreuse', 'maraschino', 'triple sec', 'amaretto', 'kahlua', 'absinthe', 'benedictine']
+MIXERS = ['lime juice', 'lemon juice', 'simple syrup', 'tonic', 'soda water', 'ginger beer', 'bitters', 'grenadine', 'orange juice', 'cola', 'mint', 'egg white']
+STYLES = ['dry', 'sweet', 'spiced', 'aged', 'white', 'dark', 'overproof', 'blanco', 'reposado', 'smoked', 'bianco', 'rosso']
+DRINK_WORDS = ['Sour', 'Fizz', 'Smash', 'Mule', 'Collins', 'Flip', 'Julep', 'Old Fashioned', 'Martini', 'Negroni', 'Spritz', 'Punch', 'Daisy', 'Sling', 'Cobbler']
+PLACES = ['Brooklyn', 'Havana', 'Paris', 'Tokyo', 'Oaxaca', 'Kentucky', 'London', 'Bombay', 'Singapore', 'Jalisco', 'Dublin', 'Sicily']
+WORDS = ['tried', 'new', 'recipe', 'tonight', 'shaken', 'stirred', 'garnish', 'too', 'sweet', 'perfect', 'balance', 'ice', 'glass', 'bitter', 'smooth', 'strong', 'again', 'friends', 'bar', 'citrus']
+
+
+def zipf_weights(n, alpha=1.1):
+    """Cumulative weights so that item i is picked ~ 1 / (i + 1) ** alpha"""
+
+    return list(accumulate(1.0 / (i + 1) ** alpha for i in range(n)))
+
+
+def sentence(rng, low=4, high=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize() + '.'
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert(model, rows, batch):
+    """Insert an iterable of row dicts `batch` rows per statement"""
+
+    table = model.__table__
+    chunk = []
+    count = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == batch:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
+def fix_sequences(*models):
+    """Explicit ids bypass Postgres sequences; move them past the seeded rows"""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__tablename__
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))")
+    db.session.commit()
+
+
+def seed_users(rng, count, batch):
+    first = next_id(User)
+    password = hasher.hash('password')
+    ids = list(range(first, first + count))
+
+    insert(User, ({
+        'id': id,
+        'username': f'user{id}',
+        'email': f'user{id}@example.com',
+        'password': password,
+    } for id in ids), batch)
+    return ids
+
+
+def seed_follows(rng, user_ids, mean_following, batch):
+    """Each user follows a pareto-distributed number of accounts, picked by popularity"""
+
+    popular = user_ids[:]
+    rng.shuffle(popular)
+    weights = zipf_weights(len(popular))
+
+    def rows():
+        for user_id in user_ids:
+            want = min(int(rng.paretovariate(1.5) * mean_following / 3), len(popular) - 1)
+            followed = set(rng.choices(popular, cum_weights=weights, k=want))
+            followed.discard(user_id)
+            for followed_id in followed:
+                yield {'user_following_id': user_id, 'user_being_followed_id': followed_id}
+
+    return insert(Follows, rows(), batch)
+
+
+def seed_posts(rng, user_ids, count, days, batch):
+    first = next_id(Post)
+    authors = user_ids[:]
+    rng.shuffle(authors)
+    weights = zipf_weights(len(authors), alpha=0.9)
+    now = datetime.utcnow()
+
+    insert(Post, ({
+        'id': id,
+        'user_id': rng.choices(authors, cum_weights=weights)[0],
+        'content': sentence(rng),
+        'timestamp': now - timedelta(seconds=rng.randint(0, days * 86400)),
+    } for id in range(first, first + count)), batch)
+    return first, first + count
+
+
+def seed_comments(rng, user_ids, post_range, count, batch):
+    first = next_id(Comment)
+    low, high = post_range
+    now = datetime.utcnow()
+
+    def rows():
+        for id in range(first, first + count):
+            # later (newer-id) posts collect more comments
+            post_id = high - 1 - min(int(rng.expovariate(1.0) * (high - low) / 8), high - low - 1)
+            yield {
+                'id': id,
+                'post_id': post_id,
+                'user_id': rng.choice(user_ids),
+                'content': sentence(rng, 2, 12),
+                'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400)),
+            }
+
+    return insert(Comment, rows(), batch)
+
+
+def ingredient_names(count):
+    names = SPIRITS + MODIFIERS + MIXERS
+    names += [f'{style} {base}' for base in SPIRITS + MODIFIERS for style in STYLES]
+    names += [f'{place} {base}' for base in SPIRITS + MODIFIERS for place in PLACES]
+    base = names[:]
+    n = 1
+    while len(names) < count:
+        names += [f'{name} no. {n}' for name in base[:count - len(names)]]
+        n += 1
+    return names[:count]
+
+
+def seed_ingredients(rng, count, batch):
+    first = next_id(Ingredient)
+    names = ingredient_names(count)
+    insert(Ingredient, ({'id': first + i, 'name': name} for i, name in enumerate(names)), batch)
+    return list(range(first, first + count))
+
+
+def seed_recipes(rng, ingredient_ids, count, batch):
+    first = next_id(Recipe)
+    weights = zipf_weights(len(ingredient_ids))
+
+    insert(Recipe, ({
+        'id': id,
+        'name': f'{rng.choice(PLACES)} {rng.choice(DRINK_WORDS)} {id}'[:50],
+    } for id in range(first, first + count)), batch)
+
+    def rows():
+        for id in range(first, first + count):
+            for ingredient_id in set(rng.choices(ingredient_ids, cum_weights=weights, k=rng.randint(2, 6))):
+                yield {'recipe_id': id, 'ingredient_id': ingredient_id}
+
+    insert(RecipeIngredient, rows(), batch)
+
+
+def seed_cabinets(rng, user_ids, ingredient_ids, batch):
+    first = next_id(Cabinet)
+    weights = zipf_weights(len(ingredient_ids))
+    cabinet_ids = list(range(first, first + len(user_ids)))
+
+    insert(Cabinet, ({'id': id, 'user_id': user_id} for id, user_id in zip(cabinet_ids, user_ids)), batch)
+
+    def rows():
+        for cabinet_id in cabinet_ids:
+            for ingredient_id in set(rng.choices(ingredient_ids, cum_weights=weights, k=rng.randint(3, 30))):
+                yield {'cabinet_id': cabinet_id, 'ingredient_id': ingredient_id}
+
+    insert(CabinetIngredient, rows(), batch)
+
+
+def seed_timelines(user_ids, batch):
+    """Build each user's timeline, committing every `batch` users"""
+
+    for i, user_id in enumerate(user_ids, 1):
+        timeline.rebuild(user_id)
+        if i % batch == 0:
+            db.session.commit()
+    db.session.commit()
+
+
+def seed(users=1000, mean_following=20, posts=10000, comments=20000, ingredients=500,
+         recipes=2000, days=365, batch=5000, random_seed=0, log=print):
+    """Generate a full synthetic dataset in the current app's database"""
+
+    rng = random.Random(random_seed)
+
+    def step(name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        log(f'{name:<12} {time.perf_counter() - start:8.1f}s')
+        return result
+
+    user_ids = step('users', seed_users, rng, users, batch)
+    step('follows', seed_follows, rng, user_ids, mean_following, batch)
+    post_range = step('posts', seed_posts, rng, user_ids, posts, days, batch)
+    if posts:
+        step('comments', seed_comments, rng, user_ids, post_range, comments, batch)
+    ingredient_ids = step('ingredients', seed_ingredients, rng, ingredients, batch)
+    step('recipes', seed_recipes, rng, ingredient_ids, recipes, batch)
+    step('cabinets', seed_cabinets, rng, user_ids, ingredient_ids, batch)
+
+    fix_sequences(User, Post, Comment, Ingredient, Recipe, Cabinet)
+    step('timelines', seed_timelines, user_ids, batch)
+
+    step('counters', counters.reconcile_all, batch, lambda message: None)
+    step('suggestions', suggestions.refresh_all, lambda message: None)
+    step('recommend', recommend.refresh_all, lambda message: None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--following', type=int, default=20, help='mean accounts followed per user')
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--ingredients', type=int, default=500)
+    parser.add_argument('--recipes', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365, help='spread posts over this many days')
+    parser.add_argument('--batch', type=int, default=5000, help='rows per INSERT')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, for repeatable datasets')
+    parser.add_argument('--create', action='store_true', help='apply pending schema migrations first')
+    args = parser.parse_args()
+
+    from app import create_app
+
+    app = create_app()
+
+    with app.app_context():
+        if args.create:
+            migrate.upgrade(db.engine)
+        seed(args.users, args.following, args.posts, args.comments, args.ingredients,
+             args.recipes, args.days, args.batch, args.seed)
+
+
+if __name__ == '__main__':
+    main()
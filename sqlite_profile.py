@@ -0,0 +1,48 @@
+"""Embedded SQLite profile.
+
+    DATABASE_URL=sqlite:///bartender.db flask run     a file next to app.py
+    DATABASE_URL=sqlite:// python -m pytest           in memory, one database per process
+
+The models and blueprints run unchanged on SQLite: Postgres only features
+(search vectors, SKIP LOCKED, advisory locks, ON CONFLICT) already fall back
+on other dialects. What SQLite needs is set up here, on every SQLite
+connection any engine opens:
+
+- foreign keys are enforced, which SQLite skips unless asked, so ON DELETE
+  CASCADE behaves as it does on Postgres;
+- file databases use WAL, so web workers and the job worker keep reading
+  while one of them writes, and writers wait up to BUSY_TIMEOUT_MS for the
+  write lock instead of failing;
+- pysqlite's own transaction handling, which commits before DDL and
+  ignores SAVEPOINT, is switched off and BEGIN is emitted when SQLAlchemy
+  begins a transaction, so savepoints and transactional DDL work.
+"""
+
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUSY_TIMEOUT_MS = 5000
+
+
+@event.listens_for(Engine, 'connect')
+def _configure_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys = ON')
+    cursor.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    # in memory databases answer 'memory' and keep their journal
+    if cursor.execute('PRAGMA journal_mode = WAL').fetchone()[0] == 'wal':
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
+
+@event.listens_for(Engine, 'begin')
+def _begin(conn):
+    if conn.dialect.name == 'sqlite':
+        # straight to the driver: BEGIN isn't a query worth counting
+        conn.connection.execute('BEGIN')
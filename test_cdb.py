@@ -0,0 +1,147 @@
+"""CocktailDB mirror tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cdb.py
+#
+# The mirror syncs from a local stand-in for TheCocktailDB, never the real API.
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models import db, Ingredient, Recipe, RecipeIngredient, CabinetIngredient
+from testing import DatabaseTestCase, app
+from blueprints.cdb import mirror
+from blueprints.cdb.client import CocktailDBClient
+
+db.create_all()
+
+
+DRINKS = {
+    'g': [{
+        'idDrink': '11403', 'strDrink': 'Gin Fizz', 'dateModified': '2017-01-01 10:00:00',
+        'strInstructions': 'Shake with ice.', 'strDrinkThumb': None,
+        'strIngredient1': 'Gin', 'strIngredient2': 'Lemon', 'strIngredient3': 'Carbonated water',
+        'strIngredient4': None,
+    }],
+    'm': [{
+        'idDrink': '11728', 'strDrink': 'Martini', 'dateModified': '2017-01-01 10:00:00',
+        'strInstructions': 'Stir.', 'strDrinkThumb': None,
+        'strIngredient1': 'Gin', 'strIngredient2': 'Dry Vermouth', 'strIngredient3': '',
+    }],
+}
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Serves DRINKS with ETags and counts requests per path"""
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        StandIn.requests.append(self.path)
+
+        if 'list.php' in self.path:
+            body = {'drinks': [{'strIngredient1': 'Gin'}, {'strIngredient1': 'Lemon'}]}
+        else:
+            letter = self.path.rsplit('f=', 1)[-1]
+            body = {'drinks': DRINKS.get(letter)}
+
+        payload = json.dumps(body).encode()
+        etag = '"%x"' % hash(payload)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class CocktailDBMirrorTestCase(DatabaseTestCase):
+    """Tests for the CocktailDB mirror"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+
+        StandIn.requests = []
+        port = self.server.server_address[1]
+        # ttl=0 so every get revalidates with the stand-in
+        self.client = CocktailDBClient(f'http://127.0.0.1:{port}/api/json/v1/1/', ttl=0)
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.client.close()
+        self.app_context.pop()
+
+    def test_sync(self):
+        """A sync imports drinks, their ingredients and the links between them"""
+
+        stats = mirror.sync(self.client, letters='gm')
+
+        self.assertEqual(stats['created'], 2)
+        martini = Recipe.query.filter_by(cdb_id='11728').one()
+        self.assertEqual(sorted(i.name for i in martini.ingredients), ['Dry Vermouth', 'Gin'])
+        # 'Gin' is shared rather than duplicated
+        self.assertEqual(Ingredient.query.filter_by(name='Gin').count(), 1)
+
+        resp = app.test_client().get(f'/api/cdb/recipes/{martini.id}')
+        self.assertEqual(resp.get_json()['recipe']['name'], 'Martini')
+
+    def test_incremental_sync(self):
+        """An unchanged catalog answers 304 and nothing is rewritten"""
+
+        mirror.sync(self.client, letters='gm')
+        stats = mirror.sync(self.client, letters='gm')
+
+        self.assertEqual(stats['unchanged_pages'], 2)
+        self.assertEqual(stats['created'] + stats['updated'], 0)
+        # the ingredient list and both pages were each fetched twice
+        self.assertEqual(len(StandIn.requests), 6)
+
+
+class RecipeSearchTestCase(DatabaseTestCase):
+    """Tests the recipe name search"""
+
+    def setUp(self):
+        """add sample data"""
+
+        super().setUp()
+
+        db.session.add_all([Recipe(name='50% Sour'), Recipe(name='500 Club'), Recipe(name='Gin_Fizz'), Recipe(name='Gin Sour')])
+        db.session.commit()
+
+    def search(self, query):
+        return [r['name'] for r in app.test_client().get(f'/api/cdb/recipes?{query}').get_json()['recipes']]
+
+    def test_wildcards_are_literal(self):
+        """% and _ in the query match themselves, not any text"""
+
+        self.assertEqual(self.search('q=50%25'), ['50% Sour'])
+        self.assertEqual(self.search('q=gin_'), ['Gin_Fizz'])
+        self.assertEqual(self.search('q=gin'), ['Gin Sour', 'Gin_Fizz'])
+
+    def test_limit_is_clamped(self):
+        """A zero or negative limit returns one result instead of failing"""
+
+        self.assertEqual(len(self.search('q=&limit=-5')), 1)
@@ -1,34 +1,28 @@
 """Model tests."""
 
 
-import os
+import threading
+import time
 from unittest import TestCase
 
-from models import db, User, Ingredient, CabinetIngredient, Cabinet, Recipe, Follows, Favorites, Comment, Post
+from sqlalchemy import event
 
-os.environ['DATABASE_URL'] = "postgresql:///bartender_test"
-
-from app import app
+from models import db, hasher, User, Ingredient, CabinetIngredient, Cabinet, Recipe, Follows, Favorites, Comment, Post
+from testing import DatabaseTestCase, app
+from passwords import HasherBusy, PasswordHasher
+import migrate
 
 # db.drop_all()
 db.create_all()
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Testing User Model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -88,6 +82,25 @@ class UserModelTestCase(TestCase):
         #Returns false if it can't authenticate
         self.assertFalse(User.authenticate(username='testuser',password='wrongpassword'))
 
+    def test_rehash_on_login(self):
+        """Does authenticate upgrade hashes made with an old cost factor"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            u = User.signup(username='testuser', email='test@test.com', password='testtest')
+            db.session.commit()
+            self.assertEqual(hasher.cost(u.password), 4)
+
+            hasher.rounds = 5
+            self.assertEqual(u, User.authenticate(username='testuser', password='testtest'))
+            db.session.commit()
+
+            self.assertEqual(hasher.cost(u.password), 5)
+            self.assertEqual(u, User.authenticate(username='testuser', password='testtest'))
+        finally:
+            hasher.rounds = rounds
+
     def test_is_following(self):
         """Does is_following method work"""
 
@@ -138,6 +151,50 @@ class UserModelTestCase(TestCase):
         #Should return true when a user is following another
         self.assertTrue(u2.is_followed_by(u))
 
+    def test_follow_state(self):
+        """Does follow_state report both directions for a batch of users"""
+
+        u = User.signup(username='testuser', email='test@test.com', password='testtest')
+        u2 = User.signup(username='testuser2', email='test2@test.com', password='testtest')
+        u3 = User.signup(username='testuser3', email='test3@test.com', password='testtest')
+        db.session.commit()
+
+        u.following.append(u2)
+        u3.following.append(u)
+        db.session.commit()
+
+        state = u.follow_state([u2, u3.id])
+
+        self.assertEqual(state[u2.id], {'following': True, 'followed_by': False})
+        self.assertEqual(state[u3.id], {'following': False, 'followed_by': True})
+        self.assertEqual(u.follow_state([]), {})
+
+    def test_follow_counter_lock_order(self):
+        """Following updates both users' counters lowest id first, whoever follows whom"""
+
+        u = User.signup(username='testuser', email='test@test.com', password='testtest')
+        u2 = User.signup(username='testuser2', email='test2@test.com', password='testtest')
+        db.session.commit()
+        u_id, u2_id = u.id, u2.id
+
+        updated = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE users'):
+                updated.append(parameters[-1])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            Follows.follow(u2_id, u_id)
+            Follows.unfollow(u2_id, u_id)
+            Follows.follow(u_id, u2_id)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        db.session.commit()
+
+        self.assertEqual(updated, [u_id, u2_id] * 3)
+        self.assertEqual((User.query.get(u_id).following_count, User.query.get(u2_id).followers_count), (1, 1))
+
     # def test_friends (self) : 
     #     """Adding a friend should show up in the User model"""
 
@@ -172,21 +229,13 @@ class UserModelTestCase(TestCase):
 
     #     self.assertEqual(u2.friends[0], u)
         
-class PostModelTestCase (TestCase):
+class PostModelTestCase(DatabaseTestCase):
     """Tests the Post model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -211,21 +260,13 @@ class PostModelTestCase (TestCase):
         self.assertEqual(self.u.posts[0], post)
         self.assertTrue(post.timestamp)
 
-class CommentModelTestCase (TestCase):
+class CommentModelTestCase(DatabaseTestCase):
     """Tests the Comment model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -259,21 +300,13 @@ class CommentModelTestCase (TestCase):
         self.assertEqual(comment.post, self.post)
         self.assertTrue(comment.timestamp)
 
-class CabinetModelTestCase (TestCase):
+class CabinetModelTestCase(DatabaseTestCase):
     """Tests the Cabinet model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -295,21 +328,28 @@ class CabinetModelTestCase (TestCase):
 
         self.assertEqual(len(cab.ingredients), 0)
 
-class IngredientModelTestCase (TestCase):
+    def test_add_many(self):
+        """add_many returns only the ids it stocked, skipping unknown and already stocked ones"""
+
+        cab = Cabinet(user_id=self.u.id)
+        gin, rum, lime = Ingredient(name='Gin'), Ingredient(name='Rum'), Ingredient(name='Lime')
+        db.session.add_all([cab, gin, rum, lime])
+        db.session.commit()
+
+        self.assertEqual(CabinetIngredient.add_many(cab.id, [gin.id]), [gin.id])
+        self.assertEqual(CabinetIngredient.add_many(cab.id, [gin.id, rum.id, lime.id, 9999]), sorted([rum.id, lime.id]))
+        self.assertEqual(CabinetIngredient.add_many(cab.id, [gin.id, 9999]), [])
+        db.session.commit()
+
+        self.assertEqual(CabinetIngredient.query.filter_by(cabinet_id=cab.id).count(), 3)
+
+class IngredientModelTestCase(DatabaseTestCase):
     """Tests the Ingredient model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -346,21 +386,13 @@ class IngredientModelTestCase (TestCase):
         self.assertEqual(self.cab.ingredients[0], ing)
 
 
-class RecipeModelTestCase (TestCase):
+class RecipeModelTestCase(DatabaseTestCase):
     """Tests the Recipe model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -373,21 +405,13 @@ class RecipeModelTestCase (TestCase):
 
         self.assertTrue(rec.id > 0)
 
-class FavoritesModelTestCase (TestCase):
+class FavoritesModelTestCase(DatabaseTestCase):
     """Tests the Favorites model"""
 
     def setUp(self):
         """create test client, and add sample data"""
         
-        User.query.delete()
-        Cabinet.query.delete()
-        Recipe.query.delete()
-        Follows.query.delete()
-        Favorites.query.delete()
-        Comment.query.delete()
-        Post.query.delete()
-        Ingredient.query.delete()
-        db.session.commit()
+        super().setUp()
 
         self.client = app.test_client() 
 
@@ -411,4 +435,89 @@ class FavoritesModelTestCase (TestCase):
         db.session.add(fav)
         db.session.commit()
 
-        self.assertEqual(self.u.favorites[0], self.rec)
\ No newline at end of file
+        self.assertEqual(self.u.favorites[0], self.rec)
+
+
+class SlowBcrypt:
+    """Stands in for Flask-Bcrypt: each hash takes `seconds`, or until `release` is set"""
+
+    def __init__(self, seconds=0, release=None):
+        self.seconds = seconds
+        self.release = release
+
+    def generate_password_hash(self, password, rounds):
+        if self.release is not None:
+            self.release.wait(5)
+        time.sleep(self.seconds)
+        return f'$2b${rounds:02d}$hash'.encode()
+
+    def check_password_hash(self, hashed, password):
+        return True
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests the bounded bcrypt pool"""
+
+    def test_busy_when_pending_is_full(self):
+        """Hashes past max_pending fail fast with HasherBusy, and slots come back when hashes finish"""
+
+        release = threading.Event()
+        hasher = PasswordHasher(SlowBcrypt(release=release), rounds=4, workers=1, max_pending=2)
+
+        waiting = [threading.Thread(target=hasher.hash, args=('password',)) for i in range(2)]
+        for thread in waiting:
+            thread.start()
+        # both slots are taken as soon as the hashes are submitted
+        while hasher._slots._value:
+            time.sleep(0.001)
+
+        with self.assertRaises(HasherBusy):
+            hasher.hash('password')
+        with self.assertRaises(HasherBusy):
+            hasher.check('$2b$04$hash', 'password')
+
+        release.set()
+        for thread in waiting:
+            thread.join()
+        while hasher._slots._value < 2:
+            time.sleep(0.001)
+        self.assertEqual(hasher.hash('password'), '$2b$04$hash')
+
+    def test_calibrate(self):
+        """calibrate extrapolates from a sample hash, doubling the time per round, within bounds"""
+
+        # 20ms at the sample cost of 8, so 11 rounds take about 160ms
+        hasher = PasswordHasher(SlowBcrypt(seconds=0.02))
+
+        self.assertEqual(hasher.calibrate(160), 11)
+        self.assertEqual(hasher.calibrate(160, min_rounds=12), 12)
+        self.assertEqual(hasher.calibrate(100000), 16)
+        self.assertEqual(hasher.calibrate(1), 10)
+
+
+class MigrationTestCase(TestCase):
+    """Tests the schema migrations and index check"""
+
+    def test_upgrade_is_idempotent(self):
+        """Migrations apply cleanly over a create_all() schema and only once"""
+
+        migrate.upgrade(db.engine, log=lambda line: None)
+
+        self.assertEqual(migrate.pending(db.engine), [])
+        self.assertEqual(migrate.upgrade(db.engine, log=lambda line: None), [])
+
+    def test_check_reports_missing_index(self):
+        """A declared index that is missing from the database is reported"""
+
+        self.assertEqual(migrate.check(db.engine), [])
+
+        with db.engine.begin() as conn:
+            conn.execute('DROP INDEX ix_follows_following')
+        try:
+            self.assertEqual(migrate.check(db.engine),
+                [('ix_follows_following', 'follows', ('user_following_id',))])
+        finally:
+            with db.engine.begin() as conn:
+                migrate.create_index(conn, 'ix_follows_following', 'follows', ['user_following_id'], concurrently=False)
+
+        self.assertEqual(migrate.check(db.engine), [])
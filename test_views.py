@@ -5,29 +5,1038 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import gzip
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import threading
 from unittest import TestCase
 
-from models import db, connect_db, User, Ingredient, CabinetIngredient, Cabinet, Recipe, Follows, Favorites, Comment, Post
+from flask import g
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from models import db, connect_db, hasher, User, Ingredient, IngredientAlias, CabinetIngredient, CabinetChange, Cabinet, Recipe, RecipeIngredient, RecipeSimilarity, CabinetSuggestion, Follows, FollowSuggestion, Favorites, Comment, Post, TimelineEntry, Job
+from testing import DatabaseTestCase, app
+from app import create_app
+from config import TestingConfig
+from identity import CURR_USER_KEY
+import identity
+import fragment_cache
+import jobs
+import migrate
+import ratelimit
+from blueprints.cabinet import matcher, recommend
+from blueprints.user import counters, export, suggestions
+from querycount import count_queries
 
-os.environ['DATABASE_URL'] = "postgresql:///bartender_test"
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test's data is rolled back when it ends)
+db.drop_all()
+db.create_all()
 
 
-# Now we can import app
+class CabinetViewTestCase(DatabaseTestCase):
+    """Tests for the cabinet blueprint"""
 
-from app import app, CURR_USER_KEY
+    def setUp(self):
+        """create test client, and add sample data"""
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.u = User.signup(
+            username='testuser',
+            email='test@test.com',
+            password='testtest',
+        )
+        db.session.commit()
+        self.cab = Cabinet(user_id=self.u.id)
+
+        self.gin = Ingredient(name='gin')
+        self.tonic = Ingredient(name='tonic')
+        self.vermouth = Ingredient(name='vermouth')
+        self.campari = Ingredient(name='campari')
+
+        gin_tonic = Recipe(name='Gin and Tonic', ingredients=[self.gin, self.tonic])
+        martini = Recipe(name='Martini', ingredients=[self.gin, self.vermouth])
+        negroni = Recipe(name='Negroni', ingredients=[self.gin, self.vermouth, self.campari])
+
+        self.cab.ingredients.extend([self.gin, self.tonic])
+        db.session.add_all([self.cab, gin_tonic, martini, negroni])
+        db.session.commit()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u.id
+
+    def test_makeable(self):
+        """Makeable recipes and near misses are matched against the cabinet"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get('/cabinet/makeable')
+            data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['name'] for r in data['makeable']], ['Gin and Tonic'])
+        self.assertEqual([r['name'] for r in data['missing']['1']], ['Martini'])
+        self.assertEqual(data['missing']['1'][0]['missing'][0]['name'], 'vermouth')
+        self.assertEqual([r['name'] for r in data['missing']['2']], ['Negroni'])
+
+    def test_makeable_limit_is_clamped(self):
+        """A zero or negative limit still returns a recipe, instead of silently none"""
+
+        with self.client as c:
+            self.login(c)
+            data = c.get('/cabinet/makeable?limit=-5').get_json()
+
+        self.assertEqual([r['name'] for r in data['makeable']], ['Gin and Tonic'])
+
+    def test_makeable_tracks_catalog_changes(self):
+        """Adding a recipe is reflected without restarting"""
+
+        db.session.add(Recipe(name='Gin Neat', ingredients=[self.gin]))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            data = c.get('/cabinet/makeable?missing=0').get_json()
+
+        self.assertCountEqual([r['name'] for r in data['makeable']], ['Gin and Tonic', 'Gin Neat'])
+        self.assertEqual(data['missing'], {})
+
+    def test_makeable_unauthorized(self):
+        """Anonymous users get a 401"""
+
+        resp = self.client.get('/cabinet/makeable')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_bulk_update(self):
+        """Many ingredients go in and out in one request; repeats and unknowns are skipped"""
+
+        gin, tonic, vermouth, campari = (i.id for i in (self.gin, self.tonic, self.vermouth, self.campari))
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post('/cabinet/ingredients', json={
+                'add': ['Vermouth', campari, gin, 'unobtainium'],
+                'remove': [tonic],
+            })
+            data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['added'], 2)
+        self.assertEqual(data['removed'], 1)
+        self.assertEqual(data['unknown'], ['unobtainium'])
+        self.assertCountEqual(data['ingredients'], [gin, vermouth, campari])
+
+    def test_versioned_get(self):
+        """Cabinet reads are conditional on the version and can return just the delta"""
+
+        vermouth, tonic = self.vermouth.id, self.tonic.id
+
+        with self.client as c:
+            self.login(c)
+            first = c.get('/cabinet/get')
+            unchanged = c.get('/cabinet/get', headers={'If-None-Match': first.headers['ETag']})
+
+            c.post('/cabinet/ingredients', json={'add': [vermouth], 'remove': [tonic]})
+            changed = c.get('/cabinet/get', headers={'If-None-Match': first.headers['ETag']})
+            delta = c.get('/cabinet/get?since=0').get_json()
+
+        self.assertEqual(first.get_json()['version'], 0)
+        self.assertEqual([i['name'] for i in first.get_json()['ingredients']], ['gin', 'tonic'])
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(delta['version'], 1)
+        self.assertEqual(delta['added'], [{'id': vermouth, 'name': 'vermouth'}])
+        self.assertEqual(delta['removed'], [tonic])
+
+    def test_remove_from_cabinet(self):
+        """The remove form drops the posted ingredients"""
+
+        cabinet_id, gin, tonic = self.cab.id, self.gin.id, self.tonic.id
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post('/cabinet/remove', data={'ingredient_id': [gin, tonic]})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(CabinetIngredient.query.filter_by(cabinet_id=cabinet_id).count(), 0)
+
+    def test_suggestions(self):
+        """Buy-next suggestions are precomputed and refreshed when the cabinet changes"""
+
+        vermouth, campari = self.vermouth.id, self.campari.id
+        recommend.refresh_cabinets([self.cab.id])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            before = c.get('/cabinet/suggestions').get_json()
+            c.post('/cabinet/ingredients', json={'add': [vermouth]})
+            after = c.get('/cabinet/suggestions').get_json()
+
+        # vermouth completes the Martini; the Negroni is still two away
+        self.assertEqual(before['suggestions'], [{'id': vermouth, 'name': 'vermouth', 'unlocks': 1}])
+        self.assertEqual(after['suggestions'], [{'id': campari, 'name': 'campari', 'unlocks': 1}])
+
+    def test_similar_recipes(self):
+        """Similar recipes are ranked by Jaccard similarity of their ingredients"""
+
+        recommend.refresh_similarities()
+        db.session.commit()
+        martini = Recipe.query.filter_by(name='Martini').one().id
+
+        data = self.client.get(f'/api/cdb/recipes/{martini}/similar').get_json()
+
+        self.assertEqual([(r['name'], r['score']) for r in data['similar']],
+            [('Negroni', 0.667), ('Gin and Tonic', 0.333)])
+
+    def test_refresh_all_job_rebuilds_index(self):
+        """The refresh queued after a sync sees recipes this process's index hasn't"""
+
+        matcher.get_index()
+        # written by another process, as a mirror sync would
+        recipe_id = db.session.execute(Recipe.__table__.insert().values(name='Dry Martini')).lastrowid
+        db.session.execute(RecipeIngredient.__table__.insert(), [
+            {'recipe_id': recipe_id, 'ingredient_id': self.gin.id},
+            {'recipe_id': recipe_id, 'ingredient_id': self.vermouth.id},
+        ])
+        db.session.commit()
+
+        recommend.refresh_all_job()
+        db.session.commit()
+        martini = Recipe.query.filter_by(name='Martini').one().id
+
+        self.assertIn((martini, recipe_id), {(s.recipe_id, s.similar_recipe_id) for s in RecipeSimilarity.query})
+
+
+class UserViewTestCase(DatabaseTestCase):
+    """Tests for the user blueprint"""
+
+    def setUp(self):
+        """create test client, and add sample data"""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.u = User.signup(
+            username='testuser',
+            email='test@test.com',
+            password='testtest',
+        )
+        self.u2 = User.signup(
+            username='testuser2',
+            email='test2@test.com',
+            password='testtest',
+        )
+        db.session.commit()
+        db.session.add_all([Cabinet(user_id=self.u.id), Cabinet(user_id=self.u2.id)])
+        db.session.commit()
+
+        self.u_id = self.u.id
+        self.u2_id = self.u2.id
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_hasher_busy(self):
+        """With every hash slot taken, login and signup answer 503 with Retry-After"""
+
+        slots = [hasher._slots.acquire(blocking=False) for i in range(hasher.max_pending)]
+        self.assertTrue(all(slots))
+        try:
+            login = self.client.post('/login', data={'username': 'testuser', 'password': 'testtest'})
+            signup = self.client.post('/signup', data={
+                'username': 'newuser', 'email': 'new@test.com', 'password': 'testtest'})
+        finally:
+            for slot in slots:
+                hasher._slots.release()
+
+        for resp in (login, signup):
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertIsNone(User.query.filter_by(username='newuser').first())
+        self.assertEqual(self.client.post('/login', data={'username': 'testuser', 'password': 'testtest'}).status_code, 302)
+
+    def test_timeline_fan_out(self):
+        """New posts show up in followers' home feeds"""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/user/follow/{self.u2_id}')
+
+            self.login(c, self.u2_id)
+            c.post('/user/create', data={'content': 'shaken not stirred'})
+
+            self.login(c, self.u_id)
+            resp = c.get('/user/')
+
+        self.assertIn(b'shaken not stirred', resp.data)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u_id).count(), 1)
+
+    def test_timeline_backfill_on_follow(self):
+        """Following a user copies their existing posts into the timeline"""
+
+        db.session.add(Post(user_id=self.u2_id, content='an old fashioned'))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/user/follow/{self.u2_id}')
+            resp = c.get('/user/')
+
+        self.assertIn(b'an old fashioned', resp.data)
+
+    def test_timeline_migration(self):
+        """Migration 11 completes timelines from before they existed, and reading one never writes"""
+
+        old = Post(user_id=self.u2_id, content='an old fashioned')
+        db.session.add_all([old, Follows(user_being_followed_id=self.u2_id, user_following_id=self.u_id)])
+        db.session.commit()
+        # a post fanned out since, on a timeline that was never built
+        new = Post(user_id=self.u2_id, content='a new fashioned')
+        db.session.add(new)
+        db.session.flush()
+        db.session.add(TimelineEntry(user_id=self.u_id, post_id=new.id, timestamp=new.timestamp))
+        db.session.commit()
+        post_ids = {old.id, new.id}
+
+        # testuser2's own posts were added without fan-out, so its feed is empty
+        with self.client as c:
+            self.login(c, self.u2_id)
+            with count_queries(db.engine) as counted:
+                c.get('/user/')
+        self.assertFalse([statement for statement in counted if statement.startswith(('INSERT', 'UPDATE'))])
+
+        migrate.build_timelines(db.session.connection())
+        db.session.commit()
+
+        self.assertEqual({entry.post_id for entry in TimelineEntry.query.filter_by(user_id=self.u_id)}, post_ids)
+
+    def test_feed_pagination(self):
+        """The JSON feed pages through posts newest first without repeats"""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            for i in range(5):
+                c.post('/user/create', data={'content': f'post {i}'})
+
+            first = c.get('/user/feed?limit=3').get_json()
+            second = c.get(f"/user/feed?limit=3&cursor={first['next_cursor']}").get_json()
+
+        self.assertEqual([p['content'] for p in first['posts']], ['post 4', 'post 3', 'post 2'])
+        self.assertEqual([p['content'] for p in second['posts']], ['post 1', 'post 0'])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_comment_pagination(self):
+        """Comments page oldest first and reject malformed cursors"""
+
+        post = Post(user_id=self.u_id, content='a daiquiri')
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+        db.session.add_all([Comment(user_id=self.u2_id, post_id=post_id, content=f'comment {i}') for i in range(3)])
+        db.session.commit()
+
+        first = self.client.get(f'/post/{post_id}/comments?limit=2').get_json()
+        second = self.client.get(f"/post/{post_id}/comments?limit=2&cursor={first['next_cursor']}").get_json()
+
+        self.assertEqual([c['content'] for c in first['comments']], ['comment 0', 'comment 1'])
+        self.assertEqual([c['content'] for c in second['comments']], ['comment 2'])
+        self.assertEqual(self.client.get(f'/post/{post_id}/comments?cursor=nope').status_code, 400)
+
+
+    def test_fragment_cache(self):
+        """Post pages render from cache until a comment retires the comments fragment"""
+
+        post = Post(user_id=self.u_id, content='a sazerac')
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+            c.get(f'/post/{post_id}')
+            self.assertEqual(len(fragment_cache.cache.backend._entries), 3)
+
+            c.post(f'/user/comment/{post_id}', data={'content': 'needs more absinthe'})
+            resp = c.get(f'/post/{post_id}')
+
+        self.assertIn(b'needs more absinthe', resp.data)
+        self.assertIn(b'a sazerac', resp.data)
+
+    def test_fragment_cache_shared_invalidation(self):
+        """On the filesystem backend an invalidation in one worker retires the fragment in the others"""
+
+        def render(cache, html):
+            return str(cache.fragment('feed-post', 1, scope='post:1', caller=lambda: html))
+
+        with tempfile.TemporaryDirectory() as path:
+            one = fragment_cache.FragmentCache(fragment_cache.FileSystemBackend(path))
+            two = fragment_cache.FragmentCache(fragment_cache.FileSystemBackend(path))
+
+            self.assertEqual(render(one, 'old'), 'old')
+            self.assertEqual(render(two, 'new'), 'old')
+            one.invalidate('post:1')
+            self.assertEqual(render(two, 'new'), 'new')
+
+    def test_fragment_cache_directory_must_be_private(self):
+        """The filesystem backend creates its directory 0700 and refuses one others can use"""
+
+        with tempfile.TemporaryDirectory() as parent:
+            private = os.path.join(parent, 'fragments')
+            fragment_cache.FileSystemBackend(private)
+            self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+
+            shared = os.path.join(parent, 'shared')
+            os.mkdir(shared)
+            os.chmod(shared, 0o777)
+            with self.assertRaises(ValueError):
+                fragment_cache.FileSystemBackend(shared)
+
+            link = os.path.join(parent, 'link')
+            os.symlink(private, link)
+            with self.assertRaises(ValueError):
+                fragment_cache.FileSystemBackend(link)
+
+    def test_counters(self):
+        """Follow, post, comment and unfollow keep the profile counters in step"""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/user/follow/{self.u2_id}')
+            c.post(f'/user/follow/{self.u2_id}')
+
+            self.login(c, self.u2_id)
+            c.post('/user/create', data={'content': 'last call'})
+            post_id = Post.query.filter_by(user_id=self.u2_id).one().id
+
+            self.login(c, self.u_id)
+            c.post(f'/user/comment/{post_id}', data={'content': 'one more'})
+            followed = c.get('/user/testuser2')
+            c.post(f'/user/unfollow/{self.u2_id}')
+            home = c.get('/user/')
+
+        u, u2 = User.query.get(self.u_id), User.query.get(self.u2_id)
+        self.assertIn(b'1 followers &middot; 0 following &middot; 1 posts', followed.data)
+        self.assertEqual((u.following_count, u.comments_count), (0, 1))
+        self.assertEqual((u2.followers_count, u2.posts_count), (0, 1))
+        # the unfollowed user's posts leave the timeline too
+        self.assertNotIn(b'last call', home.data)
+
+    def test_reconcile_counters(self):
+        """The reconcile job repairs counters that drifted from the rows"""
+
+        db.session.add(Follows(user_following_id=self.u_id, user_being_followed_id=self.u2_id))
+        User.query.filter_by(id=self.u_id).update({'posts_count': 7})
+        db.session.commit()
+
+        drift = counters.reconcile([self.u_id, self.u2_id])
+        db.session.commit()
+
+        self.assertEqual(drift, {
+            self.u_id: {'following': (0, 1), 'posts': (7, 0)},
+            self.u2_id: {'followers': (0, 1)},
+        })
+        self.assertEqual(User.query.get(self.u_id).posts_count, 0)
+        self.assertEqual(counters.reconcile([self.u_id, self.u2_id]), {})
+
+    def test_follow_suggestions(self):
+        """Friends of friends are suggested by mutual follows, minus accounts already followed"""
+
+        u3, u4, u5 = (User(username=f'testuser{i}', email=f'test{i}@test.com', password='x') for i in (3, 4, 5))
+        db.session.add_all([u3, u4, u5])
+        db.session.flush()
+        ids = self.u_id, self.u2_id, u3.id, u4.id, u5.id
+        u, u2, u3, u4, u5 = ids
+
+        # u follows u2 and u3; both follow u4, only u2 follows u5
+        db.session.add_all([Follows(user_following_id=a, user_being_followed_id=b)
+            for a, b in [(u, u2), (u, u3), (u2, u4), (u3, u4), (u2, u5), (u4, u)]])
+        db.session.commit()
+        suggestions.refresh_all(log=lambda message: None)
+
+        with self.client as c:
+            self.login(c, u)
+            before = c.get('/user/suggestions').get_json()
+            c.post(f'/user/follow/{u4}')
+            after = c.get('/user/suggestions').get_json()
+
+        self.assertEqual([(s['username'], s['mutuals']) for s in before['suggestions']],
+            [('testuser4', 2), ('testuser5', 1)])
+        self.assertEqual([s['username'] for s in after['suggestions']], ['testuser5'])
+        self.assertEqual(FollowSuggestion.query.filter_by(user_id=u4).count(), 2)
+
+    def test_identity_cache(self):
+        """g.user is served from the identity cache and dropped on logout"""
+
+        identity.cache.clear()
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.get('/user/')
+            self.assertIsNotNone(identity.cache.get(self.u_id))
+
+            # a cached user still lazy loads its relationships
+            resp = c.post(f'/user/follow/{self.u2_id}')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.filter_by(user_following_id=self.u_id).count(), 1)
+
+            c.get('/logout')
+            self.assertIsNone(identity.cache.get(self.u_id))
+
+
+    def test_home_query_count_is_constant(self):
+        """The home feed runs the same number of statements for 2 or 12 posts"""
+
+        def home_queries(c):
+            fragment_cache.cache.clear()
+            with count_queries(db.engine) as counted:
+                resp = c.get('/user/')
+            self.assertEqual(resp.status_code, 200)
+            return len(counted)
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/user/follow/{self.u2_id}')
+
+            self.login(c, self.u2_id)
+            for i in range(2):
+                c.post('/user/create', data={'content': f'post {i}'})
+
+            self.login(c, self.u_id)
+            # the follow bumped our counters, so the first request reloads g.user
+            home_queries(c)
+            few = home_queries(c)
+
+            self.login(c, self.u2_id)
+            for i in range(10):
+                c.post('/user/create', data={'content': f'more {i}'})
+
+            self.login(c, self.u_id)
+            many = home_queries(c)
+
+        self.assertEqual(few, many)
+
+
+    def export(self, client, **headers):
+        resp = client.get('/user/export', headers=headers)
+        data = resp.data
+        if resp.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return resp, [json.loads(line) for line in data.decode().splitlines()]
+
+    def test_export(self):
+        """The export streams every record of the account as NDJSON, gzipped when accepted"""
+
+        recipe = Recipe(name='Gimlet')
+        gin = Ingredient(name='Gin')
+        db.session.add_all([recipe, gin, Post(content='other post', user_id=self.u2_id)])
+        db.session.commit()
+        post = Post(content='my post', user_id=self.u_id)
+        cabinet = Cabinet.query.filter_by(user_id=self.u_id).one()
+        db.session.add_all([post, Favorites(user_id=self.u_id, recipe_id=recipe.id),
+            CabinetIngredient(cabinet_id=cabinet.id, ingredient_id=gin.id)])
+        db.session.commit()
+        db.session.add(Comment(content='my comment', user_id=self.u_id, post_id=post.id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            resp, records = self.export(c)
+            zipped, unzipped = self.export(c, **{'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(unzipped, records)
+        self.assertEqual([(r['type'], r.get('content') or r.get('name') or r.get('username')) for r in records], [
+            ('user', 'testuser'),
+            ('post', 'my post'),
+            ('comment', 'my comment'),
+            ('favorite', 'Gimlet'),
+            ('cabinet_ingredient', 'Gin'),
+        ])
+
+    def test_export_chunks(self):
+        """A long export is sent in several chunks rather than built up in one"""
+
+        db.session.add_all([Post(content='x' * 400, user_id=self.u_id) for i in range(400)])
+        db.session.commit()
+
+        chunks = list(export.ndjson(export.records(self.u_id)))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertLess(max(len(chunk) for chunk in chunks), export.CHUNK_BYTES + 1024)
+        self.assertEqual(sum(chunk.count(b'\n') for chunk in chunks), 401)
+
+    def test_export_requires_login(self):
+        """Logged out users get a 401"""
+
+        self.assertEqual(self.client.get('/user/export').status_code, 401)
+
+class ReplicaRoutingTestCase(DatabaseTestCase):
+    """GET pages read from a replica until the user writes"""
+
+    REPLICA_URL = os.environ.get('REPLICA_DATABASE_URL', "sqlite://")
+
+    def setUp(self):
+        """create test client, a replica that lags behind the primary, and sample data"""
+
+        super().setUp()
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica_0': self.REPLICA_URL}
+        app.config['DB_REPLICA_BINDS'] = ['replica_0']
+        self.replica = db.get_engine(app, bind='replica_0')
+        db.metadata.create_all(self.replica)
+        for table in reversed(db.metadata.sorted_tables):
+            self.replica.execute(table.delete())
+
+        self.client = app.test_client()
+
+        u = User.signup(
+            username='testuser',
+            email='test@test.com',
+            password='testtest',
+        )
+        db.session.commit()
+        self.u_id = u.id
+
+        # the replica has the user but hasn't caught up on their post yet
+        self.replica.execute(User.__table__.insert(), [{c.name: getattr(u, c.name) for c in User.__table__.c}])
+        db.session.add(Post(user_id=u.id, content='fresh from the primary'))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['DB_REPLICA_BINDS'] = []
+
+    def test_reads_go_to_replica_until_a_write(self):
+        """Reads hit the lagging replica, then the primary right after the user writes"""
+
+        with self.client as c:
+            before = c.get('/user/testuser/posts').get_json()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+            c.post('/user/create', data={'content': 'another round'})
+            after = c.get('/user/testuser/posts').get_json()
+
+        self.assertEqual(before['posts'], [])
+        self.assertEqual([p['content'] for p in after['posts']], ['another round', 'fresh from the primary'])
+
+
+@jobs.task('test.flaky', max_attempts=2)
+def flaky_task(message):
+    raise RuntimeError(message)
+
+
+class JobQueueTestCase(DatabaseTestCase):
+    """Tests for the background job queue"""
+
+    def setUp(self):
+        """create test client, and add sample data"""
+
+        super().setUp()
+
+        app.config['JOBS_EAGER'] = False
+        self.client = app.test_client()
+
+        u = User.signup(username='testuser', email='test@test.com', password='testtest')
+        u2 = User.signup(username='testuser2', email='test2@test.com', password='testtest')
+        db.session.flush()
+        db.session.add(Follows(user_following_id=u.id, user_being_followed_id=u2.id))
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        app.config['JOBS_EAGER'] = True
+
+    def test_fan_out_is_deferred(self):
+        """A new post reaches followers' timelines when a worker runs the job"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post('/user/create', data={'content': 'a last word'})
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u_id).count(), 0)
+
+        with app.app_context():
+            self.assertEqual(jobs.work_once('test'), 1)
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u_id).count(), 1)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_retry_then_fail(self):
+        """A failing job is retried with backoff, then kept as failed"""
+
+        with app.test_request_context():
+            jobs.enqueue('test.flaky', message='out of ice')
+            db.session.commit()
+
+            jobs.work_once('test')
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertGreater(job.run_at, job.created_at)
+            self.assertEqual(jobs.work_once('test'), 0)
+
+            job.run_at = job.created_at
+            db.session.commit()
+            jobs.work_once('test')
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ('failed', 2))
+            self.assertIn('out of ice', job.last_error)
+
+
+class MetricsViewTestCase(TestCase):
+    """Tests for the /metrics endpoint"""
+
+    def test_metrics(self):
+        """Requests show up as Prometheus series"""
+
+        client = app.test_client()
+        client.get('/')
+        resp = client.get('/metrics', headers={'Authorization': 'Bearer test-metrics-token'})
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('bartender_request_duration_seconds_count{endpoint="landing_page",method="GET"}', text)
+        self.assertIn('bartender_requests_total{endpoint="landing_page",method="GET",status="200"}', text)
+        self.assertIn('bartender_sql_statements_total{endpoint="landing_page"} 0', text)
+
+    def test_made_up_methods_share_a_series(self):
+        """Methods outside the standard set are labelled 'other'"""
+
+        client = app.test_client()
+        client.open('/nowhere', method='BREW')
+        text = client.get('/metrics', headers={'Authorization': 'Bearer test-metrics-token'}).get_data(as_text=True)
+
+        self.assertNotIn('BREW', text)
+        self.assertIn('bartender_requests_total{endpoint="unmatched",method="other",status="404"}', text)
+
+    def test_failed_statement_timing(self):
+        """A failing statement leaves nothing on the connection for later timings to pop"""
+
+        with app.test_request_context():
+            with db.engine.connect() as conn:
+                with self.assertRaises(Exception):
+                    conn.execute('SELECT * FROM no_such_table')
+                conn.execute('SELECT 1')
+                self.assertNotIn('query_start', conn.info)
+                self.assertGreater(g._sql_time, 0)
+
+    def test_metrics_access(self):
+        """Only scrapers with the token or from an allowed network can read /metrics"""
+
+        client = app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 404)
+
+        app.config['METRICS_ALLOWED_NETWORKS'] = ['10.0.0.0/8']
+        self.addCleanup(app.config.update, METRICS_ALLOWED_NETWORKS=[])
+        self.assertEqual(client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code, 200)
+        self.assertEqual(client.get('/metrics', environ_base={'REMOTE_ADDR': '192.168.1.2'}).status_code, 404)
+
+
+class IngredientSearchTestCase(DatabaseTestCase):
+    """Tests for ingredient autocomplete"""
+
+    def setUp(self):
+        """create test client, and add sample data"""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        triple_sec = Ingredient(name='Triple Sec')
+        db.session.add_all([
+            Ingredient(name='Gin'),
+            Ingredient(name='Ginger Beer'),
+            Ingredient(name='Crème de Cassis'),
+            triple_sec,
+            IngredientAlias(name='Cointreau', ingredient=triple_sec),
+        ])
+        db.session.commit()
+
+    def search(self, q):
+        return self.client.get(f'/cabinet/ingredients/autocomplete?q={q}').get_json()['results']
+
+    def test_prefix(self):
+        """Prefix matches come back with the exact match first"""
+
+        self.assertEqual([r['name'] for r in self.search('gin')], ['Gin', 'Ginger Beer'])
+
+    def test_fuzzy_and_normalized(self):
+        """Accents, case and typos still match"""
+
+        self.assertEqual(self.search('creme de cassis')[0]['name'], 'Crème de Cassis')
+        self.assertEqual(self.search('ginger bear')[0]['name'], 'Ginger Beer')
+
+    def test_alias(self):
+        """Aliases answer with the canonical ingredient"""
+
+        result = self.search('cointreau')[0]
+        self.assertEqual(result['name'], 'Triple Sec')
+        self.assertEqual(result['alias'], 'Cointreau')
+
+    def test_incremental_update(self):
+        """Committed ingredients are searchable without a rebuild"""
+
+        self.search('gin')
+        db.session.add(Ingredient(name='Grenadine'))
+        db.session.commit()
+
+        self.assertEqual(self.search('gren')[0]['name'], 'Grenadine')
+
+
+class SearchTestCase(DatabaseTestCase):
+    """Tests for full-text search"""
+
+    def setUp(self):
+        """create test client, and add sample data"""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        u = User.signup(
+            username='testuser',
+            email='test@test.com',
+            password='testtest',
+        )
+        db.session.commit()
+
+        gin = Ingredient(name='Gin')
+        lime = Ingredient(name='Lime Juice')
+        post = Post(content='Mixing a gimlet tonight', user_id=u.id)
+        db.session.add_all([
+            post,
+            Post(content='Cocktails with friends', user_id=u.id),
+            Recipe(name='Gimlet', ingredients=[gin, lime]),
+            Recipe(name='Daiquiri', ingredients=[Ingredient(name='Rum'), lime]),
+        ])
+        db.session.commit()
+        db.session.add(Comment(content='A gimlet needs fresh lime', user_id=u.id, post_id=post.id))
+        db.session.commit()
+
+    def search(self, query):
+        return self.client.get(f'/search/?{query}').get_json()
+
+    def test_search(self):
+        """Posts, comments and recipes all match, recipes by name and ingredients"""
+
+        results = self.search('q=gimlet')['results']
+        self.assertEqual({(r['type'], r.get('name') or r.get('content')) for r in results}, {
+            ('post', 'Mixing a gimlet tonight'),
+            ('comment', 'A gimlet needs fresh lime'),
+            ('recipe', 'Gimlet'),
+        })
+        self.assertEqual(results, sorted(results, key=lambda r: -r['score']))
+
+        self.assertEqual({r['name'] for r in self.search('q=lime&type=recipe')['results']}, {'Daiquiri', 'Gimlet'})
+        self.assertEqual([r['content'] for r in self.search('q=cocktail')['results']], ['Cocktails with friends'])
+        self.assertEqual(self.search('q=gimlet rum')['results'], [])
+
+    def test_type_and_pagination(self):
+        """?type= narrows the kinds and ?page= walks the results"""
+
+        first = self.search('q=lime&limit=1')
+        second = self.search('q=lime&limit=1&page=2')
+        third = self.search('q=lime&limit=1&page=3')
+
+        self.assertEqual((first['next_page'], second['next_page'], third['next_page']), (2, 3, None))
+        self.assertEqual(len({(r['type'], r['id']) for r in first['results'] + second['results'] + third['results']}), 3)
+        self.assertEqual([r['type'] for r in self.search('q=lime&type=comment')['results']], ['comment'])
+
+        resp = self.client.get('/search/?q=lime&type=user')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_memory_backend_tracks_commits(self):
+        """The in-process index picks up new, edited and deleted rows"""
+
+        app.config['SEARCH_BACKEND'] = 'memory'
+        try:
+            self.assertEqual(self.search('q=negroni')['results'], [])
+
+            recipe = Recipe.query.filter_by(name='Daiquiri').one()
+            recipe.name = 'Negroni'
+            db.session.add(Post(content='Negroni week', user_id=User.query.one().id))
+            db.session.commit()
+            self.assertEqual(len(self.search('q=negroni')['results']), 2)
+
+            Ingredient.query.filter_by(name='Rum').one().name = 'Campari'
+            db.session.delete(Post.query.filter_by(content='Negroni week').one())
+            db.session.commit()
+            self.assertEqual([r['name'] for r in self.search('q=campari')['results']], ['Negroni'])
+            self.assertEqual([r['type'] for r in self.search('q=negroni')['results']], ['recipe'])
+        finally:
+            app.config.pop('SEARCH_BACKEND')
+
+
+class RateLimitTestCase(DatabaseTestCase):
+    """Tests for write rate limits and admission control"""
+
+    def setUp(self):
+        """create test client, and add sample data"""
+
+        super().setUp()
+
+        limiter = ratelimit.limiter
+        for name in ('backend', 'rates', 'slots'):
+            self.addCleanup(setattr, limiter, name, getattr(limiter, name))
+        limiter.backend = ratelimit.MemoryBackend()
+        limiter.rates = {'auth': (60, 2), 'write': (60, 2)}
+        limiter.slots = {'auth': threading.BoundedSemaphore(1), 'write': threading.BoundedSemaphore(1)}
+
+        self.client = app.test_client()
+
+        self.u = User.signup(
+            username='testuser',
+            email='test@test.com',
+            password='testtest',
+        )
+        self.u2 = User.signup(
+            username='testuser2',
+            email='test2@test.com',
+            password='testtest',
+        )
+        db.session.commit()
+
+        self.u_id = self.u.id
+        self.u2_id = self.u2.id
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_write_rate_limit(self):
+        """Past the burst a user's posts get a 429, other users' don't"""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            statuses = [c.post('/user/create', data={'content': f'post {i}'}).status_code for i in range(3)]
+            resp = c.post('/user/create', data={'content': 'one more'})
+            # the form is read, not written
+            self.assertEqual(c.get('/user/create').status_code, 200)
+
+            self.login(c, self.u2_id)
+            other = c.post('/user/create', data={'content': 'my first post'})
+
+        self.assertEqual(statuses, [302, 302, 429])
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(other.status_code, 302)
+        self.assertEqual(Post.query.filter_by(user_id=self.u_id).count(), 2)
+
+    def test_login_limited_by_ip(self):
+        """Anonymous logins share a bucket per address; JSON clients get a JSON error"""
+
+        data = {'username': 'testuser', 'password': 'wrong'}
+        statuses = [self.client.post('/login', data=data).status_code for i in range(2)]
+        resp = self.client.post('/login', data=data, headers={'Accept': 'application/json'})
+        elsewhere = self.client.post('/login', data=data, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+
+        self.assertEqual(statuses, [302, 302])
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('error', resp.get_json())
+        self.assertEqual(elsewhere.status_code, 302)
+
+    def test_overload_sheds(self):
+        """With every slot of a class taken, requests are refused at once without spending tokens"""
+
+        slots = ratelimit.limiter.slots['write']
+        slots.acquire()
+        try:
+            with self.client as c:
+                self.login(c, self.u_id)
+                resp = c.post(f'/user/follow/{self.u2_id}')
+        finally:
+            slots.release()
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(ratelimit.limiter.backend.take(f'write:user:{self.u_id}', 1, 2), 0)
+
+    def test_bucket_refill(self):
+        """Tokens come back at the rate, up to the burst"""
+
+        backend = ratelimit.MemoryBackend(max_keys=2)
+        self.assertEqual([backend.take('a', 10, 2) > 0 for i in range(3)], [False, False, True])
+        self.assertAlmostEqual(backend.take('a', 10, 2), 0.1, places=2)
+
+        backend._buckets['a'] = (0, backend._buckets['a'][1] - 1)
+        self.assertEqual(backend.take('a', 10, 2), 0)
+        self.assertEqual(backend.take('a', 10, 2), 0)
+        self.assertGreater(backend.take('a', 10, 2), 0)
+
+        backend.take('b', 10, 2)
+        backend.take('c', 10, 2)
+        self.assertEqual(list(backend._buckets), ['b', 'c'])
+
+    def test_filesystem_backend(self):
+        """Buckets on disk are shared by every backend on the directory"""
+
+        with tempfile.TemporaryDirectory() as path:
+            one, two = ratelimit.FileSystemBackend(path), ratelimit.FileSystemBackend(path)
+            self.assertEqual(one.take('a', 1, 2), 0)
+            self.assertEqual(two.take('a', 1, 2), 0)
+            self.assertGreater(one.take('a', 1, 2), 0)
+            self.assertEqual(two.take('b', 1, 2), 0)
+
+            os.utime(two._file('b'), (0, 0))
+            two.prune()
+            self.assertEqual(len(os.listdir(path)), 1)
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app and worker start up"""
+
+    # seconds for a fresh interpreter to import the app and build it
+    COLD_START_BUDGET = 1.5
+
+    def cold_start(self):
+        script = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "from app import create_app\n"
+            "create_app('production')\n"
+            "print(time.perf_counter() - start)\n"
+            "print(' '.join(sorted({name.split('.')[0] for name in sys.modules} & {'numpy', 'scipy', 'flask_debugtoolbar'})))\n")
+        env = dict(os.environ, DATABASE_URL='sqlite://')
+        out = subprocess.run([sys.executable, '-c', script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.split('\n')
+        return float(out[0]), out[1]
+
+    def test_cold_start(self):
+        """A worker boots within budget without loading the batch or debug-only libraries"""
+
+        runs = [self.cold_start() for i in range(3)]
+
+        self.assertLess(min(seconds for seconds, loaded in runs), self.COLD_START_BUDGET)
+        self.assertEqual(runs[0][1], '')
+
+    def test_isolated_apps(self):
+        """Each call builds a separate app from its profile"""
+
+        class OtherConfig(TestingConfig):
+            SECRET_KEY = 'another secret'
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
+        other = create_app(OtherConfig)
 
-app.config['WTF_CSRF_ENABLED'] = False
+        self.assertIsNot(other, app)
+        self.assertEqual(other.config['SECRET_KEY'], 'another secret')
+        self.assertNotEqual(app.config['SECRET_KEY'], 'another secret')
+        self.assertEqual(other.test_client().get('/').status_code, 200)
+        # the shared session still belongs to the first app
+        self.assertIs(db.get_app(), app)
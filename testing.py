@@ -0,0 +1,97 @@
+"""Shared test fixtures.
+
+    python -m pytest -q                   in-memory SQLite, no server needed
+    python -m pytest -q -n auto           the same across every core (pytest-xdist)
+    TEST_DATABASE_URL=postgresql:///bartender_test python -m pytest -q
+
+Each process gets its own database: in-memory SQLite is private to the
+process, and a Postgres URL gets the xdist worker name appended, so
+bartender_test_gw0, bartender_test_gw1, ... have to exist for parallel runs.
+
+DatabaseTestCase runs every test inside one transaction that is rolled back
+when the test ends, instead of deleting from every table before each test.
+The session is bound to that transaction and starts a SAVEPOINT inside it,
+so the app's commits release a savepoint (firing after_commit as usual) and
+its rollbacks roll back to one, and the next savepoint starts right after.
+"""
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import create_app
+from models import db
+
+# the app every test module shares, on the testing profile in config.py
+app = create_app('testing')
+
+
+def reset_caches():
+    """Drop in-process state built from rows a rolled back test committed"""
+
+    import fragment_cache
+    import identity
+    from blueprints.cabinet import ingredient_index, matcher
+    from blueprints.search import index as search_index
+
+    fragment_cache.cache.clear()
+    identity.cache.clear()
+    ingredient_index.invalidate()
+    matcher.invalidate()
+    search_index.invalidate()
+
+
+def begin_test_transaction():
+    """Bind db.session to a transaction that is never committed; returns a function rolling it back"""
+
+    connection = db.engine.connect()
+    outer = connection.begin()
+
+    db.session.remove()
+    factory = db.session.session_factory
+    options = dict(factory.kw)
+    # binds={} stops Flask-SQLAlchemy mapping every table straight to the engine
+    factory.configure(bind=connection, binds={})
+
+    session = db.session()
+    session.begin_nested()
+
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            # a released savepoint stands in for a commit, so expire like one
+            session.expire_all()
+            session.begin_nested()
+
+    def remove():
+        # what ending a request does to a real session: drop uncommitted
+        # work and every loaded instance, keeping the transaction open
+        session.rollback()
+        session.expunge_all()
+        session.info.clear()
+
+    event.listen(session, 'after_transaction_end', restart_savepoint)
+    db.session.remove = remove
+
+    def rollback():
+        event.remove(session, 'after_transaction_end', restart_savepoint)
+        del db.session.remove
+        # out of the savepoint first, or the connection is left inside it
+        session.rollback()
+        session.close()
+        db.session.remove()
+        factory.kw = options
+        outer.rollback()
+        connection.close()
+        reset_caches()
+
+    return rollback
+
+
+class DatabaseTestCase(TestCase):
+    """TestCase whose database writes are rolled back after every test
+
+    Subclasses call super().setUp() before adding their sample data.
+    """
+
+    def setUp(self):
+        self.addCleanup(begin_test_transaction())
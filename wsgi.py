@@ -0,0 +1,8 @@
+"""WSGI entry point.
+
+    gunicorn --workers 4 wsgi:app
+"""
+
+from app import create_app
+
+app = create_app()